@@ -1,5 +1,11 @@
 #!/usr/bin/env python3
 import base64
+import contextlib
+import ctypes
+import functools
+import grp
+import gzip
+import socket
 import json
 import os
 import re
@@ -10,9 +16,19 @@ import time
 import traceback
 import hashlib
 import html
+import select
 import shlex
+import asyncio
+import bisect
+import heapq
+import ssl
+import hmac
+import http.client
+import http.server
+import threading
 from threading import Thread
-import urllib.request
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait as wait_futures
 from datetime import datetime, timezone
 from pathlib import Path
 
@@ -46,7 +62,13 @@ SUPPORT_CHAT_URL = os.environ.get("SUPPORT_CHAT_URL", "https://t.me/admin")
 FREE_DAYS = int(os.environ.get("FREE_DAYS", "1"))
 START_RATE_LIMIT_SEC = int(os.environ.get("START_RATE_LIMIT_SEC", "30"))
 DB_PATH = os.environ.get("DB_PATH", "/var/lib/hexenvpn-bot/bot.db")
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL").strip().upper() or "NORMAL"
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_MB = int(os.environ.get("SQLITE_CACHE_MB", "16"))
+SQLITE_MMAP_MB = int(os.environ.get("SQLITE_MMAP_MB", "64"))
+DB_GROUP_COMMIT = os.environ.get("DB_GROUP_COMMIT", "1").strip() == "1"
 CLIENTS_JSON = os.environ.get("CLIENTS_JSON", "/var/lib/vless-sub/clients.json")
+CLIENTS_FLUSH_DELAY_SEC = float(os.environ.get("CLIENTS_FLUSH_DELAY_SEC", "2"))
 SUB_DIR = os.environ.get("SUB_DIR", "/var/www/sub")
 ADD_USER_CMD = os.environ.get("ADD_USER_CMD", "/usr/local/sbin/vless-add-user")
 DEL_USER_CMD = os.environ.get("DEL_USER_CMD", "/usr/local/sbin/vless-del-user")
@@ -65,6 +87,13 @@ REPLICA_OPS_CMD = os.environ.get("REPLICA_OPS_CMD", "/usr/local/sbin/replica-ops
 METRICS_CMD = os.environ.get("METRICS_CMD", "/usr/local/sbin/metrics-master-light")
 DEVICE_LOG_PATH = os.environ.get("DEVICE_LOG_PATH", "/var/log/nginx/sub_access.log")
 DEVICE_BOOTSTRAP_BYTES = int(os.environ.get("DEVICE_BOOTSTRAP_BYTES", str(2 * 1024 * 1024)))
+DEVICE_INGEST_CHUNK_BYTES = int(os.environ.get("DEVICE_INGEST_CHUNK_BYTES", str(4 * 1024 * 1024)))
+DEVICE_INGEST_ENABLED = os.environ.get("DEVICE_INGEST_ENABLED", "1").strip() == "1"
+DEVICE_INGEST_POLL_SEC = float(os.environ.get("DEVICE_INGEST_POLL_SEC", "5"))
+DEVICE_INGEST_MIN_GAP_SEC = float(os.environ.get("DEVICE_INGEST_MIN_GAP_SEC", "1"))
+DEVICE_LOG_SOCKET = os.environ.get("DEVICE_LOG_SOCKET", "").strip()
+DEVICE_LOG_SOCKET_GROUP = os.environ.get("DEVICE_LOG_SOCKET_GROUP", "www-data").strip()
+DEVICE_CACHE_TTL_SEC = int(os.environ.get("DEVICE_CACHE_TTL_SEC", "600"))
 DEVICE_LIST_LIMIT = int(os.environ.get("DEVICE_LIST_LIMIT", "12"))
 DEVICE_SOFT_LIMIT = int(os.environ.get("DEVICE_SOFT_LIMIT", "5"))
 ONLINE_WINDOW_SEC = int(os.environ.get("ONLINE_WINDOW_SEC", "900"))
@@ -75,6 +104,10 @@ LIVE_ONLINE_CACHE_TTL_SEC = int(os.environ.get("LIVE_ONLINE_CACHE_TTL_SEC", "20"
 TRAFFIC_COLLECT_ENABLED = os.environ.get("TRAFFIC_COLLECT_ENABLED", "1").strip() == "1"
 TRAFFIC_COLLECT_INTERVAL_SEC = int(os.environ.get("TRAFFIC_COLLECT_INTERVAL_SEC", "300"))
 TRAFFIC_RETENTION_DAYS = int(os.environ.get("TRAFFIC_RETENTION_DAYS", "14"))
+TRAFFIC_DAILY_RETENTION_DAYS = int(os.environ.get("TRAFFIC_DAILY_RETENTION_DAYS", "400"))
+TRAFFIC_NODE_TIMEOUT_SEC = int(os.environ.get("TRAFFIC_NODE_TIMEOUT_SEC", str(LIVE_ONLINE_TIMEOUT_SEC)))
+# Extra xray nodes polled for traffic over SSH, besides master/UK/TR: "code:host,code:host"
+TRAFFIC_EXTRA_NODES = os.environ.get("TRAFFIC_EXTRA_NODES", "").strip()
 TRAFFIC_REPORT_ENABLED = os.environ.get("TRAFFIC_REPORT_ENABLED", "0").strip() == "1"
 TRAFFIC_REPORT_INTERVAL_SEC = int(os.environ.get("TRAFFIC_REPORT_INTERVAL_SEC", "300"))
 TRAFFIC_REPORT_HOUR = int(os.environ.get("TRAFFIC_REPORT_HOUR", "10"))
@@ -94,12 +127,33 @@ TR_HOST = os.environ.get("TR_HOST", "").strip()
 ADMIN_TG_IDS = parse_int_set(os.environ.get("ADMIN_TG_IDS", ""))
 ADMIN_TG_USERNAMES = parse_str_set(os.environ.get("ADMIN_TG_USERNAMES", ""))
 PRIMARY_ADMIN_TG_ID = int(os.environ.get("PRIMARY_ADMIN_TG_ID", "227380225"))
+TG_API_HOST = os.environ.get("TG_API_HOST", "api.telegram.org").strip() or "api.telegram.org"
+TG_HTTP_TIMEOUT_SEC = int(os.environ.get("TG_HTTP_TIMEOUT_SEC", "35"))
+TG_HTTP_IDLE_SEC = int(os.environ.get("TG_HTTP_IDLE_SEC", "55"))
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "4"))
+UPDATE_QUEUE_MAX = int(os.environ.get("UPDATE_QUEUE_MAX", "500"))
+BOT_RUNTIME = os.environ.get("BOT_RUNTIME", "threads").strip().lower() or "threads"
+ASYNC_MAX_WORKERS = int(os.environ.get("ASYNC_MAX_WORKERS", "8"))
+TG_ASYNC_MAX_CONNS = int(os.environ.get("TG_ASYNC_MAX_CONNS", "32"))
+UPDATES_MODE = os.environ.get("UPDATES_MODE", "polling").strip().lower() or "polling"
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").strip()
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1:8081").strip() or "127.0.0.1:8081"
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/tg-webhook").strip() or "/tg-webhook"
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "").strip()
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+OUTBOX_ENABLED = os.environ.get("OUTBOX_ENABLED", "1").strip() == "1"
+OUTBOX_SENDERS = int(os.environ.get("OUTBOX_SENDERS", "2"))
+OUTBOX_GLOBAL_RATE = float(os.environ.get("OUTBOX_GLOBAL_RATE", "25"))
+OUTBOX_GLOBAL_BURST = float(os.environ.get("OUTBOX_GLOBAL_BURST", "30"))
+OUTBOX_CHAT_RATE = float(os.environ.get("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_CHAT_BURST = float(os.environ.get("OUTBOX_CHAT_BURST", "3"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "5"))
 
 if not TOKEN:
     print("BOT_TOKEN is empty", file=sys.stderr)
     sys.exit(1)
 
-API_BASE = f"https://api.telegram.org/bot{TOKEN}"
+API_PATH = f"/bot{TOKEN}"
 
 CB_MAIN = "main"
 CB_MY_SUB = "my_sub"
@@ -171,6 +225,9 @@ JOB_PENDING = "pending"
 JOB_RUNNING = "running"
 JOB_DONE = "done"
 JOB_FAILED = "failed"
+OUTBOX_PRIO_REPLY = 0
+OUTBOX_PRIO_NOTICE = 1
+OUTBOX_PRIO_BULK = 2
 
 PAYMENT_PLANS = {
     1: {"months": 1, "rub": 200, "stars": 250, "days": 30},
@@ -182,21 +239,425 @@ PAYMENT_PLANS = {
 _live_cache = {"ts": 0, "data": None}
 
 
+# Keep-alive HTTPS connections to the Bot API, one per thread (http.client is not thread-safe).
+_tg_http_local = threading.local()
+_tg_http_lock = threading.Lock()
+_tg_http_stats = {"requests": 0, "connects": 0, "reused": 0, "reconnects": 0, "errors": 0}
+# Safe to send twice. Other methods (sendMessage, sendInvoice, ...) are only retried if the request never left.
+_TG_IDEMPOTENT_METHODS = frozenset({"getUpdates", "getMe", "setMyCommands", "setWebhook", "deleteWebhook"})
+
+
+class TelegramApiError(RuntimeError):
+    def __init__(self, message: str, error_code: int = 0, retry_after: int = 0):
+        super().__init__(message)
+        self.error_code = int(error_code or 0)
+        self.retry_after = int(retry_after or 0)
+
+    @classmethod
+    def from_response(cls, method: str, obj: dict):
+        params = obj.get("parameters") or {}
+        return cls(
+            f"Telegram API {method} failed: {obj}",
+            error_code=int(obj.get("error_code") or 0),
+            retry_after=int(params.get("retry_after") or 0),
+        )
+
+
+def _tg_http_stat(key: str, n: int = 1):
+    with _tg_http_lock:
+        _tg_http_stats[key] = int(_tg_http_stats.get(key) or 0) + n
+
+
+def tg_http_stats():
+    with _tg_http_lock:
+        return dict(_tg_http_stats)
+
+
+def _tg_http_drop():
+    conn = getattr(_tg_http_local, "conn", None)
+    _tg_http_local.conn = None
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def _tg_http_conn():
+    conn = getattr(_tg_http_local, "conn", None)
+    last_used = float(getattr(_tg_http_local, "last_used", 0) or 0)
+    # Telegram closes idle keep-alive sockets; do not gamble on a stale one.
+    if conn is not None and (time.time() - last_used) > TG_HTTP_IDLE_SEC:
+        _tg_http_drop()
+        conn = None
+    # An idle socket that is readable has been closed by the server: find out before writing to it.
+    sock = conn.sock if conn is not None else None
+    if conn is not None and (sock is None or sock.fileno() < 0 or select.select([sock], [], [], 0)[0]):
+        _tg_http_drop()
+        conn = None
+    if conn is None:
+        conn = http.client.HTTPSConnection(TG_API_HOST, timeout=TG_HTTP_TIMEOUT_SEC)
+        _tg_http_local.conn = conn
+        _tg_http_stat("connects")
+        return conn, False
+    _tg_http_stat("reused")
+    return conn, True
+
+
 def api_call(method: str, payload: dict):
+    db_commit_pending()
+    if async_bridge_active():
+        return asyncio.run_coroutine_threadsafe(api_call_async(method, payload), _async_rt["loop"]).result()
     data = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(
-        f"{API_BASE}/{method}",
-        data=data,
-        headers={"Content-Type": "application/json"},
-        method="POST",
+    headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+    _tg_http_stat("requests")
+    while True:
+        conn, reused = _tg_http_conn()
+        sent = False
+        try:
+            conn.request("POST", f"{API_PATH}/{method}", body=data, headers=headers)
+            sent = True
+            resp = conn.getresponse()
+            raw = resp.read()
+        except TimeoutError:
+            _tg_http_drop()
+            _tg_http_stat("errors")
+            raise
+        except (http.client.HTTPException, OSError):
+            _tg_http_drop()
+            # A reused socket may have been closed by the server: reconnect once, unless the request
+            # already went out and may have been acted on.
+            if reused and (not sent or method in _TG_IDEMPOTENT_METHODS):
+                _tg_http_stat("reconnects")
+                continue
+            _tg_http_stat("errors")
+            raise
+        except Exception:
+            _tg_http_drop()
+            _tg_http_stat("errors")
+            raise
+        break
+    if resp.will_close:
+        _tg_http_drop()
+    else:
+        _tg_http_local.last_used = time.time()
+    try:
+        obj = json.loads(raw.decode("utf-8", errors="ignore"))
+    except Exception:
+        _tg_http_stat("errors")
+        raise TelegramApiError(f"Telegram API {method} failed: HTTP {resp.status}", error_code=int(resp.status))
+    if not obj.get("ok"):
+        raise TelegramApiError.from_response(method, obj)
+    return obj.get("result")
+
+
+# Asyncio runtime (BOT_RUNTIME=asyncio): outbound HTTP and subprocesses run on a single event loop,
+# synchronous code (handlers, job ticks, sqlite) runs in a bounded executor and calls back into the loop.
+_async_rt = {"loop": None, "thread_id": 0, "tg_sem": None, "tg_idle": [], "update_slots": None, "chat_tails": {}}
+
+
+def async_bridge_active():
+    return _async_rt["loop"] is not None and threading.get_ident() != _async_rt["thread_id"]
+
+
+async def _tg_async_open():
+    host, _sep, port = TG_API_HOST.partition(":")
+    ctx = ssl.create_default_context()
+    # Connect and TLS handshake share one deadline, like the socket timeout of the threaded client.
+    return await asyncio.wait_for(
+        asyncio.open_connection(host, int(port or 443), ssl=ctx, server_hostname=host), TG_HTTP_TIMEOUT_SEC
     )
-    with urllib.request.urlopen(req, timeout=35) as resp:
-        obj = json.loads(resp.read().decode("utf-8", errors="ignore"))
+
+
+async def _tg_async_read_response(reader: asyncio.StreamReader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError("connection closed by server")
+    status = int(status_line.split(b" ", 2)[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        k, _sep, v = line.decode("latin-1").partition(":")
+        headers[k.strip().lower()] = v.strip()
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";", 1)[0].strip() or b"0", 16)
+            if size == 0:
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b"".join(chunks)
+    elif "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    else:
+        body = await reader.read()
+        headers["connection"] = "close"
+    return status, body, headers.get("connection", "").lower() != "close"
+
+
+async def _tg_async_conn():
+    idle = _async_rt["tg_idle"]
+    while idle:
+        reader, writer, last_used = idle.pop()
+        if (time.time() - last_used) <= TG_HTTP_IDLE_SEC and not reader.at_eof():
+            _tg_http_stat("reused")
+            return reader, writer, True
+        writer.close()
+    reader, writer = await _tg_async_open()
+    _tg_http_stat("connects")
+    return reader, writer, False
+
+
+async def api_call_async(method: str, payload: dict):
+    data = json.dumps(payload).encode("utf-8")
+    host = TG_API_HOST.partition(":")[0]
+    request = (
+        f"POST {API_PATH}/{method} HTTP/1.1\r\n"
+        f"Host: {host}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(data)}\r\n"
+        "Connection: keep-alive\r\n\r\n"
+    ).encode("latin-1") + data
+    _tg_http_stat("requests")
+    async with _async_rt["tg_sem"]:
+        while True:
+            reader, writer, reused = await _tg_async_conn()
+            sent = False
+            try:
+                writer.write(request)
+                await asyncio.wait_for(writer.drain(), TG_HTTP_TIMEOUT_SEC)
+                sent = True
+                status, raw, keep_alive = await asyncio.wait_for(_tg_async_read_response(reader), TG_HTTP_TIMEOUT_SEC)
+            except asyncio.TimeoutError:
+                writer.close()
+                _tg_http_stat("errors")
+                raise
+            except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+                writer.close()
+                if reused and (not sent or method in _TG_IDEMPOTENT_METHODS):
+                    _tg_http_stat("reconnects")
+                    continue
+                _tg_http_stat("errors")
+                raise
+            break
+        if keep_alive:
+            _async_rt["tg_idle"].append((reader, writer, time.time()))
+        else:
+            writer.close()
+    try:
+        obj = json.loads(raw.decode("utf-8", errors="ignore"))
+    except Exception:
+        _tg_http_stat("errors")
+        raise TelegramApiError(f"Telegram API {method} failed: HTTP {status}", error_code=int(status))
     if not obj.get("ok"):
-        raise RuntimeError(f"Telegram API {method} failed: {obj}")
+        raise TelegramApiError.from_response(method, obj)
     return obj.get("result")
 
 
+# One SQLite connection per thread, WAL journaling. Writers take _db_write_lock and BEGIN IMMEDIATE,
+# so threads queue on a Python lock instead of spinning in busy_timeout or failing with "database is locked".
+# Lock order: _db_write_lock first, then any module lock (clients_registry.lock, _outbox_cond).
+_db_local = threading.local()
+_db_write_lock = threading.RLock()
+_db_init_lock = threading.Lock()
+_db_rt = {"schema_ready": False}
+_db_stats = {"opened": 0, "writes": 0, "write_wait_ms_max": 0, "write_hold_ms_max": 0, "slow_waits": 0, "commits": 0, "deferred": 0}
+_db_commit_ts = deque(maxlen=8192)
+
+
+def open_db(check_same_thread: bool = True):
+    if SQLITE_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+        raise RuntimeError(f"Unsupported SQLITE_SYNCHRONOUS={SQLITE_SYNCHRONOUS}")
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=max(0.1, SQLITE_BUSY_TIMEOUT_MS / 1000.0),
+        check_same_thread=check_same_thread,
+        cached_statements=256,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout={max(0, SQLITE_BUSY_TIMEOUT_MS)}")
+    conn.execute(f"PRAGMA cache_size=-{max(1, SQLITE_CACHE_MB) * 1024}")
+    conn.execute(f"PRAGMA mmap_size={max(0, SQLITE_MMAP_MB) * 1024 * 1024}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.create_function("device_title", 5, human_device_title, deterministic=True)
+    with _db_init_lock:
+        if not _db_rt["schema_ready"]:
+            init_db(conn)
+            _db_rt["schema_ready"] = True
+        _db_stats["opened"] += 1
+    return conn
+
+
+def db_conn():
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = open_db()
+        _db_local.conn = conn
+    return conn
+
+
+@contextlib.contextmanager
+def db_write(conn: sqlite3.Connection | None = None):
+    # A write transaction on this thread's connection, serialized with other writers.
+    # Nested use joins the outer transaction; the outermost block commits or rolls back.
+    conn = conn if conn is not None else db_conn()
+    if getattr(_db_local, "write_depth", 0) > 0:
+        _db_local.write_depth += 1
+        try:
+            yield conn
+        finally:
+            _db_local.write_depth -= 1
+        return
+    if conn.in_transaction and not getattr(_db_local, "uow_locked", False):
+        # Never wait for _db_write_lock while holding SQLite's write lock from a plain statement.
+        _db_commit_now(conn)
+    t0 = time.monotonic()
+    with _db_write_lock:
+        waited_ms = int((time.monotonic() - t0) * 1000)
+        t1 = time.monotonic()
+        if conn.in_transaction:
+            # Writes deferred by unit_of_work() go in first.
+            _db_commit_now(conn)
+        conn.execute("BEGIN IMMEDIATE")
+        _db_local.write_depth = 1
+        _db_local.rollback_hooks = []
+        try:
+            yield conn
+            _db_commit_now(conn)
+        except BaseException:
+            conn.rollback()
+            for hook in _db_local.rollback_hooks:
+                hook()
+            raise
+        finally:
+            _db_local.write_depth = 0
+            _db_local.rollback_hooks = []
+            hold_ms = int((time.monotonic() - t1) * 1000)
+            _db_stats["writes"] += 1
+            _db_stats["write_wait_ms_max"] = max(_db_stats["write_wait_ms_max"], waited_ms)
+            _db_stats["write_hold_ms_max"] = max(_db_stats["write_hold_ms_max"], hold_ms)
+            if waited_ms >= 100:
+                _db_stats["slow_waits"] += 1
+
+
+def db_on_rollback(hook):
+    # In-memory state changed inside db_write() registers how to forget itself if the transaction fails.
+    if getattr(_db_local, "write_depth", 0) > 0:
+        _db_local.rollback_hooks.append(hook)
+
+
+def _db_commit_now(conn: sqlite3.Connection):
+    conn.commit()
+    _db_stats["commits"] += 1
+    _db_commit_ts.append(time.monotonic())
+    if conn is getattr(_db_local, "conn", None):
+        _db_local.uow_dirty = False
+        if getattr(_db_local, "uow_locked", False):
+            _db_local.uow_locked = False
+            _db_write_lock.release()
+
+
+def db_commit(conn: sqlite3.Connection):
+    # Commit now, or at the end of the enclosing unit_of_work() on this thread. A deferred commit keeps
+    # SQLite's write lock until the unit ends, so it holds _db_write_lock too; if another writer has it, commit now.
+    if DB_GROUP_COMMIT and getattr(_db_local, "uow_depth", 0) > 0 and conn is getattr(_db_local, "conn", None) and conn.in_transaction:
+        if not getattr(_db_local, "uow_locked", False):
+            if not _db_write_lock.acquire(blocking=False):
+                _db_commit_now(conn)
+                return
+            _db_local.uow_locked = True
+        _db_local.uow_dirty = True
+        _db_stats["deferred"] += 1
+        return
+    _db_commit_now(conn)
+
+
+def db_commit_pending():
+    # Called before network calls and subprocesses so the SQLite write lock is never held across them.
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None and getattr(_db_local, "uow_dirty", False):
+        _db_commit_now(conn)
+
+
+@contextlib.contextmanager
+def unit_of_work():
+    # Groups the db_commit() calls of one update or job tick into a single commit. Committed writes go in
+    # even if the block raises, as they did when every helper committed on its own.
+    depth = getattr(_db_local, "uow_depth", 0)
+    _db_local.uow_depth = depth + 1
+    try:
+        yield
+    finally:
+        _db_local.uow_depth = depth
+        if depth == 0:
+            db_commit_pending()
+            conn = getattr(_db_local, "conn", None)
+            if conn is not None and conn.in_transaction:
+                # DML that never reached db_commit() (the block raised first): do not sit on SQLite's write lock.
+                conn.rollback()
+
+
+def db_stats():
+    st = dict(_db_stats)
+    now = time.monotonic()
+    st["commits_last_min"] = sum(1 for ts in _db_commit_ts if now - ts <= 60)
+    return st
+
+
+# Background loops are described as periodic jobs so that both runtimes (threads / asyncio)
+# can drive the same tick functions. A tick returns the delay before its next run (None = interval).
+def periodic_job(
+    name: str,
+    interval_sec: int,
+    tick,
+    error_prefix: str,
+    state: dict | None = None,
+    error_delay_sec: int | None = None,
+    wait_async=None,
+):
+    # wait_async(state, delay) is awaited on the event loop after each tick under asyncio; it returns the delay to use.
+    return {
+        "name": name,
+        "interval": int(interval_sec),
+        "tick": tick,
+        "error_prefix": error_prefix,
+        "error_delay": int(interval_sec if error_delay_sec is None else error_delay_sec),
+        "state": state if state is not None else {},
+        "wait_async": wait_async,
+    }
+
+
+def state_db(state: dict):
+    # Under asyncio a job may hop between executor threads, so it always takes the current thread's connection.
+    return db_conn()
+
+
+def run_job_once(job: dict):
+    try:
+        with unit_of_work():
+            delay = job["tick"](job["state"])
+    except Exception as e:
+        print(f"{job['error_prefix']} {e}", file=sys.stderr, flush=True)
+        traceback.print_exc()
+        return job["error_delay"]
+    if delay is None:
+        return job["interval"]
+    return delay
+
+
+def run_job_forever(job: dict | None):
+    if job is None:
+        return
+    while True:
+        time.sleep(run_job_once(job))
+
+
 def init_db(conn: sqlite3.Connection):
     conn.execute(
         """
@@ -267,17 +728,33 @@ def init_db(conn: sqlite3.Connection):
             revoked INTEGER NOT NULL DEFAULT 0,
             pending INTEGER NOT NULL DEFAULT 0,
             last_path TEXT NOT NULL DEFAULT '',
+            action_token TEXT NOT NULL DEFAULT '',
+            title TEXT,
             UNIQUE(vpn_name, device_key)
         )
         """
     )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_device_summary (
+            vpn_name TEXT PRIMARY KEY,
+            active INTEGER NOT NULL DEFAULT 0,
+            pending INTEGER NOT NULL DEFAULT 0,
+            revoked INTEGER NOT NULL DEFAULT 0,
+            last_seen INTEGER NOT NULL DEFAULT 0,
+            online_seen INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS device_ingest_state (
             log_path TEXT PRIMARY KEY,
             inode INTEGER NOT NULL,
             offset INTEGER NOT NULL,
-            updated_at INTEGER NOT NULL
+            updated_at INTEGER NOT NULL,
+            head_len INTEGER NOT NULL DEFAULT 0,
+            head_sig TEXT NOT NULL DEFAULT ''
         )
         """
     )
@@ -290,7 +767,57 @@ def init_db(conn: sqlite3.Connection):
             node_host TEXT NOT NULL DEFAULT '',
             vpn_name TEXT NOT NULL,
             uplink_total INTEGER NOT NULL DEFAULT 0,
-            downlink_total INTEGER NOT NULL DEFAULT 0
+            downlink_total INTEGER NOT NULL DEFAULT 0,
+            uplink_delta INTEGER,
+            downlink_delta INTEGER
+        )
+        """
+    )
+    # Deltas of traffic_samples summed per series: hour buckets (UTC hours) and local-day buckets.
+    for table in ("traffic_hourly", "traffic_daily"):
+        conn.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                bucket_ts INTEGER NOT NULL,
+                node TEXT NOT NULL,
+                node_host TEXT NOT NULL DEFAULT '',
+                vpn_name TEXT NOT NULL,
+                uplink INTEGER NOT NULL DEFAULT 0,
+                downlink INTEGER NOT NULL DEFAULT 0,
+                last_ts INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (bucket_ts, node, node_host, vpn_name)
+            ) WITHOUT ROWID
+            """
+        )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            not_before REAL NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'pending',
+            last_error TEXT NOT NULL DEFAULT '',
+            created_at INTEGER NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS clients (
+            name TEXT PRIMARY KEY,
+            uuid TEXT,
+            token TEXT,
+            expire INTEGER,
+            revoked INTEGER,
+            trial INTEGER,
+            extra TEXT NOT NULL DEFAULT '',
+            pos INTEGER NOT NULL DEFAULT 0,
+            rev INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER NOT NULL DEFAULT 0
         )
         """
     )
@@ -321,11 +848,45 @@ def init_db(conn: sqlite3.Connection):
         conn.execute("ALTER TABLE user_devices ADD COLUMN lang TEXT NOT NULL DEFAULT ''")
     if "pending" not in cols:
         conn.execute("ALTER TABLE user_devices ADD COLUMN pending INTEGER NOT NULL DEFAULT 0")
+    if "action_token" not in cols:
+        conn.execute("ALTER TABLE user_devices ADD COLUMN action_token TEXT NOT NULL DEFAULT ''")
+    if "title" not in cols:
+        conn.execute("ALTER TABLE user_devices ADD COLUMN title TEXT")
+    # NULL title = written before titles were stored at ingest.
+    conn.execute(
+        "UPDATE user_devices SET title=device_title(platform, os_name, os_version, device_model, user_agent) WHERE title IS NULL"
+    )
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(device_ingest_state)").fetchall()]
+    if "head_len" not in cols:
+        conn.execute("ALTER TABLE device_ingest_state ADD COLUMN head_len INTEGER NOT NULL DEFAULT 0")
+    if "head_sig" not in cols:
+        conn.execute("ALTER TABLE device_ingest_state ADD COLUMN head_sig TEXT NOT NULL DEFAULT ''")
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(traffic_samples)").fetchall()]
+    if "uplink_delta" not in cols:
+        # NULL delta: first sample of a series, or written before deltas; rebuild_traffic_rollups() fills them.
+        conn.execute("ALTER TABLE traffic_samples ADD COLUMN uplink_delta INTEGER")
+        conn.execute("ALTER TABLE traffic_samples ADD COLUMN downlink_delta INTEGER")
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(user_device_summary)").fetchall()]
+    if "online_seen" not in cols:
+        conn.execute("ALTER TABLE user_device_summary ADD COLUMN online_seen INTEGER NOT NULL DEFAULT 0")
+        conn.execute("DELETE FROM user_device_summary")
     normalize_tg_alias_devices(conn)
+    if conn.execute("SELECT 1 FROM user_device_summary LIMIT 1").fetchone() is None:
+        refresh_device_summary(conn)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_device_summary_online ON user_device_summary(online_seen)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_device_summary_rank ON user_device_summary(active DESC, pending DESC, last_seen DESC)")
     conn.execute("CREATE INDEX IF NOT EXISTS idx_user_devices_vpn_last ON user_devices(vpn_name, last_seen DESC)")
+    fill_device_action_tokens(conn)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_devices_token ON user_devices(vpn_name, action_token)")
     conn.execute("CREATE INDEX IF NOT EXISTS idx_traffic_samples_time ON traffic_samples(collected_at)")
     conn.execute("CREATE INDEX IF NOT EXISTS idx_traffic_samples_user ON traffic_samples(vpn_name, collected_at)")
     conn.execute("CREATE INDEX IF NOT EXISTS idx_traffic_samples_node ON traffic_samples(node, collected_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox(status, priority, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_clients_token ON clients(token)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_clients_uuid ON clients(uuid)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_clients_expire ON clients(expire)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_clients_trial ON clients(trial, expire)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_clients_revoked ON clients(revoked)")
     conn.commit()
 
 
@@ -337,7 +898,7 @@ def get_kv(conn: sqlite3.Connection, key: str, default: str = ""):
     return str((row[0] or "").strip())
 
 
-def set_kv(conn: sqlite3.Connection, key: str, value: str):
+def put_kv(conn: sqlite3.Connection, key: str, value: str):
     now = int(time.time())
     conn.execute(
         """
@@ -347,21 +908,67 @@ def set_kv(conn: sqlite3.Connection, key: str, value: str):
         """,
         (((key or "").strip()), str(value or ""), now),
     )
-    conn.commit()
+
+
+def set_kv(conn: sqlite3.Connection, key: str, value: str):
+    put_kv(conn, key, value)
+    db_commit(conn)
+
+
+# tg_<id> -> vpn_name of every bot user, shared by all threads. Loaded from tg_users on first use and patched
+# by upsert_user() / delete_tg_users_by_vpn_name(); the dict is replaced, never mutated, so callers may keep it.
+# Edits to tg_users made outside the bot need a restart.
+class TgAliasMap:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.aliases = None
+        self.gen = 0
+
+    def get(self, conn: sqlite3.Connection):
+        with self.lock:
+            if self.aliases is not None:
+                return self.aliases
+            gen = self.gen
+        rows = conn.execute("SELECT tg_id, vpn_name FROM tg_users").fetchall()
+        aliases = {f"tg_{int(tg_id)}": (vpn_name or "").strip() for tg_id, vpn_name in rows if (vpn_name or "").strip()}
+        with self.lock:
+            # A write since the SELECT may be missing from it: use the rows once, load again next time.
+            if self.gen == gen:
+                self.aliases = aliases
+        return aliases
+
+    def set(self, tg_id: int, vpn_name: str):
+        with self.lock:
+            self.gen += 1
+            if self.aliases is not None:
+                aliases = dict(self.aliases)
+                if (vpn_name or "").strip():
+                    aliases[f"tg_{int(tg_id)}"] = vpn_name.strip()
+                else:
+                    aliases.pop(f"tg_{int(tg_id)}", None)
+                self.aliases = aliases
+
+    def drop(self, tg_ids):
+        with self.lock:
+            self.gen += 1
+            if self.aliases is not None:
+                aliases = dict(self.aliases)
+                for tg_id in tg_ids:
+                    aliases.pop(f"tg_{int(tg_id)}", None)
+                self.aliases = aliases
+
+
+tg_aliases = TgAliasMap()
 
 
 def canonical_vpn_name(conn: sqlite3.Connection, vpn_name: str):
     name = (vpn_name or "").strip()
-    m = re.fullmatch(r"tg_(\d+)", name)
-    if not m:
+    if not name.startswith("tg_"):
         return name
-    try:
-        tg_id = int(m.group(1))
-    except Exception:
-        return name
-    cur = conn.execute("SELECT vpn_name FROM tg_users WHERE tg_id=? LIMIT 1", (tg_id,))
-    row = cur.fetchone()
-    mapped = ((row or [""])[0] or "").strip()
+    mapped = tg_aliases.get(conn).get(name)
+    if mapped is None:
+        m = re.fullmatch(r"tg_(\d+)", name)
+        mapped = tg_aliases.get(conn).get(f"tg_{int(m.group(1))}") if m else None
     return mapped or name
 
 
@@ -375,7 +982,7 @@ def normalize_tg_alias_devices(conn: sqlite3.Connection):
         alias = f"tg_{int(tg_id)}"
         if alias == canonical:
             continue
-        conn.execute(
+        dup = conn.execute(
             """
             DELETE FROM user_devices
             WHERE vpn_name=? AND device_key IN (
@@ -384,28 +991,228 @@ def normalize_tg_alias_devices(conn: sqlite3.Connection):
             """,
             (alias, canonical),
         )
-        cur = conn.execute("UPDATE user_devices SET vpn_name=? WHERE vpn_name=?", (canonical, alias))
+        dropped = int(dup.rowcount or 0)
+        cur = conn.execute("UPDATE user_devices SET vpn_name=?, action_token='' WHERE vpn_name=?", (canonical, alias))
         moved += int(cur.rowcount or 0)
+        device_cache.drop([alias, canonical])
+        if dropped or cur.rowcount:
+            conn.execute("DELETE FROM user_device_summary WHERE vpn_name=?", (alias,))
+            refresh_device_summary(conn, [canonical])
     if moved > 0:
+        fill_device_action_tokens(conn)
         print(f"[devices-normalize] moved={moved}", file=sys.stderr, flush=True)
 
 
-def count_active_devices(conn: sqlite3.Connection, vpn_name: str):
-    cur = conn.execute(
-        "SELECT COUNT(*) FROM user_devices WHERE vpn_name=? AND revoked=0 AND pending=0",
-        (vpn_name,),
+def fill_device_action_tokens(conn: sqlite3.Connection):
+    # Rows written before action_token existed (or moved to another vpn_name) get it computed here.
+    rows = conn.execute("SELECT id, vpn_name, device_key FROM user_devices WHERE action_token=''").fetchall()
+    if not rows:
+        return
+    conn.executemany(
+        "UPDATE user_devices SET action_token=? WHERE id=?",
+        [(device_action_token(vpn_name, dkey or ""), rid) for rid, vpn_name, dkey in rows],
     )
-    row = cur.fetchone()
-    return int((row or [0])[0] or 0)
+    print(f"[devices-migrate] action tokens filled={len(rows)}", file=sys.stderr, flush=True)
+
+
+# revoked/pending of every device of a user, with active/pending counts, loaded from user_devices on first use.
+# Writers of revoked/pending update it inside the same db_write() (with a rollback hook), so the soft-limit
+# decision on ingest is a dict lookup. Entries expire after DEVICE_CACHE_TTL_SEC to pick up writes from
+# other processes (backfill-devices, manual sqlite edits).
+class DeviceStateCache:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.users = {}
+        self.stats = {"loads": 0, "lookups": 0}
+
+    def load(self, conn: sqlite3.Connection, names):
+        # -> {vpn_name: entry}; entry = {"devices": {device_key: (revoked, pending)}, "active": n, "pending": n, "revoked": n}
+        now = time.monotonic()
+        out = {}
+        with self.lock:
+            missing = []
+            for name in names:
+                e = self.users.get(name)
+                if e is not None and now - e["loaded"] < DEVICE_CACHE_TTL_SEC:
+                    out[name] = e
+                else:
+                    missing.append(name)
+            self.stats["lookups"] += len(out)
+            for i in range(0, len(missing), 500):
+                part = missing[i : i + 500]
+                fresh = {name: {"devices": {}, "active": 0, "pending": 0, "revoked": 0, "loaded": now} for name in part}
+                marks = ",".join("?" * len(part))
+                for vpn_name, dkey, revoked, pending in conn.execute(
+                    f"SELECT vpn_name, device_key, revoked, pending FROM user_devices WHERE vpn_name IN ({marks})", part
+                ):
+                    self.put_entry(fresh[vpn_name], dkey, int(revoked or 0), int(pending or 0))
+                self.users.update(fresh)
+                out.update(fresh)
+                self.stats["loads"] += len(part)
+        return out
 
+    def get(self, conn: sqlite3.Connection, vpn_name: str):
+        return self.load(conn, [vpn_name])[vpn_name]
+
+    @staticmethod
+    def put_entry(e: dict, dkey: str, revoked: int, pending: int):
+        # Update one device of an entry returned by load()/get() and its counters; caller holds self.lock.
+        old = e["devices"].get(dkey)
+        if old is not None:
+            e["revoked" if old[0] else "pending" if old[1] else "active"] -= 1
+        e["devices"][dkey] = (revoked, pending)
+        e["revoked" if revoked else "pending" if pending else "active"] += 1
+
+    def set_state(self, conn: sqlite3.Connection, vpn_name: str, dkey: str, revoked: int, pending: int):
+        # Caller holds db_write().
+        with self.lock:
+            self.put_entry(self.get(conn, vpn_name), dkey, int(revoked), int(pending))
+        db_on_rollback(lambda: self.drop([vpn_name]))
+
+    def drop(self, names=None):
+        with self.lock:
+            if names is None:
+                self.users.clear()
+            else:
+                for name in names:
+                    self.users.pop(name, None)
 
-def user_last_seen_ts(conn: sqlite3.Connection, vpn_name: str):
-    cur = conn.execute(
-        "SELECT MAX(last_seen) FROM user_devices WHERE vpn_name=? AND revoked=0",
-        (vpn_name,),
+
+device_cache = DeviceStateCache()
+
+
+def refresh_device_summary(conn: sqlite3.Connection, names=None):
+    # Recount user_device_summary from user_devices: all users (migration, backfill) or the given ones.
+    where = ""
+    args = []
+    if names is not None:
+        names = list(names)
+        if not names:
+            return
+        where = f"WHERE vpn_name IN ({','.join('?' * len(names))})"
+        args = names
+        conn.execute(f"DELETE FROM user_device_summary {where}", args)
+    else:
+        conn.execute("DELETE FROM user_device_summary")
+    conn.execute(
+        f"""
+        INSERT INTO user_device_summary (vpn_name, active, pending, revoked, last_seen, online_seen)
+        SELECT
+          vpn_name,
+          SUM(CASE WHEN revoked=0 AND pending=0 THEN 1 ELSE 0 END),
+          SUM(CASE WHEN revoked=0 AND pending=1 THEN 1 ELSE 0 END),
+          SUM(CASE WHEN revoked=1 THEN 1 ELSE 0 END),
+          MAX(last_seen),
+          COALESCE(MAX(CASE WHEN revoked=0 THEN last_seen END), 0)
+        FROM user_devices
+        {where}
+        GROUP BY vpn_name
+        """,
+        args,
     )
-    row = cur.fetchone()
-    return int((row or [0])[0] or 0)
+    presence.reset()
+
+
+def _store_device_summary(conn: sqlite3.Connection, entries: dict, seen: dict | None = None):
+    # Caller holds db_write(); counts come from device_cache entries.
+    # With `seen` (ingest) last_seen/online_seen only move forward; without it (revoke) online_seen
+    # is recounted from the user's remaining devices.
+    if seen is None:
+        online = {}
+        for name in entries:
+            row = conn.execute("SELECT MAX(last_seen) FROM user_devices WHERE vpn_name=? AND revoked=0", (name,)).fetchone()
+            online[name] = int((row or [0])[0] or 0)
+        conn.executemany(
+            """
+            INSERT INTO user_device_summary (vpn_name, active, pending, revoked, last_seen, online_seen)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(vpn_name) DO UPDATE SET
+                active=excluded.active, pending=excluded.pending, revoked=excluded.revoked, online_seen=excluded.online_seen
+            """,
+            [(name, int(e["active"]), int(e["pending"]), int(e["revoked"]), online[name], online[name]) for name, e in entries.items()],
+        )
+    else:
+        conn.executemany(
+            """
+            INSERT INTO user_device_summary (vpn_name, active, pending, revoked, last_seen, online_seen)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(vpn_name) DO UPDATE SET
+                active=excluded.active, pending=excluded.pending, revoked=excluded.revoked,
+                last_seen=MAX(user_device_summary.last_seen, excluded.last_seen),
+                online_seen=MAX(user_device_summary.online_seen, excluded.online_seen)
+            """,
+            [(name, int(e["active"]), int(e["pending"]), int(e["revoked"]), int(seen.get(name, 0)), int(seen.get(name, 0))) for name, e in entries.items()],
+        )
+        online = {}
+        for name in entries:
+            if seen.get(name, 0) > presence.seen.get(name, 0):
+                online[name] = int(seen[name])
+    for name, ts in online.items():
+        presence.set(name, ts)
+    db_on_rollback(presence.reset)
+
+
+def count_active_devices(conn: sqlite3.Connection, vpn_name: str):
+    return int(device_cache.get(conn, vpn_name)["active"])
+
+
+# Last time each user was seen on a non-revoked device, sorted by time. Mirrors user_device_summary.online_seen:
+# updated by the same writers inside their db_write(), reset by a rollback and reloaded after DEVICE_CACHE_TTL_SEC.
+class PresenceIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = 0.0
+        self.seen = {}
+        self.by_time = []
+
+    def _ensure(self, conn: sqlite3.Connection):
+        # Caller holds self.lock.
+        now = time.monotonic()
+        if self.loaded and now - self.loaded < DEVICE_CACHE_TTL_SEC:
+            return
+        rows = conn.execute("SELECT vpn_name, online_seen FROM user_device_summary WHERE online_seen > 0").fetchall()
+        self.seen = {name: int(ts) for name, ts in rows}
+        self.by_time = sorted((ts, name) for name, ts in self.seen.items())
+        self.loaded = now
+
+    def set(self, name: str, ts: int):
+        with self.lock:
+            if not self.loaded:
+                return
+            old = self.seen.get(name)
+            if old == ts:
+                return
+            if old is not None:
+                i = bisect.bisect_left(self.by_time, (old, name))
+                del self.by_time[i]
+            if ts > 0:
+                self.seen[name] = ts
+                bisect.insort(self.by_time, (ts, name))
+            else:
+                self.seen.pop(name, None)
+
+    def reset(self):
+        with self.lock:
+            self.loaded = 0.0
+            self.seen = {}
+            self.by_time = []
+
+    def last_seen(self, conn: sqlite3.Connection, name: str):
+        with self.lock:
+            self._ensure(conn)
+            return self.seen.get(name, 0)
+
+    def count_since(self, conn: sqlite3.Connection, threshold: int):
+        with self.lock:
+            self._ensure(conn)
+            return len(self.by_time) - bisect.bisect_left(self.by_time, (threshold,))
+
+
+presence = PresenceIndex()
+
+
+def user_last_seen_ts(conn: sqlite3.Connection, vpn_name: str):
+    return int(presence.last_seen(conn, vpn_name))
 
 
 def is_user_online(last_seen_ts: int):
@@ -420,24 +1227,9 @@ def online_label(last_seen_ts: int):
     return "⚪ офлайн"
 
 
-def online_users_count(conn: sqlite3.Connection):
-    now = int(time.time())
-    threshold = now - ONLINE_WINDOW_SEC
-    cur = conn.execute(
-        """
-        SELECT COUNT(*)
-        FROM (
-          SELECT vpn_name, MAX(last_seen) AS mx
-          FROM user_devices
-          WHERE revoked=0
-          GROUP BY vpn_name
-        ) t
-        WHERE mx >= ?
-        """,
-        (threshold,),
-    )
-    row = cur.fetchone()
-    return int((row or [0])[0] or 0)
+def online_users_count(conn: sqlite3.Connection, window_sec: int | None = None):
+    window = ONLINE_WINDOW_SEC if window_sec is None else int(window_sec)
+    return int(presence.count_since(conn, int(time.time()) - window))
 
 
 def _extract_json_obj(raw: str):
@@ -474,18 +1266,21 @@ def _parse_user_traffic_stats(raw: str):
     return stats
 
 
-def _statsquery_local():
+def _statsquery_local_args():
     # master can run xray in docker; query via host namespace if available.
     cmd = (
         "nsenter -t 1 -m -u -i -n -p sh -lc "
         + shlex.quote("docker exec hexenvpn-xray /usr/local/bin/xray api statsquery --server=127.0.0.1:10085")
     )
-    rc, out = run_cmd(["sh", "-lc", cmd], timeout_sec=LIVE_ONLINE_TIMEOUT_SEC)
-    return rc, out
+    return ["sh", "-lc", cmd]
 
 
-def _statsquery_remote(host: str):
-    args = [
+def _statsquery_local(timeout_sec: int = LIVE_ONLINE_TIMEOUT_SEC):
+    return run_cmd(_statsquery_local_args(), timeout_sec=timeout_sec)
+
+
+def _statsquery_remote_args(host: str):
+    return [
         "ssh",
         "-i",
         SSH_KEY,
@@ -498,36 +1293,335 @@ def _statsquery_remote(host: str):
         f"root@{host}",
         "/usr/local/bin/xray api statsquery --server=127.0.0.1:10085",
     ]
-    return run_cmd(args, timeout_sec=LIVE_ONLINE_TIMEOUT_SEC)
+
+
+def _statsquery_remote(host: str, timeout_sec: int = LIVE_ONLINE_TIMEOUT_SEC):
+    return run_cmd(_statsquery_remote_args(host), timeout_sec=timeout_sec)
+
+
+def traffic_nodes():
+    # [(kind, host)] polled by the traffic collector; master is always first.
+    nodes = [("master", "")]
+    if UK_HOST:
+        nodes.append(("uk", UK_HOST))
+    if TR_HOST:
+        nodes.append(("tr", TR_HOST))
+    for item in TRAFFIC_EXTRA_NODES.split(","):
+        kind, _sep, host = item.strip().partition(":")
+        if kind.strip() and host.strip() and (kind.strip(), host.strip()) not in nodes:
+            nodes.append((kind.strip(), host.strip()))
+    return nodes
+
+
+_TRAFFIC_POLL_BUCKETS_MS = (250, 500, 1000, 2000, 5000, 10000)
+_traffic_poll = {}
+_traffic_poll_lock = threading.Lock()
+
+
+def _note_traffic_poll(label: str, ms: int, rc: int):
+    with _traffic_poll_lock:
+        st = _traffic_poll.setdefault(
+            label,
+            {"polls": 0, "errors": 0, "timeouts": 0, "last_ms": 0, "max_ms": 0, "hist": [0] * (len(_TRAFFIC_POLL_BUCKETS_MS) + 1)},
+        )
+        st["polls"] += 1
+        st["errors"] += int(rc != 0)
+        st["timeouts"] += int(rc == 124)
+        st["last_ms"] = ms
+        st["max_ms"] = max(st["max_ms"], ms)
+        st["hist"][bisect.bisect_left(_TRAFFIC_POLL_BUCKETS_MS, ms)] += 1
+
+
+def traffic_poll_lines():
+    with _traffic_poll_lock:
+        items = sorted((label, dict(st, hist=list(st["hist"]))) for label, st in _traffic_poll.items())
+    lines = []
+    for label, st in items:
+        hist = ", ".join(
+            [f"≤{b / 1000:g}с {n}" for b, n in zip(_TRAFFIC_POLL_BUCKETS_MS, st["hist"])]
+            + [f">{_TRAFFIC_POLL_BUCKETS_MS[-1] / 1000:g}с {st['hist'][-1]}"]
+        )
+        lines.append(
+            f"Сбор трафика {label}: опросов {st['polls']}, ошибок {st['errors']} (таймаутов {st['timeouts']}), "
+            f"посл {st['last_ms']} мс, макс {st['max_ms']} мс | {hist}"
+        )
+    return lines
 
 
 def _collect_traffic_node(kind: str, host: str):
+    started = time.monotonic()
     if kind == "master":
-        rc, out = _statsquery_local()
-        node = "master"
-        node_host = ""
+        rc, out = _statsquery_local(TRAFFIC_NODE_TIMEOUT_SEC)
     else:
-        rc, out = _statsquery_remote(host)
-        node = kind
-        node_host = host
+        rc, out = _statsquery_remote(host, TRAFFIC_NODE_TIMEOUT_SEC)
+    return _traffic_node_result(kind, host, rc, out, started)
+
+
+async def _collect_traffic_node_async(kind: str, host: str):
+    started = time.monotonic()
+    args = _statsquery_local_args() if kind == "master" else _statsquery_remote_args(host)
+    try:
+        rc, out = await asyncio.wait_for(run_cmd_async(args, TRAFFIC_NODE_TIMEOUT_SEC), TRAFFIC_NODE_TIMEOUT_SEC + 5)
+    except asyncio.TimeoutError:
+        rc, out = 124, "deadline"
+    return _traffic_node_result(kind, host, rc, out, started)
+
+
+def _traffic_node_result(kind: str, host: str, rc: int, out: str, started: float):
+    node = kind
+    node_host = "" if kind == "master" else host
+    # Counters are as of the moment the node answered, not when the tick started.
+    collected_at = int(time.time())
+    _note_traffic_poll(_traffic_node_label(node, node_host), int((time.monotonic() - started) * 1000), rc)
     if rc != 0:
-        return {"ok": False, "node": node, "node_host": node_host, "error": (out or f"rc={rc}")[:180], "stats": {}}
+        return {"ok": False, "node": node, "node_host": node_host, "error": (out or f"rc={rc}")[:180], "stats": {}, "collected_at": collected_at}
     stats = _parse_user_traffic_stats(out)
-    return {"ok": True, "node": node, "node_host": node_host, "error": "", "stats": stats}
+    return {"ok": True, "node": node, "node_host": node_host, "error": "", "stats": stats, "collected_at": collected_at}
+
+
+async def _collect_traffic_nodes_async(nodes: list):
+    return await asyncio.gather(*(_collect_traffic_node_async(kind, host) for kind, host in nodes), return_exceptions=True)
+
+
+def _traffic_node_failed(kind: str, host: str, err: str):
+    return {"ok": False, "node": kind, "node_host": "" if kind == "master" else host, "error": err[:180], "stats": {}}
+
+
+def _collect_traffic_nodes():
+    # Polls every node at once; a slow node costs the tick TRAFFIC_NODE_TIMEOUT_SEC at most.
+    nodes = traffic_nodes()
+    if async_bridge_active():
+        # Under asyncio the subprocesses are awaited on the loop; no threads just to wait on them.
+        db_commit_pending()
+        gathered = asyncio.run_coroutine_threadsafe(_collect_traffic_nodes_async(nodes), _async_rt["loop"]).result()
+        return [
+            _traffic_node_failed(kind, host, str(res)) if isinstance(res, BaseException) else res
+            for (kind, host), res in zip(nodes, gathered)
+        ]
+    pool = ThreadPoolExecutor(max_workers=len(nodes), thread_name_prefix="traffic-poll")
+    try:
+        futures = [(kind, host, pool.submit(_collect_traffic_node, kind, host)) for kind, host in nodes]
+        done, _pending = wait_futures([fut for _kind, _host, fut in futures], timeout=TRAFFIC_NODE_TIMEOUT_SEC + 5)
+        results = []
+        for kind, host, fut in futures:
+            if fut in done and fut.exception() is None:
+                results.append(fut.result())
+                continue
+            results.append(_traffic_node_failed(kind, host, str(fut.exception()) if fut in done else "deadline"))
+        return results
+    finally:
+        pool.shutdown(wait=False)
+
+
+_traffic_last = {"loaded": False, "series": {}}
+
+
+def _traffic_delta(prev_total: int, cur_total: int):
+    d = cur_total - prev_total
+    # Counter reset: treat current value as delta since reset.
+    if d < 0:
+        d = cur_total
+    return max(0, d)
+
+
+def _local_day_start(ts: int):
+    # Naive local time: timestamp() resolves the offset of midnight itself, not of ts (DST days).
+    t = datetime.fromtimestamp(int(ts))
+    return int(t.replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+
+
+_TRAFFIC_ROLLUP_SQL = """
+    INSERT INTO {table} (bucket_ts, node, node_host, vpn_name, uplink, downlink, last_ts)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(bucket_ts, node, node_host, vpn_name) DO UPDATE SET
+        uplink={table}.uplink + excluded.uplink,
+        downlink={table}.downlink + excluded.downlink,
+        last_ts=MAX({table}.last_ts, excluded.last_ts)
+"""
+
+
+def _add_traffic_rollups(conn: sqlite3.Connection, deltas: list):
+    # deltas: [(collected_at, node, node_host, vpn_name, du, dd)]
+    hourly = {}
+    daily = {}
+    days = {}
+    for ts, node, node_host, name, du, dd in deltas:
+        day = days.get(ts)
+        if day is None:
+            day = days[ts] = _local_day_start(ts)
+        for buckets, b in ((hourly, ts - ts % 3600), (daily, day)):
+            rec = buckets.get((b, node, node_host, name))
+            if rec is None:
+                buckets[(b, node, node_host, name)] = [du, dd, ts]
+            else:
+                rec[0] += du
+                rec[1] += dd
+                rec[2] = max(rec[2], ts)
+    for table, buckets in (("traffic_hourly", hourly), ("traffic_daily", daily)):
+        if buckets:
+            conn.executemany(_TRAFFIC_ROLLUP_SQL.format(table=table), [k + tuple(v) for k, v in buckets.items()])
+
+
+def _traffic_series_last(conn: sqlite3.Connection):
+    # Last cumulative totals per (node, node_host, vpn_name); loaded once, then kept by the collector.
+    if not _traffic_last["loaded"]:
+        rows = conn.execute(
+            """
+            SELECT node, node_host, vpn_name, uplink_total, downlink_total, MAX(id)
+            FROM traffic_samples
+            GROUP BY node, node_host, vpn_name
+            """
+        ).fetchall()
+        _traffic_last["series"] = {(r[0], r[1], r[2]): (int(r[3] or 0), int(r[4] or 0)) for r in rows}
+        _traffic_last["loaded"] = True
+    return _traffic_last["series"]
+
+
+_TRAFFIC_REBUILD_CHUNK = 250000
+
+
+def rebuild_traffic_rollups(conn: sqlite3.Connection):
+    # One-off: compute deltas for samples stored before they were kept, and rebuild both rollups.
+    # Scans id ranges sequentially (samples are appended in collection order, the order the
+    # collector diffs them in); each chunk is written in its own transaction.
+    started = time.monotonic()
+    with db_write(conn):
+        conn.execute("DELETE FROM traffic_hourly")
+        conn.execute("DELETE FROM traffic_daily")
+    max_id = conn.execute("SELECT MAX(id) FROM traffic_samples").fetchone()[0] or 0
+    last = {}
+    n_samples = 0
+    for lo in range(0, max_id, _TRAFFIC_REBUILD_CHUNK):
+        updates = []
+        deltas = []
+        for rid, ts, node, node_host, name, up, down in conn.execute(
+            """
+            SELECT id, collected_at, node, node_host, vpn_name, uplink_total, downlink_total
+            FROM traffic_samples WHERE id > ? AND id <= ? ORDER BY id
+            """,
+            (lo, lo + _TRAFFIC_REBUILD_CHUNK),
+        ):
+            key = (node, node_host, name)
+            prev = last.get(key)
+            last[key] = (up, down)
+            if prev is None:
+                updates.append((None, None, rid))
+                continue
+            du = _traffic_delta(prev[0], up)
+            dd = _traffic_delta(prev[1], down)
+            updates.append((du, dd, rid))
+            deltas.append((ts, node, node_host, name, du, dd))
+        with db_write(conn):
+            conn.executemany("UPDATE traffic_samples SET uplink_delta=?, downlink_delta=? WHERE id=?", updates)
+            _add_traffic_rollups(conn, deltas)
+        n_samples += len(updates)
+    with db_write(conn):
+        put_kv(conn, "traffic_rollups", "1")
+    _traffic_last["loaded"] = False
+    with _traffic_windows_lock:
+        _traffic_windows["anchor"] = None
+        _traffic_windows["results"] = {}
+    print(
+        f"[traffic-rollup] rebuilt series={len(last)} samples={n_samples} sec={time.monotonic() - started:.1f}",
+        file=sys.stderr,
+        flush=True,
+    )
+
+
+def bench_traffic_rollup(n_users: int = 5000, n_days: int = 14):
+    # Synthetic traffic_samples: one sample per user every TRAFFIC_COLLECT_INTERVAL_SEC, every 10th
+    # user behind a tg_<id> alias, occasional counter resets. Compares the per-sample pass over the
+    # whole window (diff + canonical name + group by user/node for every row) with reading the same
+    # window from the rollups, and times the one-off rebuild that fills them.
+    import random
+    import tempfile
+
+    rnd = random.Random(23)
+    step = max(60, TRAFFIC_COLLECT_INTERVAL_SEC)
+    t0 = int(time.time()) - n_days * 86400
+    users = [f"tg_{100000 + u}" if u % 10 == 0 else f"user{u}" for u in range(n_users)]
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "bench.db"), isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.create_function("device_title", 5, human_device_title, deterministic=True)
+        init_db(conn)
+        started = time.monotonic()
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO tg_users (tg_id, vpn_name, created_at) VALUES (?, ?, ?)",
+            [(100000 + u, f"user{u}", t0) for u in range(0, n_users, 10)],
+        )
+        totals = [(0, 0)] * n_users
+        for ts in range(t0, t0 + n_days * 86400, step):
+            batch = []
+            for u, name in enumerate(users):
+                up, down = totals[u]
+                if rnd.random() < 0.0005:
+                    up, down = 0, 0
+                up += rnd.randrange(1 << 16)
+                down += rnd.randrange(1 << 20)
+                totals[u] = (up, down)
+                batch.append((ts, "master", "", name, up, down))
+            conn.executemany(
+                "INSERT INTO traffic_samples (collected_at, node, node_host, vpn_name, uplink_total, downlink_total) VALUES (?, ?, ?, ?, ?, ?)",
+                batch,
+            )
+        conn.execute("COMMIT")
+        n_rows = conn.execute("SELECT COUNT(*) FROM traffic_samples").fetchone()[0]
+        print(f"users={n_users} days={n_days} samples={n_rows} generated in {time.monotonic() - started:.1f}s")
+
+        started = time.monotonic()
+        prev = {}
+        by_user = {}
+        by_node = {}
+        for node, node_host, raw_name, up, down in conn.execute(
+            "SELECT node, node_host, vpn_name, uplink_total, downlink_total FROM traffic_samples WHERE collected_at >= ? ORDER BY collected_at ASC, id ASC",
+            (t0,),
+        ):
+            key = (node, node_host, raw_name)
+            p = prev.get(key)
+            prev[key] = (up, down)
+            if p is None:
+                continue
+            name = canonical_vpn_name(conn, raw_name)
+            du = _traffic_delta(p[0], up)
+            dd = _traffic_delta(p[1], down)
+            rec = by_user.setdefault(name, [0, 0])
+            rec[0] += du
+            rec[1] += dd
+            rec = by_node.setdefault(_traffic_node_label(node, node_host), [0, 0])
+            rec[0] += du
+            rec[1] += dd
+        t_rows = time.monotonic() - started
+
+        started = time.monotonic()
+        rebuild_traffic_rollups(conn)
+        t_rebuild = time.monotonic() - started
+
+        started = time.monotonic()
+        series = traffic_windows(conn, {"w": (t0, traffic_anchor_ts(conn))})["w"]
+        users_agg = _traffic_by_user(conn, series)
+        nodes_agg = _traffic_by_node(conn, series)
+        t_read = time.monotonic() - started
+        conn.close()
+    same = {k: [v["uplink"], v["downlink"]] for k, v in users_agg.items()} == by_user and {
+        r["node"]: [r["uplink"], r["downlink"]] for r in nodes_agg
+    } == by_node
+    print(f"same={same}")
+    print(f"per-sample {t_rows:.2f}s {int(n_rows / max(t_rows, 1e-9))} samples/s")
+    print(f"rollups    {t_read:.3f}s  x{t_rows / max(t_read, 1e-9):.0f}")
+    print(f"rebuild    {t_rebuild:.2f}s once, {int(n_rows / max(t_rebuild, 1e-9))} samples/s")
 
 
 def collect_traffic_snapshot(conn: sqlite3.Connection):
-    now = int(time.time())
     entries = []
-    results = []
-
-    # Always try master.
-    results.append(_collect_traffic_node("master", ""))
-    if UK_HOST:
-        results.append(_collect_traffic_node("uk", UK_HOST))
-    if TR_HOST:
-        results.append(_collect_traffic_node("tr", TR_HOST))
+    results = _collect_traffic_nodes()
+    now = int(time.time())
 
+    last = _traffic_series_last(conn)
+    latest = {}
+    deltas = []
     for rec in results:
         if not rec.get("ok"):
             print(
@@ -538,6 +1632,7 @@ def collect_traffic_snapshot(conn: sqlite3.Connection):
             continue
         node = rec.get("node") or ""
         node_host = rec.get("node_host") or ""
+        ts = int(rec.get("collected_at") or now)
         stats = rec.get("stats") or {}
         for vpn_name, tr in stats.items():
             name = (vpn_name or "").strip()
@@ -545,43 +1640,57 @@ def collect_traffic_snapshot(conn: sqlite3.Connection):
                 continue
             uplink = int((tr or {}).get("uplink") or 0)
             downlink = int((tr or {}).get("downlink") or 0)
-            entries.append((now, node, node_host, name, uplink, downlink))
+            key = (node, node_host, name)
+            prev = last.get(key)
+            du = dd = None
+            if prev is not None:
+                du = _traffic_delta(prev[0], uplink)
+                dd = _traffic_delta(prev[1], downlink)
+                deltas.append((ts, node, node_host, name, du, dd))
+            latest[key] = (uplink, downlink)
+            entries.append((ts, node, node_host, name, uplink, downlink, du, dd))
+
+    with db_write(conn):
+        if entries:
+            conn.executemany(
+                """
+                INSERT INTO traffic_samples (collected_at, node, node_host, vpn_name, uplink_total, downlink_total, uplink_delta, downlink_delta)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                entries,
+            )
+            _add_traffic_rollups(conn, deltas)
+
+        # Retention
+        keep_from = now - max(1, TRAFFIC_RETENTION_DAYS) * 86400
+        conn.execute("DELETE FROM traffic_samples WHERE collected_at < ?", (keep_from,))
+        conn.execute("DELETE FROM traffic_hourly WHERE bucket_ts < ?", (keep_from - keep_from % 3600,))
+        conn.execute("DELETE FROM traffic_daily WHERE bucket_ts < ?", (now - max(1, TRAFFIC_DAILY_RETENTION_DAYS) * 86400,))
+    last.update(latest)
+    return len(entries)
 
-    if entries:
-        conn.executemany(
-            """
-            INSERT INTO traffic_samples (collected_at, node, node_host, vpn_name, uplink_total, downlink_total)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            entries,
-        )
 
-    # Retention
-    keep_from = now - max(1, TRAFFIC_RETENTION_DAYS) * 86400
-    conn.execute("DELETE FROM traffic_samples WHERE collected_at < ?", (keep_from,))
-    conn.commit()
-    return len(entries)
+def traffic_collect_tick(state: dict):
+    if get_kv(state_db(state), "traffic_rollups", "") != "1":
+        rebuild_traffic_rollups(state_db(state))
+    n = collect_traffic_snapshot(state_db(state))
+    print(f"[traffic-collect] samples={n}", file=sys.stderr, flush=True)
 
 
-def traffic_collect_loop():
+def traffic_collect_job():
     if not TRAFFIC_COLLECT_ENABLED:
         print("[traffic-collect] disabled", file=sys.stderr, flush=True)
-        return
-    conn = sqlite3.connect(DB_PATH)
-    init_db(conn)
+        return None
     print(
         f"[traffic-collect] enabled interval={TRAFFIC_COLLECT_INTERVAL_SEC}s retention={TRAFFIC_RETENTION_DAYS}d",
         file=sys.stderr,
         flush=True,
     )
-    while True:
-        try:
-            n = collect_traffic_snapshot(conn)
-            print(f"[traffic-collect] samples={n}", file=sys.stderr, flush=True)
-        except Exception as e:
-            print(f"[traffic-collect-loop-error] {e}", file=sys.stderr, flush=True)
-            traceback.print_exc()
-        time.sleep(max(60, TRAFFIC_COLLECT_INTERVAL_SEC))
+    return periodic_job("traffic-collect", max(60, TRAFFIC_COLLECT_INTERVAL_SEC), traffic_collect_tick, "[traffic-collect-loop-error]")
+
+
+def traffic_collect_loop():
+    run_job_forever(traffic_collect_job())
 
 
 def _collect_live_users_for_node(kind: str, host: str):
@@ -645,8 +1754,10 @@ def get_live_online_snapshot(force: bool = False):
 
 
 def promote_pending_devices(conn: sqlite3.Connection, vpn_name: str):
-    slots = DEVICE_SOFT_LIMIT - count_active_devices(conn, vpn_name)
-    if slots <= 0:
+    # Caller holds db_write().
+    e = device_cache.get(conn, vpn_name)
+    slots = DEVICE_SOFT_LIMIT - int(e["active"])
+    if slots <= 0 or e["pending"] <= 0:
         return 0
     cur = conn.execute(
         """
@@ -665,6 +1776,8 @@ def promote_pending_devices(conn: sqlite3.Connection, vpn_name: str):
         "UPDATE user_devices SET pending=0 WHERE vpn_name=? AND device_key=?",
         [(vpn_name, k) for k in keys],
     )
+    for k in keys:
+        device_cache.set_state(conn, vpn_name, k, 0, 0)
     return len(keys)
 
 
@@ -685,12 +1798,7 @@ def _resolve_vpn_name_by_sub_key(sub_key: str):
     key = (sub_key or "").strip()
     if not key:
         return ""
-    for c in load_clients():
-        name = (c.get("name") or "").strip()
-        token = (c.get("token") or "").strip()
-        if key == name or key == token:
-            return name
-    return ""
+    return clients_registry.resolve_name(key)
 
 
 def _norm_field(raw: str):
@@ -743,152 +1851,802 @@ def _device_key(
     return "fp:" + digest
 
 
-def ingest_device_log(conn: sqlite3.Connection):
-    p = Path(DEVICE_LOG_PATH)
-    if not p.exists():
-        return 0
+_DEVICE_UPSERT_SQL = """
+    INSERT INTO user_devices (vpn_name, device_key, hwid, user_agent, ip, platform, os_name, os_version, device_model, app_version, lang, first_seen, last_seen, hits, revoked, pending, last_path, action_token, title)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?, ?)
+    ON CONFLICT(vpn_name, device_key) DO UPDATE SET
+        title=device_title(
+            CASE WHEN excluded.platform != '' THEN excluded.platform ELSE user_devices.platform END,
+            CASE WHEN excluded.os_name != '' THEN excluded.os_name ELSE user_devices.os_name END,
+            CASE WHEN excluded.os_version != '' THEN excluded.os_version ELSE user_devices.os_version END,
+            CASE WHEN excluded.device_model != '' THEN excluded.device_model ELSE user_devices.device_model END,
+            excluded.user_agent
+        ),
+        hwid=CASE WHEN excluded.hwid != '' THEN excluded.hwid ELSE user_devices.hwid END,
+        user_agent=excluded.user_agent,
+        ip=excluded.ip,
+        platform=CASE WHEN excluded.platform != '' THEN excluded.platform ELSE user_devices.platform END,
+        os_name=CASE WHEN excluded.os_name != '' THEN excluded.os_name ELSE user_devices.os_name END,
+        os_version=CASE WHEN excluded.os_version != '' THEN excluded.os_version ELSE user_devices.os_version END,
+        device_model=CASE WHEN excluded.device_model != '' THEN excluded.device_model ELSE user_devices.device_model END,
+        app_version=CASE WHEN excluded.app_version != '' THEN excluded.app_version ELSE user_devices.app_version END,
+        lang=CASE WHEN excluded.lang != '' THEN excluded.lang ELSE user_devices.lang END,
+        last_seen=excluded.last_seen,
+        hits=user_devices.hits + excluded.hits,
+        revoked=0,
+        pending=excluded.pending,
+        last_path=excluded.last_path
+"""
+# Fields where an empty value keeps the previous one (mirrors the CASE branches above).
+_DEVICE_STICKY_FIELDS = (2, 5, 6, 7, 8, 9, 10)
+_ingest_stats = {"runs": 0, "lines": 0, "parsed": 0, "bytes": 0, "sec_total": 0.0, "last_lines_per_sec": 0}
+
+
+def ingest_stats():
+    return dict(_ingest_stats)
+
+
+def _parse_device_line(line: str, now: int):
+    parts = line.split("\t")
+    if len(parts) < 9:
+        return None
+    f = [_norm_field(x) for x in parts[:19]]
+    if len(f) < 19:
+        f.extend([""] * (19 - len(f)))
+    sub_key = _sub_key_from_uri(f[2])
+    if not sub_key:
+        return None
     try:
-        st = p.stat()
+        ts = int(float(f[0]))
     except Exception:
-        return 0
+        ts = now
+    ua = f[3] or f[17]
+    platform = f[10] or f[18]
+    device_model = f[13] or f[9]
+    app_version = f[14] or f[15]
+    hwid = f[4] or f[5] or f[6] or f[7] or f[8]
+    # (ts, sub_key, hwid, ua, ip, platform, os_name, os_version, device_model, app_version, lang, uri)
+    return (ts, sub_key, hwid, ua, f[1], platform, f[11], f[12], device_model, app_version, f[16], f[2])
 
-    cur = conn.execute("SELECT inode, offset FROM device_ingest_state WHERE log_path=?", (str(p),))
-    row = cur.fetchone()
-    inode = int(st.st_ino)
-    size = int(st.st_size)
-    offset = 0
-    if row:
-        prev_inode = int(row[0] or 0)
-        prev_offset = int(row[1] or 0)
-        if prev_inode == inode and 0 <= prev_offset <= size:
-            offset = prev_offset
-    elif size > DEVICE_BOOTSTRAP_BYTES:
-        offset = size - DEVICE_BOOTSTRAP_BYTES
 
-    parsed = 0
-    now = int(time.time())
-    with p.open("r", encoding="utf-8", errors="ignore") as f:
-        if offset > 0:
-            f.seek(offset)
-        for line in f:
-            line = line.rstrip("\n")
-            if not line:
-                continue
-            parts = line.split("\t")
-            if len(parts) < 9:
-                continue
-            def p(i: int):
-                if i < len(parts):
-                    return _norm_field(parts[i])
-                return ""
+_DEVICE_EMPTY_RAW = frozenset((b"", b"-", b"null", b"None"))
+_DEVICE_EMPTY_STR = frozenset(("", "-", "null", "None"))
+_device_raw_cache = {}
+_DEVICE_RAW_CACHE_MAX = 50000
 
-            try:
-                ts = int(float(p(0)))
-            except Exception:
-                ts = now
-
-            ip = p(1)
-            uri = p(2)
-            ua = p(3)
-            hwid = p(4) or p(5) or p(6) or p(7) or p(8)
-            device_name = p(9)
-            platform = p(10)
-            os_name = p(11)
-            os_version = p(12)
-            device_model = p(13) or device_name
-            app_version = p(14) or p(15)
-            lang = p(16)
-            ch_ua = p(17)
-            ch_platform = p(18)
-
-            if not ua and ch_ua:
-                ua = ch_ua
-            if not platform and ch_platform:
-                platform = ch_platform
-
-            sub_key = _sub_key_from_uri(uri)
-            if not sub_key:
-                continue
-            vpn_name = _resolve_vpn_name_by_sub_key(sub_key)
-            if not vpn_name:
-                continue
-            vpn_name = canonical_vpn_name(conn, vpn_name)
 
+def _norm_raw(raw: bytes):
+    b = raw.strip()
+    if b in _DEVICE_EMPTY_RAW:
+        return ""
+    s = b.decode("utf-8", errors="ignore").strip()
+    return "" if s in _DEVICE_EMPTY_STR else s
+
+
+def _parse_device_raw(raw, now: int):
+    # Same result as _parse_device_line(raw.decode(...)), but works on the bytes: clients re-poll with
+    # identical headers, so everything after the timestamp is parsed once and served from a cache.
+    tab = raw.find(b"\t")
+    if tab < 0:
+        return None
+    rest = bytes(raw[tab + 1:]).rstrip(b"\r")
+    body = _device_raw_cache.get(rest)
+    if body is None:
+        parts = rest.split(b"\t", 18)
+        if len(parts) < 8:
+            return None
+        f = [_norm_raw(x) for x in parts[:18]]
+        if len(f) < 18:
+            f.extend([""] * (18 - len(f)))
+        sub_key = _sub_key_from_uri(f[1])
+        if not sub_key:
+            body = ()
+        else:
+            body = (
+                sub_key,
+                f[3] or f[4] or f[5] or f[6] or f[7],
+                f[2] or f[16],
+                f[0],
+                f[9] or f[17],
+                f[10],
+                f[11],
+                f[12] or f[8],
+                f[13] or f[14],
+                f[15],
+                f[1],
+            )
+        if len(_device_raw_cache) >= _DEVICE_RAW_CACHE_MAX:
+            _device_raw_cache.clear()
+        _device_raw_cache[rest] = body
+    if not body:
+        return None
+    try:
+        ts = int(float(raw[:tab].strip() or b"x"))
+    except (ValueError, OverflowError):
+        ts = now
+    return (ts,) + body
+
+
+def _aggregate_device_hits(parsed: list, names: dict, aliases: dict):
+    # One row per (vpn_name, device_key), in order of first appearance, so pending decisions
+    # come out exactly as if every line had been applied on its own.
+    agg = {}
+    dkeys = {}
+    for rec in parsed:
+        vpn_name = names.get(rec[1])
+        if not vpn_name:
+            continue
+        vpn_name = aliases.get(vpn_name, vpn_name)
+        fp = rec[2:11]
+        dkey = dkeys.get(fp)
+        if dkey is None:
             dkey = _device_key(
-                hwid=hwid,
-                ua=ua,
-                ip=ip,
-                lang=lang,
-                app_version=app_version,
-                platform=platform,
-                os_name=os_name,
-                os_version=os_version,
-                device_model=device_model,
+                hwid=rec[2],
+                ua=rec[3],
+                ip=rec[4],
+                lang=rec[10],
+                app_version=rec[9],
+                platform=rec[5],
+                os_name=rec[6],
+                os_version=rec[7],
+                device_model=rec[8],
             )
-            existing = conn.execute(
-                "SELECT revoked, pending FROM user_devices WHERE vpn_name=? AND device_key=?",
-                (vpn_name, dkey),
-            ).fetchone()
-            pending = 0
-            if existing:
-                was_pending = int(existing[1] or 0) == 1
-                was_revoked = int(existing[0] or 0) == 1
-                if was_pending:
-                    pending = 1
-                elif was_revoked and count_active_devices(conn, vpn_name) >= DEVICE_SOFT_LIMIT:
-                    pending = 1
-            elif count_active_devices(conn, vpn_name) >= DEVICE_SOFT_LIMIT:
+            dkeys[fp] = dkey
+        cur = agg.get((vpn_name, dkey))
+        if cur is None:
+            # [hwid, ua, ip, platform, os_name, os_version, device_model, app_version, lang, first_ts, last_ts, hits, uri]
+            agg[(vpn_name, dkey)] = [rec[2], rec[3], rec[4], rec[5], rec[6], rec[7], rec[8], rec[9], rec[10], rec[0], rec[0], 1, rec[11]]
+            continue
+        for i in _DEVICE_STICKY_FIELDS:
+            if rec[i]:
+                cur[i - 2] = rec[i]
+        cur[1] = rec[3]
+        cur[2] = rec[4]
+        cur[10] = rec[0]
+        cur[11] += 1
+        cur[12] = rec[11]
+    return agg
+
+
+def _apply_device_hits(conn: sqlite3.Connection, agg: dict):
+    # Caller holds db_write(); soft-limit decisions come from device_cache, the rows go out in one executemany.
+    users = sorted({k[0] for k in agg})
+    rows = []
+    seen = {}
+    with device_cache.lock:
+        entries = device_cache.load(conn, users)
+        db_on_rollback(lambda: device_cache.drop(users))
+        for (vpn_name, dkey), a in agg.items():
+            e = entries[vpn_name]
+            state = e["devices"].get(dkey)
+            if state is not None and state[1] == 1:
                 pending = 1
-            conn.execute(
-                """
-                INSERT INTO user_devices (vpn_name, device_key, hwid, user_agent, ip, platform, os_name, os_version, device_model, app_version, lang, first_seen, last_seen, hits, revoked, pending, last_path)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, 0, ?, ?)
-                ON CONFLICT(vpn_name, device_key) DO UPDATE SET
-                    hwid=CASE WHEN excluded.hwid != '' THEN excluded.hwid ELSE user_devices.hwid END,
-                    user_agent=excluded.user_agent,
-                    ip=excluded.ip,
-                    platform=CASE WHEN excluded.platform != '' THEN excluded.platform ELSE user_devices.platform END,
-                    os_name=CASE WHEN excluded.os_name != '' THEN excluded.os_name ELSE user_devices.os_name END,
-                    os_version=CASE WHEN excluded.os_version != '' THEN excluded.os_version ELSE user_devices.os_version END,
-                    device_model=CASE WHEN excluded.device_model != '' THEN excluded.device_model ELSE user_devices.device_model END,
-                    app_version=CASE WHEN excluded.app_version != '' THEN excluded.app_version ELSE user_devices.app_version END,
-                    lang=CASE WHEN excluded.lang != '' THEN excluded.lang ELSE user_devices.lang END,
-                    last_seen=excluded.last_seen,
-                    hits=user_devices.hits + 1,
-                    revoked=0,
-                    pending=excluded.pending,
-                    last_path=excluded.last_path
-                """,
-                (vpn_name, dkey, hwid, ua, ip, platform, os_name, os_version, device_model, app_version, lang, ts, ts, pending, uri),
+            elif state is None or state[0] == 1:
+                pending = 1 if e["active"] >= DEVICE_SOFT_LIMIT else 0
+            else:
+                pending = 0
+            device_cache.put_entry(e, dkey, 0, pending)
+            seen[vpn_name] = max(seen.get(vpn_name, 0), int(a[10]))
+            rows.append(
+                (
+                    vpn_name, dkey, a[0], a[1], a[2], a[3], a[4], a[5], a[6], a[7], a[8], a[9], a[10], a[11], pending, a[12],
+                    device_action_token(vpn_name, dkey), human_device_title(a[3], a[4], a[5], a[6], a[1]),
+                )
             )
-            parsed += 1
+        if rows:
+            conn.executemany(_DEVICE_UPSERT_SQL, rows)
+            _store_device_summary(conn, entries, seen)
+    return len(rows)
+
 
-        end_pos = f.tell()
+_DEVICE_HEAD_SIG_BYTES = 1024
+# nginx keeps writing into a renamed log until logrotate's postrotate reopens it.
+_DEVICE_ROTATED_SETTLE_SEC = 5
+
+
+def _device_log_chain(p: Path):
+    # Rotated generations oldest first and the live log last: name.N[.gz] ... name.1[.gz], name.
+    gens = []
+    pat = re.compile(re.escape(p.name) + r"\.(\d+)(\.gz)?")
+    try:
+        for cand in p.parent.iterdir():
+            m = pat.fullmatch(cand.name)
+            if m:
+                gens.append((int(m.group(1)), cand))
+    except OSError:
+        pass
+    gens.sort(key=lambda x: -x[0])
+    return [c for _, c in gens] + [p]
 
+
+def _open_device_log(path: Path):
+    return gzip.open(path, "rb") if path.name.endswith(".gz") else path.open("rb")
+
+
+def _device_log_head(path: Path, n: int):
+    # Identity of a log generation that survives rename and compression: hash of its first bytes.
+    try:
+        with _open_device_log(path) as f:
+            data = f.read(n)
+    except Exception:
+        return None
+    return hashlib.sha1(data).hexdigest() if len(data) == n else None
+
+
+def _device_log_resume(chain, row):
+    # (index into chain, byte offset in the uncompressed stream, align to the next line)
+    if not row:
+        try:
+            size = int(chain[-1].stat().st_size)
+        except OSError:
+            return len(chain) - 1, 0, False
+        if size > DEVICE_BOOTSTRAP_BYTES:
+            return len(chain) - 1, size - DEVICE_BOOTSTRAP_BYTES, True
+        return len(chain) - 1, 0, False
+    inode, offset, updated_at, head_len, head_sig = int(row[0] or 0), int(row[1] or 0), int(row[2] or 0), int(row[3] or 0), row[4] or ""
+    for i in range(len(chain) - 1, -1, -1):
+        path = chain[i]
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        gz = path.name.endswith(".gz")
+        if head_len > 0:
+            if (gz or int(st.st_size) >= offset) and _device_log_head(path, head_len) == head_sig:
+                return i, offset, False
+        elif not gz and int(st.st_ino) == inode and int(st.st_size) >= offset:
+            return i, offset, False
+    # The generation we stopped in is gone: take everything written since the last pass.
+    for i, path in enumerate(chain):
+        try:
+            if int(path.stat().st_mtime) >= updated_at:
+                return i, 0, False
+        except OSError:
+            continue
+    return len(chain) - 1, 0, False
+
+
+def _save_device_ingest_state(conn: sqlite3.Connection, log_path: str, inode: int, offset: int, head, now: int):
     conn.execute(
         """
-        INSERT INTO device_ingest_state (log_path, inode, offset, updated_at)
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(log_path) DO UPDATE SET inode=excluded.inode, offset=excluded.offset, updated_at=excluded.updated_at
+        INSERT INTO device_ingest_state (log_path, inode, offset, updated_at, head_len, head_sig)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(log_path) DO UPDATE SET
+            inode=excluded.inode, offset=excluded.offset, updated_at=excluded.updated_at,
+            head_len=excluded.head_len, head_sig=excluded.head_sig
         """,
-        (str(p), inode, int(end_pos), now),
+        (log_path, int(inode), int(offset), now, int(head[0]), head[1]),
     )
-    conn.commit()
+
+
+def _ingest_device_file(conn: sqlite3.Connection, log_path: str, path: Path, offset: int, align: bool, live: bool, ctx: dict):
+    # Returns (end offset, lines, hits); the position is saved with every chunk, so a crash resumes exactly.
+    try:
+        inode = int(path.stat().st_ino)
+    except OSError:
+        return offset, 0, 0
+    lines = 0
+    parsed = 0
+    head = (0, "")
+    chunk_size = max(64 * 1024, DEVICE_INGEST_CHUNK_BYTES)
+    with _open_device_log(path) as f:
+        if align and offset > 0:
+            # Bootstrap lands mid-line; start at the next full line instead of parsing a fragment.
+            f.seek(offset - 1)
+            offset += len(f.readline()) - 1
+        f.seek(offset)
+        pos = offset
+        tail = b""
+        while True:
+            chunk = f.read(chunk_size)
+            eof = len(chunk) < chunk_size
+            buf = tail + chunk
+            # A line nginx has not finished writing stays for the next run; a rotated file is final.
+            cut = len(buf) if (eof and not live) else buf.rfind(b"\n") + 1
+            if cut <= 0:
+                if eof:
+                    break
+                tail = buf
+                continue
+            tail = buf[cut:]
+            records = []
+            for raw in buf[:cut].split(b"\n"):
+                if not raw:
+                    continue
+                lines += 1
+                rec = _parse_device_raw(raw, ctx["now"])
+                if rec is not None:
+                    records.append(rec)
+            pos += cut
+            if head[0] < _DEVICE_HEAD_SIG_BYTES and pos > head[0]:
+                n = min(pos, _DEVICE_HEAD_SIG_BYTES)
+                sig = _device_log_head(path, n)
+                head = (n, sig) if sig else head
+            agg = _aggregate_device_hits(records, ctx["names"], ctx["aliases"])
+            with db_write(conn):
+                _apply_device_hits(conn, agg)
+                _save_device_ingest_state(conn, log_path, inode, pos, head, ctx["now"])
+            parsed += sum(a[11] for a in agg.values())
+            if eof:
+                break
+    return pos, lines, parsed
+
+
+def _device_aliases(conn: sqlite3.Connection):
+    return tg_aliases.get(conn)
+
+
+def ingest_device_log(conn: sqlite3.Connection):
+    p = Path(DEVICE_LOG_PATH)
+    try:
+        st = p.stat()
+    except Exception:
+        st = None
+    row = conn.execute(
+        "SELECT inode, offset, updated_at, head_len, head_sig FROM device_ingest_state WHERE log_path=?", (str(p),)
+    ).fetchone()
+    if st is not None and row and int(row[0] or 0) == int(st.st_ino) and int(row[1] or 0) == int(st.st_size):
+        return 0
+    chain = _device_log_chain(p)
+    if st is None and len(chain) == 1:
+        return 0
+    idx, offset, align = _device_log_resume(chain, row)
+
+    started = time.monotonic()
+    ctx = {
+        "now": int(time.time()),
+        "names": clients_registry.key_map(),
+        "aliases": _device_aliases(conn),
+    }
+    parsed = 0
+    lines = 0
+    nbytes = 0
+    for i in range(idx, len(chain)):
+        path = chain[i]
+        live = i == len(chain) - 1
+        if live and st is None:
+            break
+        begin = offset if i == idx else 0
+        pos, n_lines, n_parsed = _ingest_device_file(conn, str(p), path, begin, align and i == idx, live, ctx)
+        lines += n_lines
+        parsed += n_parsed
+        nbytes += max(0, pos - begin)
+        if live:
+            break
+        try:
+            if not path.name.endswith(".gz") and time.time() - path.stat().st_mtime < _DEVICE_ROTATED_SETTLE_SEC:
+                break
+            nxt = int(chain[i + 1].stat().st_ino)
+        except OSError:
+            break
+        # The rotated generation is drained; point the state at the start of the next one.
+        with db_write(conn):
+            _save_device_ingest_state(conn, str(p), nxt, 0, (0, ""), ctx["now"])
+        print(f"[device-ingest] drained rotated {path.name} at {pos} bytes", file=sys.stderr, flush=True)
+
+    elapsed = max(1e-6, time.monotonic() - started)
+    _ingest_stats["runs"] += 1
+    _ingest_stats["lines"] += lines
+    _ingest_stats["parsed"] += parsed
+    _ingest_stats["bytes"] += nbytes
+    _ingest_stats["sec_total"] += elapsed
+    if lines:
+        _ingest_stats["last_lines_per_sec"] = int(lines / elapsed)
     return parsed
 
 
+_device_ingest_rt = {"running": False, "mode": "", "last_run": 0.0}
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+
+
+def _inotify_watch_dir(path: str):
+    # Linux inotify through libc; None means "poll instead" (other OS, no permission, limits reached).
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        mask = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+        if libc.inotify_add_watch(fd, os.fsencode(str(Path(path).parent)), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+def _inotify_wait(fd: int, timeout_sec: float, name: str):
+    # The watch is on the directory (so rotation is seen); wake up only for events about our file.
+    deadline = time.time() + max(0.0, timeout_sec)
+    while True:
+        ready, _, _ = select.select([fd], [], [], max(0.0, deadline - time.time()))
+        if not ready:
+            return False
+        if _inotify_drain(fd, name):
+            return True
+
+
+async def _inotify_wait_async(fd: int, timeout_sec: float, name: str):
+    # Same as _inotify_wait, but the event loop watches the fd instead of a blocked thread.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max(0.0, timeout_sec)
+    while True:
+        ready = loop.create_future()
+        loop.add_reader(fd, lambda fut=ready: fut.done() or fut.set_result(None))
+        try:
+            await asyncio.wait_for(ready, max(0.0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(fd)
+        if _inotify_drain(fd, name):
+            return True
+
+
+def _inotify_drain(fd: int, name: str):
+    # Read all pending events; True if one of them is about our file.
+    want = os.fsencode(name)
+    hit = False
+    try:
+        while True:
+            buf = os.read(fd, 65536)
+            if not buf:
+                break
+            pos = 0
+            while pos + 16 <= len(buf):
+                name_len = int.from_bytes(buf[pos + 12:pos + 16], sys.byteorder)
+                if buf[pos + 16:pos + 16 + name_len].rstrip(b"\0") == want:
+                    hit = True
+                pos += 16 + name_len
+    except BlockingIOError:
+        pass
+    return hit
+
+
+def device_ingest_lag(conn: sqlite3.Connection):
+    p = Path(DEVICE_LOG_PATH)
+    try:
+        st = p.stat()
+    except OSError:
+        return {"bytes": 0, "sec": 0}
+    row = conn.execute("SELECT inode, offset, updated_at FROM device_ingest_state WHERE log_path=?", (str(p),)).fetchone()
+    if not row or int(row[0] or 0) != int(st.st_ino):
+        return {"bytes": int(st.st_size), "sec": int(max(0, time.time() - (row[2] if row else st.st_mtime)))}
+    behind = max(0, int(st.st_size) - int(row[1] or 0))
+    sec = int(max(0, st.st_mtime - int(row[2] or 0))) if behind > 0 else 0
+    return {"bytes": behind, "sec": sec}
+
+
+_device_socket = {"started": False, "datagrams": 0, "parsed": 0, "flushes": 0, "errors": 0}
+
+
+def _device_socket_flush(conn: sqlite3.Connection, records: list):
+    agg = _aggregate_device_hits(records, clients_registry.key_map(), _device_aliases(conn))
+    with db_write(conn):
+        _apply_device_hits(conn, agg)
+    _device_socket["parsed"] += sum(a[11] for a in agg.values())
+    _device_socket["flushes"] += 1
+
+
+def device_socket_loop(sock: socket.socket):
+    # nginx sends one access-log record per datagram (syslog framing). Datagrams land in one reusable
+    # buffer and are parsed as bytes; hits are applied in batches at most every DEVICE_INGEST_MIN_GAP_SEC.
+    conn = db_conn()
+    buf = bytearray(65536)
+    view = memoryview(buf)
+    records = []
+    gap = max(0.1, DEVICE_INGEST_MIN_GAP_SEC)
+    flush_at = time.monotonic() + gap
+    while True:
+        sock.settimeout(max(0.01, flush_at - time.monotonic()))
+        try:
+            n = sock.recv_into(buf)
+        except socket.timeout:
+            n = 0
+        except OSError as e:
+            print(f"[device-socket-error] {e}", file=sys.stderr, flush=True)
+            time.sleep(1)
+            n = 0
+        if n > 0:
+            _device_socket["datagrams"] += 1
+            # "<190>Oct 17 12:00:00 tag: " -- the message is everything after the first ": ".
+            start = buf.find(b": ", 0, min(n, 128)) + 2
+            rec = _parse_device_raw(bytes(view[start:n]).rstrip(b"\n"), int(time.time())) if start >= 2 else None
+            if rec is not None:
+                records.append(rec)
+        if time.monotonic() < flush_at and len(records) < 5000:
+            continue
+        flush_at = time.monotonic() + gap
+        if not records:
+            continue
+        try:
+            _device_socket_flush(conn, records)
+        except Exception as e:
+            _device_socket["errors"] += 1
+            print(f"[device-socket-error] {e}", file=sys.stderr, flush=True)
+        records = []
+
+
+def start_device_socket():
+    if not DEVICE_LOG_SOCKET or _device_socket["started"]:
+        return
+    try:
+        os.unlink(DEVICE_LOG_SOCKET)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.bind(DEVICE_LOG_SOCKET)
+    # Only the bot and nginx's group (workers run as www-data) may write: forged hits would push real
+    # devices into pending and fake presence.
+    mode = 0o600
+    if DEVICE_LOG_SOCKET_GROUP:
+        try:
+            os.chown(DEVICE_LOG_SOCKET, -1, grp.getgrnam(DEVICE_LOG_SOCKET_GROUP).gr_gid)
+            mode = 0o660
+        except (KeyError, OSError) as e:
+            print(f"[device-socket] group {DEVICE_LOG_SOCKET_GROUP} not applied, only the bot user can write: {e}", file=sys.stderr, flush=True)
+    os.chmod(DEVICE_LOG_SOCKET, mode)
+    _device_socket["started"] = True
+    Thread(target=device_socket_loop, args=(sock,), daemon=True).start()
+    print(f"[device-socket] listening on {DEVICE_LOG_SOCKET}", file=sys.stderr, flush=True)
+
+
+def bench_device_log(n_lines: int = 1000000):
+    # Synthetic sub_access.log: compares the TSV str path with the bytes path on the same lines.
+    import random
+
+    rnd = random.Random(14)
+    users = [f"user{i}" for i in range(5000)]
+    names = {u: u for u in users}
+    uas = ["Happ/3.5.2", "v2rayNG/1.9.16", "Streisand/1.6", "Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X)"]
+    devs = [(u, f"hw-{rnd.randrange(1 << 30):x}" if rnd.random() < 0.6 else "-", rnd.choice(uas), f"10.{rnd.randrange(256)}.{rnd.randrange(256)}.{rnd.randrange(256)}") for u in users for _ in range(rnd.randrange(1, 4))]
+    out = []
+    for i in range(n_lines):
+        u, hw, ua, ip = devs[rnd.randrange(len(devs))]
+        out.append(f"{1700000000 + i * 0.013:.3f}\t{ip}\t/sub/{u}\t{ua}\t{hw}\t-\t-\t-\t-\t-\tandroid\t-\t-\t-\t1.2\t-\tru-RU\t-\t-\t-\n")
+    data = "".join(out).encode()
+    del out
+    now = int(time.time())
+    started = time.monotonic()
+    tsv = [_parse_device_line(raw.decode("utf-8", errors="ignore").rstrip("\r"), now) for raw in data.split(b"\n") if raw]
+    agg_tsv = _aggregate_device_hits([r for r in tsv if r is not None], names, {})
+    t_tsv = time.monotonic() - started
+    _device_raw_cache.clear()
+    started = time.monotonic()
+    raw_recs = [_parse_device_raw(raw, now) for raw in data.split(b"\n") if raw]
+    agg_raw = _aggregate_device_hits([r for r in raw_recs if r is not None], names, {})
+    t_raw = time.monotonic() - started
+    print(f"lines={n_lines} bytes={len(data)} devices={len(agg_raw)} same={agg_tsv == agg_raw}")
+    print(f"tsv   {t_tsv:.2f}s {int(n_lines / max(t_tsv, 1e-9))} lines/s")
+    print(f"bytes {t_raw:.2f}s {int(n_lines / max(t_raw, 1e-9))} lines/s  x{t_tsv / max(t_raw, 1e-9):.1f}")
+
+
+_DEVICE_BACKFILL_SPLIT_BYTES = 64 * 1024 * 1024
+_DEVICE_BACKFILL_SQL = """
+    INSERT INTO user_devices (vpn_name, device_key, hwid, user_agent, ip, platform, os_name, os_version, device_model, app_version, lang, first_seen, last_seen, hits, revoked, pending, last_path, action_token)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?)
+    ON CONFLICT(vpn_name, device_key) DO UPDATE SET
+        hwid=CASE WHEN excluded.hwid != '' AND excluded.last_seen >= user_devices.last_seen THEN excluded.hwid ELSE user_devices.hwid END,
+        user_agent=CASE WHEN excluded.last_seen >= user_devices.last_seen THEN excluded.user_agent ELSE user_devices.user_agent END,
+        ip=CASE WHEN excluded.last_seen >= user_devices.last_seen THEN excluded.ip ELSE user_devices.ip END,
+        platform=CASE WHEN excluded.platform != '' AND excluded.last_seen >= user_devices.last_seen THEN excluded.platform ELSE user_devices.platform END,
+        os_name=CASE WHEN excluded.os_name != '' AND excluded.last_seen >= user_devices.last_seen THEN excluded.os_name ELSE user_devices.os_name END,
+        os_version=CASE WHEN excluded.os_version != '' AND excluded.last_seen >= user_devices.last_seen THEN excluded.os_version ELSE user_devices.os_version END,
+        device_model=CASE WHEN excluded.device_model != '' AND excluded.last_seen >= user_devices.last_seen THEN excluded.device_model ELSE user_devices.device_model END,
+        app_version=CASE WHEN excluded.app_version != '' AND excluded.last_seen >= user_devices.last_seen THEN excluded.app_version ELSE user_devices.app_version END,
+        lang=CASE WHEN excluded.lang != '' AND excluded.last_seen >= user_devices.last_seen THEN excluded.lang ELSE user_devices.lang END,
+        last_path=CASE WHEN excluded.last_seen >= user_devices.last_seen THEN excluded.last_path ELSE user_devices.last_path END,
+        first_seen=MIN(user_devices.first_seen, excluded.first_seen),
+        last_seen=MAX(user_devices.last_seen, excluded.last_seen),
+        hits=MAX(user_devices.hits, excluded.hits)
+"""
+
+
+def _backfill_device_part(task):
+    # Runs in a pool process: parse one byte range [start, end) of a log (end < 0: whole file).
+    path, start, end, names, aliases, now = task
+    records = []
+    lines = 0
+    with _open_device_log(Path(path)) as f:
+        if start > 0:
+            f.seek(start - 1)
+            start += len(f.readline()) - 1
+        pos = start
+        f.seek(start)
+        while end < 0 or pos < end:
+            raw = f.readline()
+            if not raw:
+                break
+            pos += len(raw)
+            raw = raw.rstrip(b"\n")
+            if not raw:
+                continue
+            lines += 1
+            rec = _parse_device_raw(raw, now)
+            if rec is not None:
+                records.append(rec)
+    return _aggregate_device_hits(records, names, aliases), lines
+
+
+def _merge_device_aggs(parts):
+    # Parts come in log order (oldest file, lowest offset first), so the result does not depend on
+    # which worker finished first: later parts win for attributes, timestamps take min/max.
+    total = {}
+    for agg in parts:
+        for key, a in agg.items():
+            cur = total.get(key)
+            if cur is None:
+                total[key] = list(a)
+                continue
+            for i in _DEVICE_STICKY_FIELDS:
+                if a[i - 2]:
+                    cur[i - 2] = a[i - 2]
+            cur[1] = a[1]
+            cur[2] = a[2]
+            cur[9] = min(cur[9], a[9])
+            cur[10] = max(cur[10], a[10])
+            cur[11] += a[11]
+            cur[12] = a[12]
+    return total
+
+
+def backfill_device_logs(paths: list | None = None, workers: int = 0):
+    # Rebuild user_devices from current and rotated (.gz) logs. Existing rows keep revoked/pending, new
+    # devices over DEVICE_SOFT_LIMIT start pending; hits take the larger count, so running it twice over the same logs changes nothing.
+    conn = db_conn()
+    live = Path(DEVICE_LOG_PATH)
+    files = [Path(x) for x in paths] if paths else _device_log_chain(live)
+    files = [f for f in files if f.is_file()]
+    now = int(time.time())
+    names = clients_registry.key_map()
+    aliases = _device_aliases(conn)
+    tasks = []
+    live_end = None
+    for f in files:
+        if f.name.endswith(".gz"):
+            tasks.append((str(f), 0, -1, names, aliases, now))
+            continue
+        size = int(f.stat().st_size)
+        if f == live:
+            # Stop at the last complete line; the ingest job continues from there.
+            with f.open("rb") as fh:
+                fh.seek(max(0, size - 65536))
+                tail = fh.read()
+            size = size - len(tail) + tail.rfind(b"\n") + 1
+            live_end = (int(f.stat().st_ino), size)
+        for start in range(0, max(size, 1), _DEVICE_BACKFILL_SPLIT_BYTES):
+            tasks.append((str(f), start, min(size, start + _DEVICE_BACKFILL_SPLIT_BYTES), names, aliases, now))
+    workers = max(1, workers or (os.cpu_count() or 1))
+    started = time.monotonic()
+    with ProcessPoolExecutor(max_workers=min(workers, max(1, len(tasks)))) as pool:
+        results = list(pool.map(_backfill_device_part, tasks))
+    total = _merge_device_aggs(agg for agg, _ in results)
+    lines = sum(n for _, n in results)
+    parsed_sec = time.monotonic() - started
+    tokens = {key: device_action_token(*key) for key in total}
+    with db_write(conn):
+        # New devices get the soft-limit decision live ingest would have made, in first-seen order.
+        users = sorted({k[0] for k in total})
+        device_cache.drop(users)
+        db_on_rollback(device_cache.drop)
+        pending = {}
+        with device_cache.lock:
+            entries = device_cache.load(conn, users)
+            for key, a in sorted(total.items(), key=lambda kv: (kv[1][9], kv[0])):
+                e = entries[key[0]]
+                if key[1] in e["devices"]:
+                    continue
+                pending[key] = 1 if e["active"] >= DEVICE_SOFT_LIMIT else 0
+                device_cache.put_entry(e, key[1], 0, pending[key])
+        rows = [
+            (vpn_name, dkey, a[0], a[1], a[2], a[3], a[4], a[5], a[6], a[7], a[8], a[9], a[10], a[11], pending.get((vpn_name, dkey), 0), a[12], tokens[(vpn_name, dkey)])
+            for (vpn_name, dkey), a in sorted(total.items())
+        ]
+        conn.executemany(_DEVICE_BACKFILL_SQL, rows)
+        conn.execute("UPDATE user_devices SET title=device_title(platform, os_name, os_version, device_model, user_agent)")
+        refresh_device_summary(conn)
+        if live_end is not None:
+            # The ingest job may have moved on during the parse: only ever move its offset forward.
+            row = conn.execute("SELECT inode, offset FROM device_ingest_state WHERE log_path=?", (str(live),)).fetchone()
+            if row is not None and (int(row[0] or 0) != live_end[0] or int(row[1] or 0) >= live_end[1]):
+                live_end = None
+        if live_end is not None:
+            n = min(live_end[1], _DEVICE_HEAD_SIG_BYTES)
+            sig = _device_log_head(live, n) if n > 0 else ""
+            _save_device_ingest_state(conn, str(live), live_end[0], live_end[1], (n, sig or ""), now)
+    print(
+        f"[device-backfill] files={len(files)} parts={len(tasks)} workers={workers} lines={lines} "
+        f"devices={len(rows)} parse={parsed_sec:.1f}s total={time.monotonic() - started:.1f}s",
+        file=sys.stderr,
+        flush=True,
+    )
+    return len(rows)
+
+
+def device_ingest_status_line(conn: sqlite3.Connection, parsed: int = 0):
+    if not _device_ingest_rt["running"]:
+        return f"Обновлено записей: {parsed}"
+    lag = device_ingest_lag(conn)
+    return f"Сбор в фоне ({_device_ingest_rt['mode']}), отставание: {lag['bytes'] // 1024} КБ / {lag['sec']} с"
+
+
+def refresh_device_log(conn: sqlite3.Connection):
+    # Handlers only read user_devices while the ingest job keeps it current; otherwise ingest inline as before.
+    if _device_ingest_rt["running"]:
+        return 0
+    try:
+        return ingest_device_log(conn)
+    except Exception as e:
+        print(f"[device-ingest-error] {e}", file=sys.stderr, flush=True)
+        return 0
+
+
+def device_ingest_tick(state: dict):
+    ingest_device_log(state_db(state))
+    _device_ingest_rt["last_run"] = time.time()
+    fd = state.get("inotify_fd")
+    if fd is None:
+        return max(0.5, DEVICE_INGEST_POLL_SEC)
+    if async_bridge_active():
+        # Under asyncio the watch is awaited on the loop (device_ingest_wait_async), not in an executor thread.
+        state["watch"] = True
+        return 0
+    return _device_ingest_delay(_inotify_wait(fd, DEVICE_INGEST_POLL_SEC, Path(DEVICE_LOG_PATH).name))
+
+
+def _device_ingest_delay(changed: bool):
+    # Ingest right away after an idle spell, but at most once per DEVICE_INGEST_MIN_GAP_SEC under load.
+    if changed:
+        return max(0.0, DEVICE_INGEST_MIN_GAP_SEC - (time.time() - _device_ingest_rt["last_run"]))
+    return 0
+
+
+async def device_ingest_wait_async(state: dict, delay: float):
+    if not state.pop("watch", False):
+        return delay
+    return _device_ingest_delay(await _inotify_wait_async(state["inotify_fd"], DEVICE_INGEST_POLL_SEC, Path(DEVICE_LOG_PATH).name))
+
+
+def device_ingest_job():
+    if not DEVICE_INGEST_ENABLED:
+        print("[device-ingest] disabled, devices are ingested on demand", file=sys.stderr, flush=True)
+        return None
+    fd = _inotify_watch_dir(DEVICE_LOG_PATH)
+    _device_ingest_rt["running"] = True
+    _device_ingest_rt["mode"] = "inotify" if fd is not None else "poll"
+    print(
+        f"[device-ingest] enabled mode={_device_ingest_rt['mode']} poll={DEVICE_INGEST_POLL_SEC}s log={DEVICE_LOG_PATH}",
+        file=sys.stderr,
+        flush=True,
+    )
+    # With inotify the tick blocks on the watch for up to DEVICE_INGEST_POLL_SEC instead of sleeping
+    # (under asyncio the event loop watches the fd instead).
+    return periodic_job(
+        "device-ingest",
+        max(1, int(DEVICE_INGEST_POLL_SEC)),
+        device_ingest_tick,
+        "[device-ingest-loop-error]",
+        state={"inotify_fd": fd},
+        error_delay_sec=max(5, int(DEVICE_INGEST_POLL_SEC)),
+        wait_async=device_ingest_wait_async,
+    )
+
+
+def device_ingest_loop():
+    run_job_forever(device_ingest_job())
+
+
 def get_device_stats_by_user(conn: sqlite3.Connection, limit: int = 20):
     cur = conn.execute(
         """
-        SELECT
-          vpn_name,
-          SUM(CASE WHEN revoked=0 AND pending=0 THEN 1 ELSE 0 END) AS active_devices,
-          SUM(CASE WHEN revoked=0 AND pending=1 THEN 1 ELSE 0 END) AS pending_devices,
-          MAX(last_seen) AS last_seen
-        FROM user_devices
-        GROUP BY vpn_name
-        HAVING active_devices > 0 OR pending_devices > 0
-        ORDER BY active_devices DESC, pending_devices DESC, last_seen DESC
+        SELECT vpn_name, active, pending, last_seen
+        FROM user_device_summary
+        WHERE active > 0 OR pending > 0
+        ORDER BY active DESC, pending DESC, last_seen DESC
         LIMIT ?
         """,
         (int(limit),),
@@ -896,17 +2654,17 @@ def get_device_stats_by_user(conn: sqlite3.Connection, limit: int = 20):
     return cur.fetchall()
 
 
-def get_device_counts_map(conn: sqlite3.Connection):
-    cur = conn.execute(
-        """
-        SELECT
-          vpn_name,
-          SUM(CASE WHEN revoked=0 AND pending=0 THEN 1 ELSE 0 END) AS active_devices,
-          SUM(CASE WHEN revoked=0 AND pending=1 THEN 1 ELSE 0 END) AS pending_devices
-        FROM user_devices
-        GROUP BY vpn_name
-        """
-    )
+def get_device_counts_map(conn: sqlite3.Connection, names=None):
+    if names is None:
+        cur = conn.execute("SELECT vpn_name, active, pending FROM user_device_summary")
+    else:
+        names = list(names)
+        if not names:
+            return {}
+        cur = conn.execute(
+            f"SELECT vpn_name, active, pending FROM user_device_summary WHERE vpn_name IN ({','.join('?' * len(names))})",
+            names,
+        )
     out = {}
     for r in cur.fetchall():
         out[(r[0] or "").strip()] = (int(r[1] or 0), int(r[2] or 0))
@@ -916,7 +2674,7 @@ def get_device_counts_map(conn: sqlite3.Connection):
 def get_latest_device_for_user(conn: sqlite3.Connection, vpn_name: str):
     cur = conn.execute(
         """
-        SELECT device_key, hwid, user_agent, platform, os_name, os_version, device_model, app_version, last_seen
+        SELECT device_key, hwid, user_agent, platform, os_name, os_version, device_model, app_version, last_seen, title
         FROM user_devices
         WHERE vpn_name=? AND revoked=0
         ORDER BY pending ASC, last_seen DESC
@@ -930,7 +2688,7 @@ def get_latest_device_for_user(conn: sqlite3.Connection, vpn_name: str):
 def get_devices_for_user(conn: sqlite3.Connection, vpn_name: str, limit: int = DEVICE_LIST_LIMIT):
     cur = conn.execute(
         """
-        SELECT device_key, hwid, user_agent, ip, platform, os_name, os_version, device_model, app_version, lang, first_seen, last_seen, hits, pending
+        SELECT device_key, hwid, user_agent, ip, platform, os_name, os_version, device_model, app_version, lang, first_seen, last_seen, hits, pending, title, action_token
         FROM user_devices
         WHERE vpn_name=? AND revoked=0
         ORDER BY pending ASC, first_seen ASC, last_seen ASC
@@ -963,56 +2721,151 @@ def _traffic_node_label(node: str, node_host: str):
     return n or "-"
 
 
-def _traffic_window_aggregate(conn: sqlite3.Connection, since_ts: int):
-    cur = conn.execute(
-        """
-        SELECT collected_at, node, node_host, vpn_name, uplink_total, downlink_total
-        FROM traffic_samples
-        WHERE collected_at >= ?
-        ORDER BY collected_at ASC
-        """,
-        (int(since_ts),),
-    )
-    prev = {}
+def _traffic_segments(start_ts: int, end_ts: int):
+    # Cover [start_ts, end_ts) with raw samples at the ragged edges, hour buckets in between and
+    # local-day buckets for whole days, so a month-long window reads ~30 rows per series.
+    h0 = -(-start_ts // 3600) * 3600
+    h1 = end_ts // 3600 * 3600
+    if h1 <= h0:
+        return [("traffic_samples", start_ts, end_ts)]
+    segs = [("traffic_samples", start_ts, h0)]
+    d0 = _local_day_start(h0)
+    if d0 < h0:
+        d0 = _local_day_start(d0 + 26 * 3600)
+    d1 = _local_day_start(h1)
+    if d0 < d1 and d0 % 3600 == 0 and d1 % 3600 == 0:
+        segs += [("traffic_hourly", h0, d0), ("traffic_daily", d0, d1), ("traffic_hourly", d1, h1)]
+    else:
+        segs.append(("traffic_hourly", h0, h1))
+    segs.append(("traffic_samples", h1, end_ts))
+    return [seg for seg in segs if seg[1] < seg[2]]
+
+
+_traffic_windows = {"anchor": None, "results": {}, "hits": 0, "passes": 0, "rows": 0}
+_traffic_windows_lock = threading.Lock()
+# While the collector is down windows end at "now" and every call is a new key; keep the cache bounded.
+_TRAFFIC_WINDOWS_MAX = 256
+
+
+def traffic_anchor_ts(conn: sqlite3.Connection):
+    # End bound for "last N hours" windows: just past the latest collection, so results stay
+    # cacheable until the collector writes the next snapshot. If collection has stalled, fall back
+    # to the wall clock so the windows keep sliding instead of freezing at the last snapshot.
+    now = int(time.time())
+    row = conn.execute("SELECT MAX(collected_at) FROM traffic_samples").fetchone()
+    if not row or row[0] is None or now - int(row[0]) > 2 * max(1, TRAFFIC_COLLECT_INTERVAL_SEC):
+        return now + 1
+    return min(int(row[0]), now) + 1
+
+
+def _merge_ranges(ranges):
+    out = []
+    for a, b in sorted(ranges):
+        if out and a <= out[-1][1]:
+            out[-1][1] = max(out[-1][1], b)
+        else:
+            out.append([a, b])
+    return out
+
+
+def _traffic_windows_pass(conn: sqlite3.Connection, windows: dict):
+    # One read per source table covering every requested window; each row is added to all windows
+    # whose segments contain it.
+    by_table = {}
+    for key, (start_ts, end_ts) in windows.items():
+        for table, a, b in _traffic_segments(int(start_ts), int(end_ts)):
+            by_table.setdefault(table, []).append((a, b, key))
+    out = {key: {} for key in windows}
+    n_rows = 0
+    for table, segs in by_table.items():
+        ranges = _merge_ranges((a, b) for a, b, _key in segs)
+        if table == "traffic_samples":
+            ts_col = "collected_at"
+            sql = """
+                SELECT collected_at, vpn_name, node, node_host, uplink_delta, downlink_delta, collected_at
+                FROM traffic_samples
+                WHERE uplink_delta IS NOT NULL AND ({where})
+            """
+        else:
+            ts_col = "bucket_ts"
+            sql = f"SELECT bucket_ts, vpn_name, node, node_host, uplink, downlink, last_ts FROM {table} WHERE {{where}}"
+        where = " OR ".join([f"({ts_col} >= ? AND {ts_col} < ?)"] * len(ranges))
+        params = [v for r in ranges for v in r]
+        for ts, name, node, node_host, up, down, last_ts in conn.execute(sql.format(where=where), params):
+            n_rows += 1
+            up = int(up or 0)
+            down = int(down or 0)
+            last_ts = int(last_ts or 0)
+            for a, b, key in segs:
+                if a <= ts < b:
+                    acc = out[key]
+                    rec = acc.get((name, node, node_host))
+                    if rec is None:
+                        acc[(name, node, node_host)] = [up, down, last_ts]
+                    else:
+                        rec[0] += up
+                        rec[1] += down
+                        rec[2] = max(rec[2], last_ts)
+    return out, n_rows
+
+
+def traffic_windows(conn: sqlite3.Connection, windows: dict):
+    # {key: (start_ts, end_ts)} -> {key: {(vpn_name, node, node_host): [uplink, downlink, last_ts]}}
+    # Results are shared between callers until the next collection and must not be modified.
+    anchor = conn.execute("SELECT MAX(id) FROM traffic_samples").fetchone()[0]
+    out = {}
+    missing = {}
+    with _traffic_windows_lock:
+        if _traffic_windows["anchor"] != anchor:
+            _traffic_windows["anchor"] = anchor
+            _traffic_windows["results"] = {}
+        cached = _traffic_windows["results"]
+        for key, win in windows.items():
+            win = (int(win[0]), int(win[1]))
+            if win in cached:
+                out[key] = cached[win]
+            else:
+                missing[key] = win
+        _traffic_windows["hits"] += len(out)
+    if missing:
+        fresh, n_rows = _traffic_windows_pass(conn, missing)
+        with _traffic_windows_lock:
+            _traffic_windows["passes"] += 1
+            _traffic_windows["rows"] += n_rows
+            if _traffic_windows["anchor"] == anchor:
+                if len(_traffic_windows["results"]) + len(missing) > _TRAFFIC_WINDOWS_MAX:
+                    _traffic_windows["results"] = {}
+                for key, win in missing.items():
+                    _traffic_windows["results"][win] = fresh[key]
+        out.update(fresh)
+    return out
+
+
+def _traffic_by_user(conn: sqlite3.Connection, series: dict):
     agg = {}
-    for collected_at, node, node_host, raw_name, up_total, down_total in cur.fetchall():
+    for (raw_name, node, node_host), (du, dd, last_ts) in series.items():
         name = canonical_vpn_name(conn, (raw_name or "").strip())
         if not name:
             continue
         node_label = _traffic_node_label(node, node_host)
-        key = (name, node_label)
-        up_total = int(up_total or 0)
-        down_total = int(down_total or 0)
-        p = prev.get(key)
-        if p is None:
-            prev[key] = (up_total, down_total, int(collected_at or 0))
-            continue
-        prev_up, prev_down, _prev_ts = p
-        du = up_total - prev_up
-        dd = down_total - prev_down
-        # Counter reset: treat current value as delta since reset.
-        if du < 0:
-            du = up_total
-        if dd < 0:
-            dd = down_total
-        if du < 0:
-            du = 0
-        if dd < 0:
-            dd = 0
-        prev[key] = (up_total, down_total, int(collected_at or 0))
         user_rec = agg.setdefault(name, {"uplink": 0, "downlink": 0, "nodes": {}, "last_ts": 0})
         user_rec["uplink"] += du
         user_rec["downlink"] += dd
-        user_rec["last_ts"] = max(int(user_rec.get("last_ts") or 0), int(collected_at or 0))
+        user_rec["last_ts"] = max(int(user_rec.get("last_ts") or 0), last_ts)
         node_rec = user_rec["nodes"].setdefault(node_label, {"uplink": 0, "downlink": 0})
         node_rec["uplink"] += du
         node_rec["downlink"] += dd
     return agg
 
 
+def _traffic_window_aggregate(conn: sqlite3.Connection, hours: int):
+    end_ts = traffic_anchor_ts(conn)
+    series = traffic_windows(conn, {"w": (end_ts - max(1, int(hours)) * 3600, end_ts)})["w"]
+    return _traffic_by_user(conn, series)
+
+
 def get_traffic_top(conn: sqlite3.Connection, hours: int = 24, limit: int = 12):
-    since_ts = int(time.time()) - max(1, int(hours)) * 3600
-    agg = _traffic_window_aggregate(conn, since_ts)
+    agg = _traffic_window_aggregate(conn, hours)
     rows = []
     for name, rec in agg.items():
         up = int(rec.get("uplink") or 0)
@@ -1034,8 +2887,7 @@ def get_traffic_top(conn: sqlite3.Connection, hours: int = 24, limit: int = 12):
 
 
 def get_traffic_user_breakdown(conn: sqlite3.Connection, vpn_name: str, hours: int = 24):
-    since_ts = int(time.time()) - max(1, int(hours)) * 3600
-    agg = _traffic_window_aggregate(conn, since_ts)
+    agg = _traffic_window_aggregate(conn, hours)
     rec = agg.get((vpn_name or "").strip()) or {"uplink": 0, "downlink": 0, "nodes": {}, "last_ts": 0}
     nodes = []
     for node_name, nrec in (rec.get("nodes") or {}).items():
@@ -1054,48 +2906,19 @@ def get_traffic_user_breakdown(conn: sqlite3.Connection, vpn_name: str, hours: i
     }
 
 
-def _traffic_window_aggregate_by_node(conn: sqlite3.Connection, since_ts: int):
-    cur = conn.execute(
-        """
-        SELECT collected_at, node, node_host, vpn_name, uplink_total, downlink_total
-        FROM traffic_samples
-        WHERE collected_at >= ?
-        ORDER BY collected_at ASC
-        """,
-        (int(since_ts),),
-    )
-    prev = {}
+def _traffic_by_node(conn: sqlite3.Connection, series: dict):
     out = {}
-    for collected_at, node, node_host, raw_name, up_total, down_total in cur.fetchall():
+    for (raw_name, node, node_host), (du, dd, last_ts) in series.items():
         name = canonical_vpn_name(conn, (raw_name or "").strip())
         if not name:
             continue
         node_label = _traffic_node_label(node, node_host)
-        key = (name, node_label)
-        up_total = int(up_total or 0)
-        down_total = int(down_total or 0)
-        p = prev.get(key)
-        if p is None:
-            prev[key] = (up_total, down_total)
-            continue
-        prev_up, prev_down = p
-        du = up_total - prev_up
-        dd = down_total - prev_down
-        if du < 0:
-            du = up_total
-        if dd < 0:
-            dd = down_total
-        if du < 0:
-            du = 0
-        if dd < 0:
-            dd = 0
-        prev[key] = (up_total, down_total)
         rec = out.setdefault(node_label, {"uplink": 0, "downlink": 0, "users": set(), "last_ts": 0})
         rec["uplink"] += du
         rec["downlink"] += dd
         if (du + dd) > 0:
             rec["users"].add(name)
-            rec["last_ts"] = max(int(rec.get("last_ts") or 0), int(collected_at or 0))
+            rec["last_ts"] = max(int(rec.get("last_ts") or 0), last_ts)
     rows = []
     for node_label, rec in out.items():
         up = int(rec.get("uplink") or 0)
@@ -1124,11 +2947,13 @@ def _month_start_ts_local(now_ts: int):
 def build_node_traffic_report_text(conn: sqlite3.Connection, now_ts: int | None = None):
     ts = int(now_ts or time.time())
     now_local = datetime.fromtimestamp(ts, tz=timezone.utc).astimezone()
-    since_24h = ts - 86400
+    end_ts = min(ts + 1, traffic_anchor_ts(conn))
+    since_24h = end_ts - 86400
     since_month = _month_start_ts_local(ts)
 
-    day_rows = _traffic_window_aggregate_by_node(conn, since_24h)
-    month_rows = _traffic_window_aggregate_by_node(conn, since_month)
+    wins = traffic_windows(conn, {"day": (since_24h, end_ts), "month": (since_month, end_ts)})
+    day_rows = _traffic_by_node(conn, wins["day"])
+    month_rows = _traffic_by_node(conn, wins["month"])
 
     def section(title: str, rows: list[dict], since_ts: int):
         lines = [title]
@@ -1154,46 +2979,13 @@ def build_node_traffic_report_text(conn: sqlite3.Connection, now_ts: int | None
     return "\n".join(lines)[:3500]
 
 
-def _traffic_total_between(conn: sqlite3.Connection, start_ts: int, end_ts: int):
-    start_ts = int(start_ts)
-    end_ts = int(end_ts)
-    if end_ts <= start_ts:
-        return 0, {}
-    cur = conn.execute(
-        """
-        SELECT collected_at, node, node_host, vpn_name, uplink_total, downlink_total
-        FROM traffic_samples
-        WHERE collected_at >= ? AND collected_at < ?
-        ORDER BY collected_at ASC
-        """,
-        (start_ts, end_ts),
-    )
-    prev = {}
+def _traffic_node_totals(conn: sqlite3.Connection, series: dict):
     node_totals = {}
-    for _ts, node, node_host, raw_name, up_total, down_total in cur.fetchall():
+    for (raw_name, node, node_host), (du, dd, _last_ts) in series.items():
         name = canonical_vpn_name(conn, (raw_name or "").strip())
         if not name:
             continue
         node_label = _traffic_node_label(node, node_host)
-        key = (name, node_label)
-        up_total = int(up_total or 0)
-        down_total = int(down_total or 0)
-        p = prev.get(key)
-        if p is None:
-            prev[key] = (up_total, down_total)
-            continue
-        prev_up, prev_down = p
-        du = up_total - prev_up
-        dd = down_total - prev_down
-        if du < 0:
-            du = up_total
-        if dd < 0:
-            dd = down_total
-        if du < 0:
-            du = 0
-        if dd < 0:
-            dd = 0
-        prev[key] = (up_total, down_total)
         node_totals[node_label] = int(node_totals.get(node_label, 0)) + du + dd
     total = sum(int(v or 0) for v in node_totals.values())
     return int(total), node_totals
@@ -1218,27 +3010,47 @@ def device_action_token(vpn_name: str, device_key: str):
     return hashlib.sha1(raw).hexdigest()[:12]
 
 
+def revoke_devices_by_tokens(conn: sqlite3.Connection, pairs):
+    # [(vpn_name, action_token), ...] in one transaction -> (revoked, promoted)
+    revoked = 0
+    users = []
+    with db_write(conn):
+        for vpn_name, token in pairs:
+            row = conn.execute(
+                "UPDATE user_devices SET revoked=1 WHERE vpn_name=? AND action_token=? AND revoked=0 RETURNING device_key, pending",
+                (vpn_name, token),
+            ).fetchone()
+            if not row:
+                continue
+            revoked += 1
+            device_cache.set_state(conn, vpn_name, row[0], 1, int(row[1] or 0))
+            if vpn_name not in users:
+                users.append(vpn_name)
+        promoted = sum(promote_pending_devices(conn, vpn_name) for vpn_name in users)
+        if users:
+            _store_device_summary(conn, device_cache.load(conn, users))
+    return revoked, promoted
+
+
 def revoke_device_by_token(conn: sqlite3.Connection, vpn_name: str, token: str):
-    for row in get_all_devices_for_user(conn, vpn_name, limit=300):
-        dkey = (row[0] or "")
-        if device_action_token(vpn_name, dkey) == token:
-            conn.execute(
-                "UPDATE user_devices SET revoked=1 WHERE vpn_name=? AND device_key=?",
-                (vpn_name, dkey),
-            )
-            promoted = promote_pending_devices(conn, vpn_name)
-            conn.commit()
-            return True, promoted
-    return False, 0
+    revoked, promoted = revoke_devices_by_tokens(conn, [(vpn_name, token)])
+    return revoked > 0, promoted
 
 
 def revoke_all_devices(conn: sqlite3.Connection, vpn_name: str):
-    cur = conn.execute(
-        "UPDATE user_devices SET revoked=1 WHERE vpn_name=? AND revoked=0",
-        (vpn_name,),
-    )
-    promoted = promote_pending_devices(conn, vpn_name)
-    conn.commit()
+    with db_write(conn):
+        cur = conn.execute(
+            "UPDATE user_devices SET revoked=1 WHERE vpn_name=? AND revoked=0",
+            (vpn_name,),
+        )
+        with device_cache.lock:
+            e = device_cache.get(conn, vpn_name)
+            for dkey, (revoked, pending) in list(e["devices"].items()):
+                if not revoked:
+                    device_cache.put_entry(e, dkey, 1, pending)
+        db_on_rollback(lambda: device_cache.drop([vpn_name]))
+        promoted = promote_pending_devices(conn, vpn_name)
+        _store_device_summary(conn, {vpn_name: device_cache.get(conn, vpn_name)})
     return int(cur.rowcount or 0), promoted
 
 
@@ -1269,6 +3081,7 @@ ANDROID_MODEL_MAP = {
 }
 
 
+@functools.lru_cache(maxsize=4096)
 def _guess_os_from_ua(ua: str):
     u = (ua or "").lower()
     if "android" in u:
@@ -1294,7 +3107,9 @@ def _human_model(model: str):
     return m
 
 
+@functools.lru_cache(maxsize=8192)
 def human_device_title(platform: str, os_name: str, os_version: str, device_model: str, ua: str):
+    # Stored in user_devices.title at ingest (SQL function device_title); screens read the column.
     p = (platform or "").strip()
     o = (os_name or "").strip()
     v = (os_version or "").strip()
@@ -1329,8 +3144,9 @@ def get_user(conn: sqlite3.Connection, tg_id: int):
 
 
 def delete_tg_users_by_vpn_name(conn: sqlite3.Connection, vpn_name: str):
-    conn.execute("DELETE FROM tg_users WHERE vpn_name=?", (vpn_name,))
-    conn.commit()
+    rows = conn.execute("DELETE FROM tg_users WHERE vpn_name=? RETURNING tg_id", (vpn_name,)).fetchall()
+    db_commit(conn)
+    tg_aliases.drop([r[0] for r in rows])
 
 
 def tg_ids_by_vpn_name(conn: sqlite3.Connection, vpn_name: str):
@@ -1341,10 +3157,7 @@ def tg_ids_by_vpn_name(conn: sqlite3.Connection, vpn_name: str):
 def notify_user_change(conn: sqlite3.Connection, vpn_name: str, text: str):
     ids = tg_ids_by_vpn_name(conn, vpn_name)
     for tg_id in ids:
-        try:
-            send_message(int(tg_id), text[:3500], kb_main(is_admin=False))
-        except Exception as e:
-            print(f"[notify-user-change-error] vpn={vpn_name} tg_id={tg_id} err={e}", file=sys.stderr, flush=True)
+        send_message(int(tg_id), text[:3500], kb_main(is_admin=False), priority=OUTBOX_PRIO_NOTICE)
 
 
 def upsert_user(conn: sqlite3.Connection, tg_id: int, username: str, vpn_name: str):
@@ -1360,13 +3173,14 @@ def upsert_user(conn: sqlite3.Connection, tg_id: int, username: str, vpn_name: s
         """,
         (tg_id, username, vpn_name, now, now),
     )
-    conn.commit()
+    db_commit(conn)
+    tg_aliases.set(tg_id, vpn_name)
 
 
 def touch_start(conn: sqlite3.Connection, tg_id: int):
     now = int(time.time())
     conn.execute("UPDATE tg_users SET last_start_at=? WHERE tg_id=?", (now, tg_id))
-    conn.commit()
+    db_commit(conn)
 
 
 def get_admin_state(conn: sqlite3.Connection, tg_id: int):
@@ -1393,12 +3207,12 @@ def set_admin_state(conn: sqlite3.Connection, tg_id: int, step: str, payload: di
         """,
         (tg_id, step, json.dumps(payload, ensure_ascii=False), now),
     )
-    conn.commit()
+    db_commit(conn)
 
 
 def clear_admin_state(conn: sqlite3.Connection, tg_id: int):
     conn.execute("DELETE FROM admin_state WHERE tg_id=?", (tg_id,))
-    conn.commit()
+    db_commit(conn)
 
 
 def get_pending_provision_job(conn: sqlite3.Connection, tg_id: int):
@@ -1418,25 +3232,21 @@ def enqueue_provision_job(conn: sqlite3.Connection, tg_id: int, chat_id: int, us
         "INSERT INTO provisioning_jobs (tg_id, chat_id, username, vpn_name, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
         (tg_id, chat_id, username, vpn_name, JOB_PENDING, now),
     )
-    conn.commit()
+    db_commit(conn)
 
 
 def claim_next_provision_job(conn: sqlite3.Connection):
-    cur = conn.cursor()
-    cur.execute("BEGIN IMMEDIATE")
-    cur.execute(
-        "SELECT id, tg_id, chat_id, username, vpn_name FROM provisioning_jobs WHERE status=? ORDER BY id ASC LIMIT 1",
-        (JOB_PENDING,),
-    )
-    row = cur.fetchone()
-    if not row:
-        conn.commit()
-        return None
+    with db_write(conn):
+        row = conn.execute(
+            "SELECT id, tg_id, chat_id, username, vpn_name FROM provisioning_jobs WHERE status=? ORDER BY id ASC LIMIT 1",
+            (JOB_PENDING,),
+        ).fetchone()
+        if not row:
+            return None
 
-    jid = int(row[0])
-    now = int(time.time())
-    cur.execute("UPDATE provisioning_jobs SET status=?, started_at=? WHERE id=?", (JOB_RUNNING, now, jid))
-    conn.commit()
+        jid = int(row[0])
+        now = int(time.time())
+        conn.execute("UPDATE provisioning_jobs SET status=?, started_at=? WHERE id=?", (JOB_RUNNING, now, jid))
     return {
         "id": jid,
         "tg_id": int(row[1]),
@@ -1453,63 +3263,64 @@ def finish_provision_job(conn: sqlite3.Connection, job_id: int, ok: bool, result
         "UPDATE provisioning_jobs SET status=?, finished_at=?, result_text=? WHERE id=?",
         (status, now, (result_text or "")[:4000], job_id),
     )
-    conn.commit()
-
+    db_commit(conn)
+
+
+def provision_worker_tick(state: dict):
+    conn = state_db(state)
+    job = claim_next_provision_job(conn)
+    if not job:
+        return 1
+
+    ok, out = provision_user(job["vpn_name"])
+    if ok:
+        existing = get_user(conn, int(job["tg_id"]))
+        upsert_user(conn, int(job["tg_id"]), job.get("username", ""), job["vpn_name"])
+        set_trial_flag(job["vpn_name"], True)
+        finish_provision_job(conn, int(job["id"]), True, out)
+        if existing is None:
+            uname = (job.get("username") or "").strip()
+            who = f"@{uname}" if uname else f"tg_id={int(job['tg_id'])}"
+            send_admin_alert(
+                "🆕 Новый пользователь зарегистрирован.\n"
+                f"Пользователь: {who}\n"
+                f"VPN: {job['vpn_name']}\n"
+                f"Триал: {FREE_DAYS} дн."
+            )
+        send_message(
+            int(job["chat_id"]),
+            f"✅ Подписка готова.\n🧪 Пробный доступ: {FREE_DAYS} дн.\n"
+            "Открой «👤 Моя подписка», чтобы подключиться.\n"
+            "Для продления используй «💰 Оплатить подписку».",
+            kb_main(is_admin=False),
+            priority=OUTBOX_PRIO_NOTICE,
+        )
+    else:
+        finish_provision_job(conn, int(job["id"]), False, out)
+        send_message(
+            int(job["chat_id"]),
+            "❌ Не удалось создать подписку автоматически. Напиши в поддержку.\n\n" + SUPPORT_TEXT,
+            kb_main(is_admin=False),
+            priority=OUTBOX_PRIO_NOTICE,
+        )
+        uname = (job.get("username") or "").strip()
+        who = f"@{uname}" if uname else f"tg_id={int(job['tg_id'])}"
+        send_admin_alert(
+            "🚨 Ошибка регистрации нового пользователя.\n"
+            f"Пользователь: {who}\n"
+            f"VPN: {job['vpn_name']}\n\n"
+            f"{(out or '').strip()[:1200]}"
+        )
+        print(f"provision failed for {job['vpn_name']}:\n{out}", file=sys.stderr)
+    return 0
 
-def provision_worker_loop():
-    conn = sqlite3.connect(DB_PATH)
-    init_db(conn)
 
-    while True:
-        try:
-            job = claim_next_provision_job(conn)
-            if not job:
-                time.sleep(1)
-                continue
+def provision_worker_job():
+    return periodic_job("provision-worker", 1, provision_worker_tick, "worker error:", error_delay_sec=2)
 
-            ok, out = provision_user(job["vpn_name"])
-            if ok:
-                existing = get_user(conn, int(job["tg_id"]))
-                upsert_user(conn, int(job["tg_id"]), job.get("username", ""), job["vpn_name"])
-                set_trial_flag(job["vpn_name"], True)
-                finish_provision_job(conn, int(job["id"]), True, out)
-                if existing is None:
-                    uname = (job.get("username") or "").strip()
-                    who = f"@{uname}" if uname else f"tg_id={int(job['tg_id'])}"
-                    send_admin_alert(
-                        "🆕 Новый пользователь зарегистрирован.\n"
-                        f"Пользователь: {who}\n"
-                        f"VPN: {job['vpn_name']}\n"
-                        f"Триал: {FREE_DAYS} дн."
-                    )
-                send_message(
-                    int(job["chat_id"]),
-                    f"✅ Подписка готова.\n🧪 Пробный доступ: {FREE_DAYS} дн.\n"
-                    "Открой «👤 Моя подписка», чтобы подключиться.\n"
-                    "Для продления используй «💰 Оплатить подписку».",
-                    kb_main(is_admin=False),
-                )
-            else:
-                finish_provision_job(conn, int(job["id"]), False, out)
-                send_message(
-                    int(job["chat_id"]),
-                    "❌ Не удалось создать подписку автоматически. Напиши в поддержку.\n\n" + SUPPORT_TEXT,
-                    kb_main(is_admin=False),
-                )
-                uname = (job.get("username") or "").strip()
-                who = f"@{uname}" if uname else f"tg_id={int(job['tg_id'])}"
-                send_admin_alert(
-                    "🚨 Ошибка регистрации нового пользователя.\n"
-                    f"Пользователь: {who}\n"
-                    f"VPN: {job['vpn_name']}\n\n"
-                    f"{(out or '').strip()[:1200]}"
-                )
-                print(f"provision failed for {job['vpn_name']}:\n{out}", file=sys.stderr)
 
-        except Exception as e:
-            print(f"worker error: {e}", file=sys.stderr)
-            traceback.print_exc()
-            time.sleep(2)
+def provision_worker_loop():
+    run_job_forever(provision_worker_job())
 
 
 def is_admin_user(user_obj: dict):
@@ -1535,6 +3346,9 @@ def safe_tg_name(user_obj: dict):
 
 
 def run_cmd(args: list[str], timeout_sec: int = 240):
+    db_commit_pending()
+    if async_bridge_active():
+        return asyncio.run_coroutine_threadsafe(run_cmd_async(args, timeout_sec), _async_rt["loop"]).result()
     started = time.time()
     try:
         proc = subprocess.run(args, capture_output=True, text=True, timeout=timeout_sec)
@@ -1553,6 +3367,28 @@ def run_cmd(args: list[str], timeout_sec: int = 240):
     return rc, out
 
 
+async def run_cmd_async(args: list[str], timeout_sec: int = 240):
+    started = time.time()
+    proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout_sec)
+        rc = int(proc.returncode)
+        out = (stdout.decode("utf-8", errors="replace") + "\n" + stderr.decode("utf-8", errors="replace")).strip()
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        rc = 124
+        out = f"timeout after {timeout_sec}s"
+    if rc != 0:
+        cmd = " ".join(args)
+        print(
+            f"[cmd-error] rc={rc} sec={time.time()-started:.2f} cmd={cmd}\n{out[:1200]}",
+            file=sys.stderr,
+            flush=True,
+        )
+    return rc, out
+
+
 def admin_chat_ids():
     ids = set(ADMIN_TG_IDS)
     ids.add(PRIMARY_ADMIN_TG_ID)
@@ -1561,10 +3397,7 @@ def admin_chat_ids():
 
 def send_admin_alert(text: str):
     for chat_id in admin_chat_ids():
-        try:
-            send_message(chat_id, text[:3500], kb_main(is_admin=True))
-        except Exception as e:
-            print(f"[monitor-alert-send-error] chat_id={chat_id} err={e}", file=sys.stderr, flush=True)
+        send_message(chat_id, text[:3500], kb_main(is_admin=True), priority=OUTBOX_PRIO_NOTICE)
 
 
 def trial_notice_already_sent(conn: sqlite3.Connection, tg_id: int, notice_kind: str, expire_ts: int):
@@ -1584,7 +3417,7 @@ def mark_trial_notice_sent(conn: sqlite3.Connection, tg_id: int, notice_kind: st
         """,
         (int(tg_id), notice_kind, int(expire_ts), now),
     )
-    conn.commit()
+    db_commit(conn)
 
 
 def answer_pre_checkout(pre_checkout_query_id: str, ok: bool, error_message: str = ""):
@@ -1594,7 +3427,9 @@ def answer_pre_checkout(pre_checkout_query_id: str, ok: bool, error_message: str
     api_call("answerPreCheckoutQuery", payload)
 
 
-def send_stars_invoice(chat_id: int, months: int):
+def send_stars_invoice(chat_id: int, months: int, fallback: dict | None = None):
+    # Queued like a reply, so it keeps its place among the messages to this chat; `fallback` (an outbox
+    # item) is sent instead if Telegram rejects the invoice.
     plan = PAYMENT_PLANS.get(months)
     if not plan:
         raise RuntimeError(f"Unknown payment plan: {months}")
@@ -1614,57 +3449,87 @@ def send_stars_invoice(chat_id: int, months: int):
         "currency": "XTR",
         "prices": [{"label": title, "amount": stars}],
     }
-    api_call("sendInvoice", payload)
+    item = _outbox_item(chat_id, "sendInvoice", payload, OUTBOX_PRIO_REPLY)
+    item["fallback"] = fallback
+    send_via_outbox(item)
 
 
-def monitor_loop():
+def monitor_tick(state: dict):
+    args = [MONITOR_CMD]
+    if MONITOR_CHECK_USER:
+        args += ["--user", MONITOR_CHECK_USER]
+    rc, out = run_cmd(args, timeout_sec=max(60, min(MONITOR_INTERVAL_SEC, 180)))
+    now = int(time.time())
+    sig = f"{rc}:{(out or '')[:300]}"
+
+    if rc == 0:
+        if state["was_bad"]:
+            send_admin_alert("✅ Мониторинг: восстановлено. Healthcheck снова OK.")
+            print("[monitor] recovered", file=sys.stderr, flush=True)
+        state["was_bad"] = False
+    else:
+        need_alert = (not state["was_bad"]) or (
+            sig != state["last_bad_sig"] and (now - state["last_bad_at"]) >= MONITOR_COOLDOWN_SEC
+        )
+        if need_alert:
+            msg = "🚨 Мониторинг: проблема на VPN-узлах.\n\n" + (out[:2500] if out else f"rc={rc}")
+            send_admin_alert(msg)
+            state["last_bad_at"] = now
+            state["last_bad_sig"] = sig
+            print("[monitor] alerted", file=sys.stderr, flush=True)
+        state["was_bad"] = True
+
+
+def monitor_job():
     if not MONITOR_ENABLED:
         print("[monitor] disabled", file=sys.stderr, flush=True)
-        return
-
-    last_bad_at = 0
-    last_bad_sig = ""
-    was_bad = False
+        return None
     print(
         f"[monitor] enabled interval={MONITOR_INTERVAL_SEC}s cooldown={MONITOR_COOLDOWN_SEC}s cmd={MONITOR_CMD}",
         file=sys.stderr,
         flush=True,
     )
+    state = {"was_bad": False, "last_bad_at": 0, "last_bad_sig": ""}
+    return periodic_job("monitor", max(30, MONITOR_INTERVAL_SEC), monitor_tick, "[monitor-loop-error]", state=state)
 
-    while True:
-        try:
-            args = [MONITOR_CMD]
-            if MONITOR_CHECK_USER:
-                args += ["--user", MONITOR_CHECK_USER]
-            rc, out = run_cmd(args, timeout_sec=max(60, min(MONITOR_INTERVAL_SEC, 180)))
-            now = int(time.time())
-            sig = f"{rc}:{(out or '')[:300]}"
-
-            if rc == 0:
-                if was_bad:
-                    send_admin_alert("✅ Мониторинг: восстановлено. Healthcheck снова OK.")
-                    print("[monitor] recovered", file=sys.stderr, flush=True)
-                was_bad = False
-            else:
-                need_alert = (not was_bad) or (sig != last_bad_sig and (now - last_bad_at) >= MONITOR_COOLDOWN_SEC)
-                if need_alert:
-                    msg = "🚨 Мониторинг: проблема на VPN-узлах.\n\n" + (out[:2500] if out else f"rc={rc}")
-                    send_admin_alert(msg)
-                    last_bad_at = now
-                    last_bad_sig = sig
-                    print("[monitor] alerted", file=sys.stderr, flush=True)
-                was_bad = True
-        except Exception as e:
-            print(f"[monitor-loop-error] {e}", file=sys.stderr, flush=True)
-            traceback.print_exc()
 
-        time.sleep(max(30, MONITOR_INTERVAL_SEC))
+def monitor_loop():
+    run_job_forever(monitor_job())
 
 
-def replica_monitor_loop():
+def replica_monitor_tick(state: dict):
+    now = int(time.time())
+    for code, label, host in state["nodes"]:
+        st = state["states"].setdefault(code, {"was_bad": False, "last_bad_at": 0, "last_bad_sig": ""})
+        args = [REPLICA_MONITOR_CMD, "--node", code]
+        if MONITOR_CHECK_USER:
+            args += ["--user", MONITOR_CHECK_USER]
+        rc, out = run_cmd(args, timeout_sec=max(60, min(REPLICA_MONITOR_INTERVAL_SEC, 180)))
+        sig = f"{rc}:{(out or '')[:300]}"
+
+        if rc == 0:
+            if st["was_bad"]:
+                send_admin_alert(f"✅ Мониторинг реплики {label}: восстановлено ({host}).")
+                print(f"[replica-monitor] recovered node={code}", file=sys.stderr, flush=True)
+            st["was_bad"] = False
+            continue
+
+        need_alert = (not st["was_bad"]) or (
+            sig != st["last_bad_sig"] and (now - int(st["last_bad_at"] or 0)) >= REPLICA_MONITOR_COOLDOWN_SEC
+        )
+        if need_alert:
+            msg = f"🚨 Мониторинг реплики {label}: проблема ({host}).\n\n" + (out[:2500] if out else f"rc={rc}")
+            send_admin_alert(msg)
+            st["last_bad_at"] = now
+            st["last_bad_sig"] = sig
+            print(f"[replica-monitor] alerted node={code}", file=sys.stderr, flush=True)
+        st["was_bad"] = True
+
+
+def replica_monitor_job():
     if not REPLICA_MONITOR_ENABLED:
         print("[replica-monitor] disabled", file=sys.stderr, flush=True)
-        return
+        return None
 
     nodes = []
     if UK_HOST:
@@ -1673,7 +3538,7 @@ def replica_monitor_loop():
         nodes.append(("tr", "TR", TR_HOST))
     if not nodes:
         print("[replica-monitor] no replica hosts configured", file=sys.stderr, flush=True)
-        return
+        return None
 
     states = {code: {"was_bad": False, "last_bad_at": 0, "last_bad_sig": ""} for code, _label, _host in nodes}
     print(
@@ -1681,79 +3546,102 @@ def replica_monitor_loop():
         file=sys.stderr,
         flush=True,
     )
+    return periodic_job(
+        "replica-monitor",
+        max(30, REPLICA_MONITOR_INTERVAL_SEC),
+        replica_monitor_tick,
+        "[replica-monitor-loop-error]",
+        state={"nodes": nodes, "states": states},
+    )
 
-    while True:
-        try:
-            now = int(time.time())
-            for code, label, host in nodes:
-                st = states.setdefault(code, {"was_bad": False, "last_bad_at": 0, "last_bad_sig": ""})
-                args = [REPLICA_MONITOR_CMD, "--node", code]
-                if MONITOR_CHECK_USER:
-                    args += ["--user", MONITOR_CHECK_USER]
-                rc, out = run_cmd(args, timeout_sec=max(60, min(REPLICA_MONITOR_INTERVAL_SEC, 180)))
-                sig = f"{rc}:{(out or '')[:300]}"
-
-                if rc == 0:
-                    if st["was_bad"]:
-                        send_admin_alert(f"✅ Мониторинг реплики {label}: восстановлено ({host}).")
-                        print(f"[replica-monitor] recovered node={code}", file=sys.stderr, flush=True)
-                    st["was_bad"] = False
-                    continue
 
-                need_alert = (not st["was_bad"]) or (
-                    sig != st["last_bad_sig"] and (now - int(st["last_bad_at"] or 0)) >= REPLICA_MONITOR_COOLDOWN_SEC
-                )
-                if need_alert:
-                    msg = f"🚨 Мониторинг реплики {label}: проблема ({host}).\n\n" + (out[:2500] if out else f"rc={rc}")
-                    send_admin_alert(msg)
-                    st["last_bad_at"] = now
-                    st["last_bad_sig"] = sig
-                    print(f"[replica-monitor] alerted node={code}", file=sys.stderr, flush=True)
-                st["was_bad"] = True
-        except Exception as e:
-            print(f"[replica-monitor-loop-error] {e}", file=sys.stderr, flush=True)
-            traceback.print_exc()
+def replica_monitor_loop():
+    run_job_forever(replica_monitor_job())
 
-        time.sleep(max(30, REPLICA_MONITOR_INTERVAL_SEC))
 
+def traffic_report_tick(state: dict):
+    conn = state_db(state)
+    now_ts = int(time.time())
+    now_local = datetime.fromtimestamp(now_ts, tz=timezone.utc).astimezone()
+    today = now_local.strftime("%Y-%m-%d")
+    last_sent = get_kv(conn, "traffic_report_last_date", default="")
+    if (now_local.hour > TRAFFIC_REPORT_HOUR) or (
+        now_local.hour == TRAFFIC_REPORT_HOUR and now_local.minute >= TRAFFIC_REPORT_MINUTE
+    ):
+        if last_sent != today:
+            text = build_node_traffic_report_text(conn, now_ts=now_ts)
+            send_admin_alert(text)
+            set_kv(conn, "traffic_report_last_date", today)
+            print(f"[traffic-report] sent date={today}", file=sys.stderr, flush=True)
 
-def traffic_report_loop():
+
+def traffic_report_job():
     if not TRAFFIC_REPORT_ENABLED:
         print("[traffic-report] disabled", file=sys.stderr, flush=True)
-        return
-    conn = sqlite3.connect(DB_PATH)
-    init_db(conn)
+        return None
     print(
         f"[traffic-report] enabled interval={TRAFFIC_REPORT_INTERVAL_SEC}s at={TRAFFIC_REPORT_HOUR:02d}:{TRAFFIC_REPORT_MINUTE:02d}",
         file=sys.stderr,
         flush=True,
     )
-    while True:
-        try:
-            now_ts = int(time.time())
-            now_local = datetime.fromtimestamp(now_ts, tz=timezone.utc).astimezone()
-            today = now_local.strftime("%Y-%m-%d")
-            last_sent = get_kv(conn, "traffic_report_last_date", default="")
-            if (now_local.hour > TRAFFIC_REPORT_HOUR) or (
-                now_local.hour == TRAFFIC_REPORT_HOUR and now_local.minute >= TRAFFIC_REPORT_MINUTE
-            ):
-                if last_sent != today:
-                    text = build_node_traffic_report_text(conn, now_ts=now_ts)
-                    send_admin_alert(text)
-                    set_kv(conn, "traffic_report_last_date", today)
-                    print(f"[traffic-report] sent date={today}", file=sys.stderr, flush=True)
-        except Exception as e:
-            print(f"[traffic-report-loop-error] {e}", file=sys.stderr, flush=True)
-            traceback.print_exc()
-        time.sleep(max(60, TRAFFIC_REPORT_INTERVAL_SEC))
+    return periodic_job("traffic-report", max(60, TRAFFIC_REPORT_INTERVAL_SEC), traffic_report_tick, "[traffic-report-loop-error]")
 
 
-def traffic_anomaly_loop():
+def traffic_report_loop():
+    run_job_forever(traffic_report_job())
+
+
+def traffic_anomaly_tick(state: dict):
+    conn = state_db(state)
+    last_alert_at = state["last_alert_at"]
+    now_ts = int(time.time())
+    win_sec = max(300, int(TRAFFIC_ANOMALY_WINDOW_MIN) * 60)
+    end_ts = traffic_anchor_ts(conn)
+    wins = traffic_windows(conn, {"cur": (end_ts - win_sec, end_ts), "prev": (end_ts - 2 * win_sec, end_ts - win_sec)})
+    cur_total, cur_nodes = _traffic_node_totals(conn, wins["cur"])
+    prev_total, _prev_nodes = _traffic_node_totals(conn, wins["prev"])
+    min_total_bytes = max(1, int(TRAFFIC_ANOMALY_MIN_TOTAL_MB)) * 1024 * 1024
+    if prev_total > 0:
+        ratio = float(cur_total) / float(prev_total)
+        if cur_total >= min_total_bytes and ratio >= float(TRAFFIC_ANOMALY_RATIO):
+            if (now_ts - int(last_alert_at.get("traffic") or 0)) >= TRAFFIC_ANOMALY_COOLDOWN_SEC:
+                top_nodes = sorted(cur_nodes.items(), key=lambda x: int(x[1] or 0), reverse=True)[:3]
+                top_txt = ", ".join([f"{n}={_fmt_bytes(v)}" for n, v in top_nodes]) if top_nodes else "n/a"
+                send_admin_alert(
+                    "🚨 Аномалия трафика.\n"
+                    f"Окно: {TRAFFIC_ANOMALY_WINDOW_MIN} мин\n"
+                    f"Текущее: {_fmt_bytes(cur_total)}\n"
+                    f"Предыдущее: {_fmt_bytes(prev_total)}\n"
+                    f"Рост: x{ratio:.2f}\n"
+                    f"Узлы: {top_txt}"
+                )
+                last_alert_at["traffic"] = now_ts
+                print("[traffic-anomaly] alerted traffic spike", file=sys.stderr, flush=True)
+
+    if LIVE_ONLINE_ENABLED:
+        live = get_live_online_snapshot(force=True)
+        cur_live = len(live.get("all_users") or set())
+        last_live_count = state["last_live_count"]
+        if last_live_count is not None:
+            delta = int(cur_live) - int(last_live_count)
+            if int(cur_live) >= CONN_SPIKE_MIN_ONLINE and delta >= CONN_SPIKE_DELTA:
+                if (now_ts - int(last_alert_at.get("connections") or 0)) >= TRAFFIC_ANOMALY_COOLDOWN_SEC:
+                    send_admin_alert(
+                        "🚨 Всплеск live-сессий.\n"
+                        f"Сейчас: {cur_live}\n"
+                        f"Было: {last_live_count}\n"
+                        f"Δ: +{delta}\n"
+                        f"Окно проверки: {LIVE_ONLINE_SAMPLE_SEC} сек"
+                    )
+                    last_alert_at["connections"] = now_ts
+                    print("[traffic-anomaly] alerted connection spike", file=sys.stderr, flush=True)
+        state["last_live_count"] = int(cur_live)
+
+
+def traffic_anomaly_job():
     if not TRAFFIC_ANOMALY_ENABLED:
         print("[traffic-anomaly] disabled", file=sys.stderr, flush=True)
-        return
-    conn = sqlite3.connect(DB_PATH)
-    init_db(conn)
+        return None
     print(
         "[traffic-anomaly] enabled "
         f"interval={TRAFFIC_ANOMALY_INTERVAL_SEC}s "
@@ -1764,144 +3652,438 @@ def traffic_anomaly_loop():
         file=sys.stderr,
         flush=True,
     )
-    last_alert_at = {"traffic": 0, "connections": 0}
-    last_live_count = None
-    while True:
-        try:
-            now_ts = int(time.time())
-            win_sec = max(300, int(TRAFFIC_ANOMALY_WINDOW_MIN) * 60)
-            cur_total, cur_nodes = _traffic_total_between(conn, now_ts - win_sec, now_ts)
-            prev_total, _prev_nodes = _traffic_total_between(conn, now_ts - 2 * win_sec, now_ts - win_sec)
-            min_total_bytes = max(1, int(TRAFFIC_ANOMALY_MIN_TOTAL_MB)) * 1024 * 1024
-            if prev_total > 0:
-                ratio = float(cur_total) / float(prev_total)
-                if cur_total >= min_total_bytes and ratio >= float(TRAFFIC_ANOMALY_RATIO):
-                    if (now_ts - int(last_alert_at.get("traffic") or 0)) >= TRAFFIC_ANOMALY_COOLDOWN_SEC:
-                        top_nodes = sorted(cur_nodes.items(), key=lambda x: int(x[1] or 0), reverse=True)[:3]
-                        top_txt = ", ".join([f"{n}={_fmt_bytes(v)}" for n, v in top_nodes]) if top_nodes else "n/a"
-                        send_admin_alert(
-                            "🚨 Аномалия трафика.\n"
-                            f"Окно: {TRAFFIC_ANOMALY_WINDOW_MIN} мин\n"
-                            f"Текущее: {_fmt_bytes(cur_total)}\n"
-                            f"Предыдущее: {_fmt_bytes(prev_total)}\n"
-                            f"Рост: x{ratio:.2f}\n"
-                            f"Узлы: {top_txt}"
-                        )
-                        last_alert_at["traffic"] = now_ts
-                        print("[traffic-anomaly] alerted traffic spike", file=sys.stderr, flush=True)
-
-            if LIVE_ONLINE_ENABLED:
-                live = get_live_online_snapshot(force=True)
-                cur_live = len(live.get("all_users") or set())
-                if last_live_count is not None:
-                    delta = int(cur_live) - int(last_live_count)
-                    if int(cur_live) >= CONN_SPIKE_MIN_ONLINE and delta >= CONN_SPIKE_DELTA:
-                        if (now_ts - int(last_alert_at.get("connections") or 0)) >= TRAFFIC_ANOMALY_COOLDOWN_SEC:
-                            send_admin_alert(
-                                "🚨 Всплеск live-сессий.\n"
-                                f"Сейчас: {cur_live}\n"
-                                f"Было: {last_live_count}\n"
-                                f"Δ: +{delta}\n"
-                                f"Окно проверки: {LIVE_ONLINE_SAMPLE_SEC} сек"
-                            )
-                            last_alert_at["connections"] = now_ts
-                            print("[traffic-anomaly] alerted connection spike", file=sys.stderr, flush=True)
-                last_live_count = int(cur_live)
-        except Exception as e:
-            print(f"[traffic-anomaly-loop-error] {e}", file=sys.stderr, flush=True)
-            traceback.print_exc()
-        time.sleep(max(60, TRAFFIC_ANOMALY_INTERVAL_SEC))
+    state = {"last_alert_at": {"traffic": 0, "connections": 0}, "last_live_count": None}
+    return periodic_job(
+        "traffic-anomaly", max(60, TRAFFIC_ANOMALY_INTERVAL_SEC), traffic_anomaly_tick, "[traffic-anomaly-loop-error]", state=state
+    )
+
+
+def traffic_anomaly_loop():
+    run_job_forever(traffic_anomaly_job())
+
+
+def trial_notice_tick(state: dict):
+    conn = state_db(state)
+    now = int(time.time())
+    notices = []
+    trials = {c["name"]: c for c in clients_registry.trials_expiring_before(now + 6 * 3600)}
+    if not trials:
+        return
+    cur = conn.execute("SELECT tg_id, vpn_name FROM tg_users")
+    rows = cur.fetchall()
+    for tg_id, vpn_name in rows:
+        row = trials.get(vpn_name or "")
+        if not row:
+            continue
+        if not bool(row.get("trial", False)):
+            continue
+
+        exp = int(row.get("expire") or 0)
+        if exp <= 0:
+            continue
+        left = exp - now
+
+        if 0 < left <= 6 * 3600:
+            kind = "trial_6h"
+            if not trial_notice_already_sent(conn, int(tg_id), kind, exp):
+                notices.append(
+                    (
+                        int(tg_id),
+                        kind,
+                        exp,
+                        "⏰ Пробный доступ скоро завершится (меньше 6 часов).\n"
+                        "Чтобы продолжить пользоваться VPN без перерыва, продлите подписку.",
+                    )
+                )
+        elif left <= 0:
+            kind = "trial_expired"
+            if not trial_notice_already_sent(conn, int(tg_id), kind, exp):
+                notices.append(
+                    (
+                        int(tg_id),
+                        kind,
+                        exp,
+                        "⛔ Пробный доступ завершен.\n"
+                        "Чтобы восстановить доступ, оплатите подписку.",
+                    )
+                )
+
+    if notices:
+        # Queued in one batch; the outbox persists them, so marking as sent right away is safe.
+        done = send_messages_bulk([(tg_id, text, kb_pay()) for tg_id, _kind, _exp, text in notices], priority=OUTBOX_PRIO_BULK)
+        for i in done:
+            tg_id, kind, exp, _text = notices[i]
+            mark_trial_notice_sent(conn, tg_id, kind, exp)
+
+
+def trial_notice_job():
+    return periodic_job("trial-notice", 300, trial_notice_tick, "[trial-notice-loop-error]")
 
 
 def trial_notice_loop():
-    conn = sqlite3.connect(DB_PATH)
-    init_db(conn)
-    while True:
-        try:
-            now = int(time.time())
-            # Build quick map by vpn_name.
-            by_name = {}
-            for c in load_clients():
-                nm = (c.get("name") or "").strip()
-                if nm:
-                    by_name[nm] = c
-
-            cur = conn.execute("SELECT tg_id, vpn_name FROM tg_users")
-            rows = cur.fetchall()
-            for tg_id, vpn_name in rows:
-                row = by_name.get(vpn_name or "")
-                if not row:
-                    continue
-                if not bool(row.get("trial", False)):
-                    continue
+    run_job_forever(trial_notice_job())
 
-                exp = int(row.get("expire") or 0)
-                if exp <= 0:
-                    continue
-                left = exp - now
-
-                if 0 < left <= 6 * 3600:
-                    kind = "trial_6h"
-                    if not trial_notice_already_sent(conn, int(tg_id), kind, exp):
-                        send_message(
-                            int(tg_id),
-                            "⏰ Пробный доступ скоро завершится (меньше 6 часов).\n"
-                            "Чтобы продолжить пользоваться VPN без перерыва, продлите подписку.",
-                            kb_pay(),
-                        )
-                        mark_trial_notice_sent(conn, int(tg_id), kind, exp)
-                elif left <= 0:
-                    kind = "trial_expired"
-                    if not trial_notice_already_sent(conn, int(tg_id), kind, exp):
-                        send_message(
-                            int(tg_id),
-                            "⛔ Пробный доступ завершен.\n"
-                            "Чтобы восстановить доступ, оплатите подписку.",
-                            kb_pay(),
-                        )
-                        mark_trial_notice_sent(conn, int(tg_id), kind, exp)
+
+# clients.json is shared with nginx njs and the vless-* scripts. The bot keeps the authoritative
+# copy in the `clients` table and exports the file only when rows change.
+CLIENT_COLUMNS = ("uuid", "token", "expire", "revoked", "trial")
+_CLIENT_SELECT = "SELECT name, uuid, token, expire, revoked, trial, extra, rev FROM clients"
+
+
+def _client_to_db(c: dict):
+    extra = {k: v for k, v in c.items() if k != "name" and k not in CLIENT_COLUMNS}
+    return (
+        None if c.get("uuid") is None else str(c.get("uuid")),
+        None if c.get("token") is None else str(c.get("token")),
+        None if c.get("expire") is None else int(c.get("expire") or 0),
+        None if c.get("revoked") is None else int(bool(c.get("revoked"))),
+        None if c.get("trial") is None else int(bool(c.get("trial"))),
+        json.dumps(extra, ensure_ascii=False, sort_keys=True) if extra else "",
+    )
+
+
+def _client_from_db(r):
+    # Same key order as vless-add-user writes; absent keys stay absent.
+    name, uid, token, expire, revoked, trial, extra = r[:7]
+    c = {"name": name}
+    if uid is not None:
+        c["uuid"] = uid
+    if token is not None:
+        c["token"] = token
+    if expire is not None:
+        c["expire"] = int(expire)
+    if revoked is not None:
+        c["revoked"] = bool(revoked)
+    if trial is not None:
+        c["trial"] = bool(trial)
+    if extra:
+        try:
+            c.update(json.loads(extra))
+        except Exception:
+            pass
+    return c
+
+
+# Client rows backed by the `clients` table, with clients.json maintained as an export.
+# vless-add-user/vless-del-user/vless-sync-expire (and admins on the host) still edit clients.json, so every
+# read compares the file's (inode, mtime, size) with the last export and imports it when it differs.
+# Rows changed by the bot and not exported yet win over the file. Writers hold db_write() and then self.lock.
+class ClientRegistry:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.rev = 0
+        self.exported_rev = 0
+        self.export_sig = None
+        self.frags = {}
+        self.timer = None
+        self.stats = {"imports": 0, "exports": 0, "serialized": 0, "commits": 0, "export_ms_max": 0}
+
+    def _stat_sig(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return f"{st.st_ino}:{st.st_mtime_ns}:{st.st_size}"
+
+    def _load_state(self, conn: sqlite3.Connection):
+        # Caller holds self.lock.
+        if self.loaded:
+            return
+        try:
+            st = json.loads(get_kv(conn, "clients_store", "{}") or "{}")
+        except Exception:
+            st = {}
+        self.rev = int(st.get("rev") or 0)
+        self.exported_rev = int(st.get("exported_rev") or 0)
+        self.export_sig = st.get("sig") or None
+        self.loaded = True
+
+    def _save_state(self, conn: sqlite3.Connection):
+        state = {"rev": self.rev, "exported_rev": self.exported_rev, "sig": self.export_sig}
+        put_kv(conn, "clients_store", json.dumps(state))
+
+    def _fresh(self):
+        conn = db_conn()
+        sig = self._stat_sig()
+        if self.loaded and (sig is None or sig == self.export_sig):
+            return conn
+        with db_write(conn):
+            with self.lock:
+                self._load_state(conn)
+                sig = self._stat_sig()
+                if sig is not None and sig != self.export_sig:
+                    self._import(conn, sig)
+        return conn
+
+    def refresh(self):
+        # Import clients.json now if something outside the bot changed it.
+        self._fresh()
+
+    def _import(self, conn: sqlite3.Connection, sig: str):
+        try:
+            rows = json.loads(Path(self.path).read_text(encoding="utf-8"))
         except Exception as e:
-            print(f"[trial-notice-loop-error] {e}", file=sys.stderr, flush=True)
-            traceback.print_exc()
+            # The scripts rewrite the file in place: a partial read is retried on the next access.
+            print(f"[clients] import skipped: {e}", file=sys.stderr, flush=True)
+            return
+        if not isinstance(rows, list):
+            return
+        current = {r[0]: r for r in conn.execute("SELECT name, uuid, token, expire, revoked, trial, extra, pos, rev FROM clients")}
+        now = int(time.time())
+        rev = self.rev + 1
+        seen = set()
+        changed = 0
+        local_wins = 0
+        for pos, c in enumerate(rows):
+            name = (c.get("name") or "").strip() if isinstance(c, dict) else ""
+            if not name or name in seen:
+                continue
+            seen.add(name)
+            vals = _client_to_db(c)
+            cur = current.get(name)
+            if cur is not None and int(cur[8]) > self.exported_rev:
+                local_wins += 1
+                if int(cur[7]) != pos:
+                    conn.execute("UPDATE clients SET pos=? WHERE name=?", (pos, name))
+                continue
+            if cur is not None and tuple(cur[1:7]) == vals:
+                if int(cur[7]) != pos:
+                    conn.execute("UPDATE clients SET pos=? WHERE name=?", (pos, name))
+                continue
+            conn.execute(
+                """
+                INSERT INTO clients (name, uuid, token, expire, revoked, trial, extra, pos, rev, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    uuid=excluded.uuid, token=excluded.token, expire=excluded.expire, revoked=excluded.revoked,
+                    trial=excluded.trial, extra=excluded.extra, pos=excluded.pos, rev=excluded.rev, updated_at=excluded.updated_at
+                """,
+                (name, *vals, pos, rev, now),
+            )
+            changed += 1
+        gone = [(name,) for name in current if name not in seen]
+        if gone:
+            conn.executemany("DELETE FROM clients WHERE name=?", gone)
+            changed += len(gone)
+        if changed:
+            self.rev = rev
+        if not local_wins:
+            self.exported_rev = self.rev
+        self.export_sig = sig
+        self._save_state(conn)
+        self.stats["imports"] += 1
+        if changed:
+            print(f"[clients] imported clients.json changed={changed} total={len(seen)}", file=sys.stderr, flush=True)
+
+    def _export(self, conn: sqlite3.Connection):
+        # Caller holds db_write() and self.lock. Unchanged rows reuse their cached JSON fragment.
+        if self.rev == self.exported_rev and self.export_sig is not None:
+            return
+        t0 = time.monotonic()
+        frags = {}
+        parts = []
+        for r in conn.execute(_CLIENT_SELECT + " ORDER BY pos, name"):
+            cached = self.frags.get(r[0])
+            if cached is None or cached[0] != int(r[7]):
+                cached = (int(r[7]), json.dumps(_client_from_db(r), ensure_ascii=False, indent=2).replace("\n", "\n  "))
+                self.stats["serialized"] += 1
+            frags[r[0]] = cached
+            parts.append(cached[1])
+        # Byte-identical to json.dumps(clients, ensure_ascii=False, indent=2).
+        text = "[\n  " + ",\n  ".join(parts) + "\n]\n" if parts else "[]\n"
+        _write_clients_atomic(text.encode("utf-8"))
+        self.frags = frags
+        self.exported_rev = self.rev
+        self.export_sig = self._stat_sig()
+        self._save_state(conn)
+        self.stats["exports"] += 1
+        self.stats["export_ms_max"] = max(self.stats["export_ms_max"], int((time.monotonic() - t0) * 1000))
+
+    def _query(self, where: str = "", params: tuple = (), limit: int = 0):
+        conn = self._fresh()
+        sql = _CLIENT_SELECT + (f" WHERE {where}" if where else "") + " ORDER BY pos, name"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return [_client_from_db(r) for r in conn.execute(sql, params).fetchall()]
+
+    def _one(self, where: str, params: tuple):
+        rows = self._query(where, params, limit=1)
+        return rows[0] if rows else None
+
+    def all(self):
+        return self._query()
+
+    def get(self, name: str):
+        return self._one("name=?", (name or "",))
+
+    def get_by_token(self, token: str):
+        return self._one("token=?", (token or "",))
+
+    def get_by_uuid(self, uid: str):
+        return self._one("uuid=?", (uid or "",))
+
+    def resolve_name(self, key: str):
+        row = self.get(key) or self.get_by_token(key)
+        return (row.get("name") or "").strip() if row else ""
+
+    def select(self, filter_mode: str = "all"):
+        if filter_mode == "only_blocked":
+            return self._query("revoked=1")
+        if filter_mode == "only_active":
+            return self._query("COALESCE(revoked, 0)=0")
+        if filter_mode == "only_trial":
+            return self._query("trial=1")
+        return self._query()
+
+    def trials_expiring_before(self, ts: int):
+        return self._query("trial=1 AND expire>0 AND expire<=?", (int(ts),))
+
+    def count(self):
+        return int(self._fresh().execute("SELECT COUNT(*) FROM clients").fetchone()[0])
+
+    def key_map(self):
+        # Subscription key (name or token) -> name, as resolve_name() would answer it.
+        rows = self._fresh().execute("SELECT name, token FROM clients").fetchall()
+        m = {token: name for name, token in rows if token}
+        m.update((name, name) for name, _token in rows)
+        return m
+
+    def apply(self, changes: dict):
+        # Caller holds db_write() and self.lock.
+        conn = self._fresh()
+        rev = self.rev + 1
+        now = int(time.time())
+        for name, fields in changes.items():
+            cols = {k: v for k, v in fields.items() if k in CLIENT_COLUMNS}
+            extra_fields = {k: v for k, v in fields.items() if k not in CLIENT_COLUMNS and k != "name"}
+            if extra_fields:
+                row = conn.execute("SELECT extra FROM clients WHERE name=?", (name,)).fetchone()
+                extra = json.loads(row[0]) if row and row[0] else {}
+                extra.update(extra_fields)
+                cols["extra"] = json.dumps(extra, ensure_ascii=False, sort_keys=True)
+            vals = _client_to_db({k: v for k, v in cols.items() if k != "extra"})
+            sets = []
+            params = []
+            for i, col in enumerate(CLIENT_COLUMNS):
+                if col in cols:
+                    sets.append(f"{col}=?")
+                    params.append(vals[i])
+            if "extra" in cols:
+                sets.append("extra=?")
+                params.append(cols["extra"])
+            sets.append("rev=?")
+            sets.append("updated_at=?")
+            params.extend([rev, now, name])
+            conn.execute(f"UPDATE clients SET {', '.join(sets)} WHERE name=?", params)
+        self.rev = rev
+        self._save_state(conn)
+        self.stats["commits"] += 1
+
+    def flush(self):
+        with db_write() as conn:
+            with self.lock:
+                self.timer = None
+                self._fresh()
+                self._export(conn)
+
+    def schedule_flush(self):
+        # Caller holds self.lock.
+        if self.timer is not None or self.rev == self.exported_rev:
+            return
+        self.timer = threading.Timer(max(0.0, CLIENTS_FLUSH_DELAY_SEC), self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+
+clients_registry = ClientRegistry(CLIENTS_JSON)
 
-        time.sleep(300)
 
+# Field changes to client rows, committed together by clients_batch().
+class ClientsBatch:
+    def __init__(self):
+        self.changes = {}
 
-def load_clients():
+    def get(self, name: str):
+        row = clients_registry.get(name)
+        fields = self.changes.get(name)
+        if row is not None and fields:
+            row.update(fields)
+        return row
+
+    def update(self, name: str, **fields):
+        if clients_registry.get(name) is None:
+            return False
+        self.changes.setdefault(name, {}).update(fields)
+        return True
+
+
+def _write_clients_atomic(data: bytes):
     p = Path(CLIENTS_JSON)
-    if not p.exists():
-        return []
+    tmp = p.with_name(f".{p.name}.bot.tmp")
+    bak = p.with_name(p.name + ".bot.bak")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    if p.exists():
+        st = p.stat()
+        try:
+            os.chmod(tmp, st.st_mode & 0o7777)
+            os.chown(tmp, st.st_uid, st.st_gid)
+        except OSError:
+            pass
+        # Hard link keeps the previous version as .bot.bak without copying it.
+        try:
+            bak.unlink(missing_ok=True)
+            os.link(p, bak)
+        except OSError:
+            bak.write_bytes(p.read_bytes())
+    # rename() is atomic: nginx njs and the vless-* scripts see either the old or the new file.
+    os.replace(tmp, p)
     try:
-        return json.loads(p.read_text(encoding="utf-8"))
-    except Exception:
-        return []
+        dir_fd = os.open(str(p.parent), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+
+@contextlib.contextmanager
+def clients_batch(flush: bool = True):
+    # Collect client changes and commit them in one transaction. With flush=True clients.json is re-exported
+    # before returning; otherwise one deferred export covers every batch within CLIENTS_FLUSH_DELAY_SEC.
+    with db_write(), clients_registry.lock:
+        batch = ClientsBatch()
+        yield batch
+        if batch.changes:
+            clients_registry.apply(batch.changes)
+        if flush:
+            clients_registry.flush()
+        else:
+            clients_registry.schedule_flush()
 
 
-def save_clients(clients: list[dict]):
-    p = Path(CLIENTS_JSON)
-    bak = p.with_name(p.name + ".bot.bak")
-    if p.exists():
-        bak.write_text(p.read_text(encoding="utf-8"), encoding="utf-8")
-    p.write_text(json.dumps(clients, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+def run_clients_cmd(args: list[str], timeout_sec: int):
+    # vless-* scripts read and rewrite clients.json themselves: export pending rows first,
+    # import whatever they changed right after.
+    clients_registry.flush()
+    rc, out = run_cmd(args, timeout_sec=timeout_sec)
+    clients_registry.refresh()
+    return rc, out
 
 
 def get_client_by_name(name: str):
-    for c in load_clients():
-        if (c.get("name") or "") == name:
-            return c
-    return None
+    return clients_registry.get(name)
 
 
 def set_trial_flag(name: str, is_trial: bool):
-    clients = load_clients()
-    changed = False
-    for c in clients:
-        if (c.get("name") or "") == name:
-            c["trial"] = bool(is_trial)
-            changed = True
-            break
-    if changed:
-        save_clients(clients)
+    # Only the bot reads `trial`, so the export may be deferred and coalesced.
+    with clients_batch(flush=False) as batch:
+        changed = batch.update(name, trial=bool(is_trial))
     return changed
 
 
@@ -1917,7 +4099,7 @@ def master_has_vpn_user(name: str):
 
 
 def provision_user(name: str):
-    rc, out = run_cmd([ADD_USER_CMD, "--name", name, "--days", str(FREE_DAYS)], timeout_sec=300)
+    rc, out = run_clients_cmd([ADD_USER_CMD, "--name", name, "--days", str(FREE_DAYS)], timeout_sec=300)
     if rc == 0:
         return True, out
     lowered = out.lower()
@@ -1927,23 +4109,15 @@ def provision_user(name: str):
 
 
 def sync_expire_apply():
-    return run_cmd([SYNC_EXPIRE_CMD, "--apply", "--grace-days", str(SYNC_GRACE_DAYS)], timeout_sec=120)
+    return run_clients_cmd([SYNC_EXPIRE_CMD, "--apply", "--grace-days", str(SYNC_GRACE_DAYS)], timeout_sec=120)
 
 
 def set_user_expire_days(name: str, days: int):
-    clients = load_clients()
-    found = False
-    now_ts = int(time.time())
-    new_exp = now_ts + days * 86400
-    for c in clients:
-        if (c.get("name") or "") == name:
-            c["expire"] = int(new_exp)
-            c["revoked"] = False
-            found = True
-            break
+    new_exp = int(time.time()) + days * 86400
+    with clients_batch() as batch:
+        found = batch.update(name, expire=int(new_exp), revoked=False)
     if not found:
         return False, "Пользователь не найден"
-    save_clients(clients)
     rc, out = sync_expire_apply()
     if rc != 0:
         return False, f"Срок обновлен, но sync завершился с ошибкой:\n{out}"
@@ -1951,20 +4125,14 @@ def set_user_expire_days(name: str, days: int):
 
 
 def extend_user_expire_days(name: str, days: int):
-    clients = load_clients()
-    found = False
     now_ts = int(time.time())
-    for c in clients:
-        if (c.get("name") or "") == name:
-            cur_exp = int(c.get("expire") or 0)
-            base = max(now_ts, cur_exp)
-            c["expire"] = int(base + days * 86400)
-            c["revoked"] = False
-            found = True
-            break
-    if not found:
+    with clients_batch() as batch:
+        row = batch.get(name)
+        if row is not None:
+            base = max(now_ts, int(row.get("expire") or 0))
+            batch.update(name, expire=int(base + days * 86400), revoked=False)
+    if row is None:
         return False, "Пользователь не найден"
-    save_clients(clients)
     rc, out = sync_expire_apply()
     if rc != 0:
         return False, f"Срок продлен, но sync завершился с ошибкой:\n{out}"
@@ -1972,16 +4140,10 @@ def extend_user_expire_days(name: str, days: int):
 
 
 def set_user_blocked(name: str, blocked: bool = True):
-    clients = load_clients()
-    found = False
-    for c in clients:
-        if (c.get("name") or "") == name:
-            c["revoked"] = bool(blocked)
-            found = True
-            break
+    with clients_batch() as batch:
+        found = batch.update(name, revoked=bool(blocked))
     if not found:
         return False, "Пользователь не найден"
-    save_clients(clients)
     rc, out = sync_expire_apply()
     if rc != 0:
         return False, f"Статус изменен, но sync завершился с ошибкой:\n{out}"
@@ -2122,7 +4284,7 @@ def find_subscription_info(vpn_name: str):
 
 
 def count_clients():
-    return len(load_clients())
+    return clients_registry.count()
 
 
 def tg_username_map(conn: sqlite3.Connection):
@@ -2160,19 +4322,13 @@ def parse_positive_int(text: str):
 def build_user_rows(conn: sqlite3.Connection, query: str = "", filter_mode: str = "all"):
     rows = []
     q = (query or "").strip().lower()
-    for c in load_clients():
+    for c in clients_registry.select(filter_mode):
         name = (c.get("name") or "").strip()
         if not name:
             continue
         exp = int(c.get("expire") or 0)
         revoked = bool(c.get("revoked") or False)
         is_trial = bool(c.get("trial", False))
-        if filter_mode == "only_blocked" and not revoked:
-            continue
-        if filter_mode == "only_active" and revoked:
-            continue
-        if filter_mode == "only_trial" and not is_trial:
-            continue
         disp = display_name_for(conn, name)
         searchable = f"{name} {disp}".lower()
         if q and q not in searchable:
@@ -2221,7 +4377,8 @@ def kb_my_devices(vpn_name: str, rows: list[tuple]):
     buttons = []
     for idx, r in enumerate(rows, start=1):
         dkey = (r[0] or "")
-        tok = device_action_token(vpn_name, dkey)
+        # The token is stored with the row; only a row written before it was filled needs hashing.
+        tok = (r[15] if len(r) > 15 else "") or device_action_token(vpn_name, dkey)
         ident = human_device_id(dkey, (r[1] or ""))
         ident_short = _safe_text(ident, 18)
         label = f"Отключить {ident_short} ({idx})"
@@ -2391,7 +4548,317 @@ def kb_selector(rows: list[dict], offset: int, total: int, can_choose: bool):
     return {"inline_keyboard": buttons}
 
 
-def send_message(chat_id: int, text: str, reply_markup: dict, parse_mode: str | None = None):
+# Outbound queue: token buckets per chat and globally, priorities (replies first), 429 retry_after.
+# Replies live only in memory; notices and bulk sends are persisted in `outbox` and survive restarts.
+_outbox_cond = threading.Condition()
+_outbox = {
+    "started": False,
+    "heap": [],
+    "seq": 0,
+    "inflight": set(),
+    "paused_until": 0.0,
+    "global_bucket": {"tokens": OUTBOX_GLOBAL_BURST, "ts": 0.0},
+    "chat_buckets": {},
+    "done_ids": [],
+    "flushed_at": 0.0,
+    "wake": None,
+}
+_outbox_stats = {"enqueued": 0, "sent": 0, "failed": 0, "retried": 0, "rate_limited": 0, "latency_ms_total": 0, "latency_ms_max": 0}
+_outbox_sent_ts = deque(maxlen=4096)
+
+
+def _bucket_wait(bucket: dict, rate: float, burst: float, now: float):
+    if rate <= 0:
+        return 0.0
+    tokens = min(burst, float(bucket["tokens"]) + (now - float(bucket["ts"])) * rate)
+    bucket["tokens"] = tokens
+    bucket["ts"] = now
+    if tokens >= 1.0:
+        return 0.0
+    return (1.0 - tokens) / rate
+
+
+def outbox_stats():
+    now = time.time()
+    with _outbox_cond:
+        st = dict(_outbox_stats)
+        depth = {OUTBOX_PRIO_REPLY: 0, OUTBOX_PRIO_NOTICE: 0, OUTBOX_PRIO_BULK: 0}
+        for prio, _seq, _item in _outbox["heap"]:
+            depth[prio] = depth.get(prio, 0) + 1
+        st["depth"] = depth
+        st["inflight"] = len(_outbox["inflight"])
+        st["last_min"] = sum(1 for ts in _outbox_sent_ts if now - ts <= 60)
+        st["paused_sec"] = max(0, int(_outbox["paused_until"] - now))
+    return st
+
+
+def _outbox_item(chat_id: int, method: str, payload: dict, priority: int):
+    return {
+        "id": None,
+        "seq": None,
+        "chat_id": int(chat_id),
+        "method": method,
+        "payload": payload,
+        "priority": int(priority),
+        "attempts": 0,
+        "not_before": 0.0,
+        "enqueued_at": time.time(),
+        "fallback": None,
+    }
+
+
+def _outbox_push(item: dict):
+    # Caller holds _outbox_cond. A retried item keeps its seq, so it stays ahead of later messages to the same chat.
+    if item.get("seq") is None:
+        _outbox["seq"] += 1
+        item["seq"] = _outbox["seq"]
+    heapq.heappush(_outbox["heap"], (int(item["priority"]), int(item["seq"]), item))
+
+
+def outbox_enqueue_many(items: list[dict]):
+    persist = [it for it in items if int(it["priority"]) > OUTBOX_PRIO_REPLY]
+    if persist:
+        now = int(time.time())
+        with db_write() as db:
+            for it in persist:
+                cur = db.execute(
+                    "INSERT INTO outbox (chat_id, method, payload, priority, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (int(it["chat_id"]), it["method"], json.dumps(it["payload"], ensure_ascii=False), int(it["priority"]), now),
+                )
+                it["id"] = int(cur.lastrowid)
+    with _outbox_cond:
+        for it in items:
+            _outbox_push(it)
+        _outbox_stats["enqueued"] += len(items)
+        _outbox_notify()
+
+
+def _outbox_pick(now: float):
+    # Caller holds _outbox_cond. Returns (item, 0) or (None, seconds to wait).
+    if now < _outbox["paused_until"]:
+        return None, _outbox["paused_until"] - now
+    gw = _bucket_wait(_outbox["global_bucket"], OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_BURST, now)
+    if gw > 0:
+        return None, gw
+    heap = _outbox["heap"]
+    skipped = []
+    blocked = set()
+    wait = 1.0
+    found = None
+    while heap:
+        entry = heapq.heappop(heap)
+        item = entry[2]
+        chat_id = item["chat_id"]
+        if chat_id in blocked or chat_id in _outbox["inflight"]:
+            skipped.append(entry)
+            continue
+        if item["not_before"] > now:
+            wait = min(wait, item["not_before"] - now)
+            blocked.add(chat_id)
+            skipped.append(entry)
+            continue
+        bucket = _outbox["chat_buckets"].setdefault(chat_id, {"tokens": OUTBOX_CHAT_BURST, "ts": now})
+        cw = _bucket_wait(bucket, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, now)
+        if cw > 0:
+            wait = min(wait, cw)
+            blocked.add(chat_id)
+            skipped.append(entry)
+            continue
+        found = item
+        break
+    for entry in skipped:
+        heapq.heappush(heap, entry)
+    if found is None:
+        return None, wait
+    _outbox["global_bucket"]["tokens"] -= 1.0
+    _outbox["chat_buckets"][found["chat_id"]]["tokens"] -= 1.0
+    _outbox["inflight"].add(found["chat_id"])
+    if len(_outbox["chat_buckets"]) > 10000:
+        # Buckets idle long enough to be full again carry no state.
+        idle_sec = OUTBOX_CHAT_BURST / max(OUTBOX_CHAT_RATE, 0.001)
+        for key in [k for k, b in _outbox["chat_buckets"].items() if now - b["ts"] > idle_sec]:
+            _outbox["chat_buckets"].pop(key, None)
+    return found, 0.0
+
+
+def _outbox_flush_done(force: bool = False):
+    with _outbox_cond:
+        ids = _outbox["done_ids"]
+        if not ids or (not force and len(ids) < 50 and time.time() - _outbox["flushed_at"] < 1.0):
+            return
+        _outbox["done_ids"] = []
+        _outbox["flushed_at"] = time.time()
+    with db_write() as db:
+        db.executemany("DELETE FROM outbox WHERE id=?", [(i,) for i in ids])
+
+
+def _outbox_update_row(item: dict, status: str, error: str):
+    if item.get("id") is None:
+        return
+    with db_write() as db:
+        db.execute(
+            "UPDATE outbox SET status=?, attempts=?, not_before=?, last_error=? WHERE id=?",
+            (status, int(item["attempts"]), float(item["not_before"]), (error or "")[:500], int(item["id"])),
+        )
+
+
+def _outbox_notify():
+    # Caller holds _outbox_cond. Wakes sender threads, or the sender tasks under asyncio.
+    _outbox_cond.notify_all()
+    if _outbox["wake"] is not None:
+        _async_rt["loop"].call_soon_threadsafe(_outbox["wake"].set)
+
+
+def _outbox_send(item: dict):
+    try:
+        api_call(item["method"], item["payload"])
+    except Exception as e:
+        _outbox_done(item, e)
+        return
+    _outbox_done(item, None)
+
+
+def _outbox_done(item: dict, exc: Exception | None):
+    # Bookkeeping after one send attempt (exc=None: delivered); touches sqlite only for failures.
+    status = "sent"
+    error = "" if exc is None else str(exc)
+    retry_after = 0
+    if isinstance(exc, TelegramApiError):
+        if exc.error_code == 429 or exc.retry_after > 0:
+            status = "rate_limited"
+            retry_after = max(1, exc.retry_after)
+        elif 400 <= exc.error_code < 500:
+            # Bot blocked, chat not found, bad markup: retrying will not help.
+            status = "failed"
+        else:
+            status = "retry"
+    elif exc is not None:
+        status = "retry"
+    now = time.time()
+    if status == "retry":
+        item["attempts"] += 1
+        if item["attempts"] >= max(1, OUTBOX_MAX_ATTEMPTS):
+            status = "failed"
+        else:
+            item["not_before"] = now + min(300, 2 ** item["attempts"])
+    elif status == "rate_limited":
+        item["not_before"] = now + retry_after
+    with _outbox_cond:
+        _outbox["inflight"].discard(item["chat_id"])
+        if status == "sent":
+            latency_ms = int((now - item["enqueued_at"]) * 1000)
+            _outbox_stats["sent"] += 1
+            _outbox_stats["latency_ms_total"] += latency_ms
+            _outbox_stats["latency_ms_max"] = max(_outbox_stats["latency_ms_max"], latency_ms)
+            _outbox_sent_ts.append(now)
+            if item.get("id") is not None:
+                _outbox["done_ids"].append(int(item["id"]))
+        elif status == "failed":
+            _outbox_stats["failed"] += 1
+        else:
+            if status == "rate_limited":
+                _outbox_stats["rate_limited"] += 1
+                # Flood control applies to the whole bot: pause every sender, not just this chat.
+                _outbox["paused_until"] = max(_outbox["paused_until"], now + retry_after)
+            else:
+                _outbox_stats["retried"] += 1
+            _outbox_push(item)
+        _outbox_notify()
+    if status == "sent":
+        return
+    print(
+        f"[outbox] {status} chat_id={item['chat_id']} method={item['method']} attempts={item['attempts']} err={error[:300]}",
+        file=sys.stderr,
+        flush=True,
+    )
+    _outbox_update_row(item, "failed" if status == "failed" else "pending", error)
+    if status == "failed" and item.get("fallback") is not None:
+        outbox_enqueue_many([item["fallback"]])
+
+
+def outbox_sender_loop():
+    while True:
+        with _outbox_cond:
+            while True:
+                item, wait = _outbox_pick(time.time())
+                if item is not None:
+                    break
+                _outbox_cond.wait(timeout=max(0.01, min(1.0, wait)))
+        try:
+            _outbox_send(item)
+        except Exception as e:
+            print(f"[outbox-sender-error] {e}", file=sys.stderr, flush=True)
+            traceback.print_exc()
+        try:
+            _outbox_flush_done(force=not _outbox["heap"])
+        except Exception as e:
+            print(f"[outbox-flush-error] {e}", file=sys.stderr, flush=True)
+
+
+async def outbox_sender_async():
+    # BOT_RUNTIME=asyncio: same as outbox_sender_loop, but waits on the loop and sends with api_call_async;
+    # only the sqlite bookkeeping of failures and flushes goes to the executor.
+    loop = asyncio.get_running_loop()
+    wake = _outbox["wake"]
+    while True:
+        wake.clear()
+        with _outbox_cond:
+            item, wait = _outbox_pick(time.time())
+        if item is None:
+            try:
+                await asyncio.wait_for(wake.wait(), max(0.01, min(1.0, wait)))
+            except asyncio.TimeoutError:
+                pass
+            continue
+        try:
+            try:
+                await api_call_async(item["method"], item["payload"])
+            except Exception as e:
+                await loop.run_in_executor(None, _outbox_done, item, e)
+            else:
+                _outbox_done(item, None)
+        except Exception as e:
+            print(f"[outbox-sender-error] {e}", file=sys.stderr, flush=True)
+            traceback.print_exc()
+        if _outbox["done_ids"]:
+            try:
+                await loop.run_in_executor(None, _outbox_flush_done, not _outbox["heap"])
+            except Exception as e:
+                print(f"[outbox-flush-error] {e}", file=sys.stderr, flush=True)
+
+
+def start_outbox():
+    if not OUTBOX_ENABLED or _outbox["started"]:
+        return
+    with db_write() as db:
+        db.execute("DELETE FROM outbox WHERE status='failed' AND created_at < ?", (int(time.time()) - 7 * 86400,))
+    rows = db.execute(
+        "SELECT id, chat_id, method, payload, priority, attempts, not_before, created_at FROM outbox WHERE status='pending' ORDER BY id ASC"
+    ).fetchall()
+    with _outbox_cond:
+        for rid, chat_id, method, payload, priority, attempts, not_before, created_at in rows:
+            try:
+                payload_obj = json.loads(payload)
+            except Exception:
+                continue
+            item = _outbox_item(int(chat_id), method, payload_obj, int(priority))
+            item.update(
+                {"id": int(rid), "attempts": int(attempts or 0), "not_before": float(not_before or 0), "enqueued_at": float(created_at or 0)}
+            )
+            _outbox_push(item)
+        _outbox["started"] = True
+    if async_bridge_active():
+        # Under asyncio the senders are tasks on the loop, not threads parked on _outbox_cond.
+        _outbox["wake"] = asyncio.Event()
+        for _ in range(max(1, OUTBOX_SENDERS)):
+            asyncio.run_coroutine_threadsafe(outbox_sender_async(), _async_rt["loop"])
+    else:
+        for _ in range(max(1, OUTBOX_SENDERS)):
+            Thread(target=outbox_sender_loop, daemon=True).start()
+    print(f"[outbox] senders={max(1, OUTBOX_SENDERS)} restored={len(rows)}", file=sys.stderr, flush=True)
+
+
+def _send_message_payload(chat_id: int, text: str, reply_markup: dict, parse_mode: str | None = None):
     payload = {
         "chat_id": chat_id,
         "text": text,
@@ -2400,7 +4867,45 @@ def send_message(chat_id: int, text: str, reply_markup: dict, parse_mode: str |
     }
     if parse_mode:
         payload["parse_mode"] = parse_mode
-    api_call("sendMessage", payload)
+    return payload
+
+
+def _outbox_direct(item: dict):
+    # OUTBOX_ENABLED=0: send inline. Errors are logged, not raised, the same as with the outbox.
+    try:
+        api_call(item["method"], item["payload"])
+        return True
+    except Exception as e:
+        print(f"[send-error] chat_id={item['chat_id']} method={item['method']} err={e}", file=sys.stderr, flush=True)
+    if item.get("fallback") is not None:
+        _outbox_direct(item["fallback"])
+    return False
+
+
+def send_via_outbox(item: dict):
+    # True if the call was queued (or, without the outbox, sent).
+    if not _outbox["started"]:
+        return _outbox_direct(item)
+    outbox_enqueue_many([item])
+    return True
+
+
+def send_message(chat_id: int, text: str, reply_markup: dict, parse_mode: str | None = None, priority: int = OUTBOX_PRIO_REPLY):
+    # Delivery errors never reach the caller: the outbox retries, logs and finally drops failed messages
+    # (with OUTBOX_ENABLED=0 the call is made inline and a failure is only logged), so no try/except is needed.
+    send_via_outbox(_outbox_item(chat_id, "sendMessage", _send_message_payload(chat_id, text, reply_markup, parse_mode), priority))
+
+
+def send_messages_bulk(messages: list[tuple], priority: int = OUTBOX_PRIO_BULK):
+    # Returns indexes of messages that were sent or queued.
+    items = [
+        _outbox_item(int(chat_id), "sendMessage", _send_message_payload(int(chat_id), text, reply_markup), priority)
+        for chat_id, text, reply_markup in messages
+    ]
+    if not _outbox["started"]:
+        return [i for i, item in enumerate(items) if _outbox_direct(item)]
+    outbox_enqueue_many(items)
+    return list(range(len(items)))
 
 
 def answer_callback(callback_query_id: str, text: str = ""):
@@ -2445,10 +4950,7 @@ def show_my_subscription(conn: sqlite3.Connection, msg: dict):
         return
 
     vpn_name = row[2]
-    try:
-        ingest_device_log(conn)
-    except Exception as e:
-        print(f"[device-ingest-error] {e}", file=sys.stderr, flush=True)
+    refresh_device_log(conn)
     active_devices = count_active_devices(conn, vpn_name)
     info = find_subscription_info(vpn_name)
     if not info:
@@ -2502,10 +5004,7 @@ def show_my_devices(conn: sqlite3.Connection, msg: dict):
         send_message(chat_id, "Подписка не найдена. Нажми /start", kb_main(is_admin=is_admin_user(user)))
         return
     vpn_name = row[2]
-    try:
-        ingest_device_log(conn)
-    except Exception as e:
-        print(f"[device-ingest-error] {e}", file=sys.stderr, flush=True)
+    refresh_device_log(conn)
     rows = get_devices_for_user(conn, vpn_name, limit=DEVICE_LIST_LIMIT)
     if not rows:
         send_message(
@@ -2521,9 +5020,8 @@ def show_my_devices(conn: sqlite3.Connection, msg: dict):
     ]
     lines.append("")
     for i, r in enumerate(rows, start=1):
-        device_key, hwid, ua, ip, platform, os_name, os_version, device_model, app_version, lang, first_seen, last_seen, hits, pending = r
+        device_key, hwid, ua, ip, platform, os_name, os_version, device_model, app_version, lang, first_seen, last_seen, hits, pending, title = r
         ident = human_device_id(device_key, hwid)
-        title = human_device_title(platform, os_name, os_version, device_model, ua)
         name = title or f"Устройство {i}"
         lines.append(f"<b>{html.escape(_safe_text(name, 100))}</b>")
         lines.append(f"Дата подключения: {_fmt_ts(int(last_seen or 0))}")
@@ -2555,15 +5053,19 @@ def show_pay_plan(msg: dict, months: int):
 
 def start_stars_payment(msg: dict, months: int):
     chat_id = int(msg["chat"]["id"])
-    try:
-        send_stars_invoice(chat_id, months)
-    except Exception as e:
-        print(f"[stars-invoice-error] months={months} err={e}", file=sys.stderr, flush=True)
-        send_message(
-            chat_id,
-            "❌ Не удалось открыть оплату Stars.\nПроверь настройки платежей в BotFather или попробуй позже.",
-            kb_pay(),
-        )
+    fallback = _outbox_item(
+        chat_id,
+        "sendMessage",
+        _send_message_payload(
+            chat_id, "❌ Не удалось открыть оплату Stars.\nПроверь настройки платежей в BotFather или попробуй позже.", kb_pay()
+        ),
+        OUTBOX_PRIO_REPLY,
+    )
+    if months not in PAYMENT_PLANS:
+        print(f"[stars-invoice-error] unknown plan months={months}", file=sys.stderr, flush=True)
+        send_via_outbox(fallback)
+        return
+    send_stars_invoice(chat_id, months, fallback)
 
 
 def show_support(msg: dict):
@@ -2577,10 +5079,75 @@ def show_admin(msg: dict):
         send_message(chat_id, "Эта команда только для администратора.", kb_main(is_admin=False))
         return
     total = count_clients()
-    text = f"Админка\nВсего пользователей: {total}\n\nВыберите раздел:"
+    online = online_users_count(db_conn())
+    text = f"Админка\nВсего пользователей: {total}\nОнлайн ({int(ONLINE_WINDOW_SEC / 60)} мин): {online}\n\nВыберите раздел:"
     send_message(chat_id, text, kb_admin())
 
 
+def bot_metrics_lines():
+    http_st = tg_http_stats()
+    upd_st = dispatch_stats()
+    done = int(upd_st["done"] or 0)
+    avg_ms = int(upd_st["handler_ms_total"] / done) if done > 0 else 0
+    lines = [
+        "🤖 Бот",
+        (
+            f"Telegram API: запросов {http_st['requests']}, соединений {http_st['connects']}, "
+            f"повторно {http_st['reused']}, переподключений {http_st['reconnects']}, ошибок {http_st['errors']}"
+        ),
+        (
+            f"Апдейты: в очереди {upd_st['queued']} (макс {upd_st['max_queued']}), в работе {upd_st['busy']}, "
+            f"обработано {done}, ошибок {upd_st['errors']}, среднее {avg_ms} мс, макс {upd_st['handler_ms_max']} мс"
+        ),
+    ]
+    d_st = db_stats()
+    lines.append(
+        f"SQLite: соединений {d_st['opened']}, коммитов {d_st['commits']} ({d_st['commits_last_min'] / 60:.1f}/с за минуту), "
+        f"отложено {d_st['deferred']}, транзакций записи {d_st['writes']}, "
+        f"ожидание блокировки макс {d_st['write_wait_ms_max']} мс (долгих {d_st['slow_waits']}), "
+        f"удержание макс {d_st['write_hold_ms_max']} мс"
+    )
+    ing_st = ingest_stats()
+    if ing_st["runs"]:
+        lines.append(
+            f"Лог устройств: строк {ing_st['lines']}, хитов {ing_st['parsed']}, "
+            f"{ing_st['bytes'] // 1024} КБ, последний проход {ing_st['last_lines_per_sec']} строк/с"
+        )
+    if _device_ingest_rt["running"]:
+        lines.append(device_ingest_status_line(db_conn()))
+    if _device_socket["started"]:
+        lines.append(
+            f"Сокет устройств: датаграмм {_device_socket['datagrams']}, хитов {_device_socket['parsed']}, "
+            f"пакетов {_device_socket['flushes']}, ошибок {_device_socket['errors']}"
+        )
+    if _traffic_windows["passes"]:
+        lines.append(
+            f"Окна трафика: проходов {_traffic_windows['passes']}, строк {_traffic_windows['rows']}, "
+            f"из кэша {_traffic_windows['hits']}"
+        )
+    lines.extend(traffic_poll_lines())
+    reg_st = dict(clients_registry.stats)
+    lines.append(
+        f"Клиенты: {clients_registry.count()}, изменений {reg_st['commits']}, импортов clients.json {reg_st['imports']}, "
+        f"экспортов {reg_st['exports']} (макс {reg_st['export_ms_max']} мс, сериализовано строк {reg_st['serialized']})"
+    )
+    if _outbox["started"]:
+        ob_st = outbox_stats()
+        sent = int(ob_st["sent"] or 0)
+        ob_avg_ms = int(ob_st["latency_ms_total"] / sent) if sent > 0 else 0
+        depth = ob_st["depth"]
+        lines.append(
+            f"Очередь отправки: ответы {depth.get(OUTBOX_PRIO_REPLY, 0)}, уведомления {depth.get(OUTBOX_PRIO_NOTICE, 0)}, "
+            f"рассылки {depth.get(OUTBOX_PRIO_BULK, 0)}, отправлено {sent} ({ob_st['last_min']}/мин), "
+            f"повторов {ob_st['retried']}, 429: {ob_st['rate_limited']}, ошибок {ob_st['failed']}, "
+            f"задержка ср {ob_avg_ms} мс / макс {ob_st['latency_ms_max']} мс"
+        )
+    if UPDATES_MODE == "webhook":
+        wh_st = webhook_stats()
+        lines.append(f"Webhook: принято {wh_st['accepted']}, отклонено {wh_st['rejected']}, дублей {wh_st['duplicates']}")
+    return lines
+
+
 def show_admin_status(msg: dict):
     user = msg["from"]
     chat_id = msg["chat"]["id"]
@@ -2588,11 +5155,12 @@ def show_admin_status(msg: dict):
         send_message(chat_id, "Эта команда только для администратора.", kb_main(is_admin=False))
         return
     rc, out = run_cmd([METRICS_CMD], timeout_sec=45)
+    bot_txt = "\n".join(bot_metrics_lines())
     if rc == 0:
-        send_message(chat_id, out[:3500], kb_admin())
+        send_message(chat_id, (out[:3000] + "\n\n" + bot_txt)[:3500], kb_admin())
     else:
-        text = "❌ Не удалось получить метрики узла.\n\n" + (out[:3000] if out else f"rc={rc}")
-        send_message(chat_id, text, kb_admin())
+        text = "❌ Не удалось получить метрики узла.\n\n" + (out[:2500] if out else f"rc={rc}") + "\n\n" + bot_txt
+        send_message(chat_id, text[:3500], kb_admin())
 
 
 def show_admin_devices_overview(conn: sqlite3.Connection, msg: dict, force_live: bool = False):
@@ -2601,11 +5169,7 @@ def show_admin_devices_overview(conn: sqlite3.Connection, msg: dict, force_live:
     if not is_admin_user(user):
         send_message(chat_id, "Эта команда только для администратора.", kb_main(is_admin=False))
         return
-    try:
-        parsed = ingest_device_log(conn)
-    except Exception as e:
-        print(f"[device-ingest-error] {e}", file=sys.stderr, flush=True)
-        parsed = 0
+    parsed = refresh_device_log(conn)
     rows = get_device_stats_by_user(conn, limit=12)
     online_total = online_users_count(conn)
     live = get_live_online_snapshot(force=force_live)
@@ -2616,7 +5180,7 @@ def show_admin_devices_overview(conn: sqlite3.Connection, msg: dict, force_live:
         live_users.add(canonical_vpn_name(conn, u))
     lines = [
         f"📱 Устройства (сбор без лимитов)",
-        f"Обновлено записей: {parsed}",
+        device_ingest_status_line(conn, parsed),
         f"Онлайн сейчас (окно {int(ONLINE_WINDOW_SEC/60)} мин): {online_total}",
     ]
     if live.get("enabled"):
@@ -2657,10 +5221,7 @@ def show_admin_online_sessions(conn: sqlite3.Connection, msg: dict, force_live:
     if not is_admin_user(user):
         send_message(chat_id, "Эта команда только для администратора.", kb_main(is_admin=False))
         return
-    try:
-        ingest_device_log(conn)
-    except Exception as e:
-        print(f"[device-ingest-error] {e}", file=sys.stderr, flush=True)
+    refresh_device_log(conn)
     live = get_live_online_snapshot(force=force_live)
     if not live.get("enabled"):
         send_message(chat_id, "🟢 Онлайн сессии\n\nLIVE мониторинг отключен.", kb_admin_service())
@@ -2683,8 +5244,8 @@ def show_admin_online_sessions(conn: sqlite3.Connection, msg: dict, force_live:
             who = f"{disp} ({canon})" if disp != canon else canon
             d = get_latest_device_for_user(conn, canon)
             if d:
-                dkey, hwid, ua, platform, os_name, os_version, device_model, app_ver, _last_seen = d
-                title = human_device_title(platform, os_name, os_version, device_model, ua) or "Устройство"
+                dkey, hwid, ua, platform, os_name, os_version, device_model, app_ver, _last_seen, title = d
+                title = title or "Устройство"
                 ident = human_device_id(dkey, hwid)
                 lines.append(f"- {who} | { _safe_text(title, 48) } | { _safe_text(ident, 24) }")
             else:
@@ -2754,10 +5315,7 @@ def show_admin_user_traffic(conn: sqlite3.Connection, msg: dict, vpn_name: str,
 
 def show_admin_user_devices(conn: sqlite3.Connection, msg: dict, vpn_name: str):
     chat_id = msg["chat"]["id"]
-    try:
-        ingest_device_log(conn)
-    except Exception as e:
-        print(f"[device-ingest-error] {e}", file=sys.stderr, flush=True)
+    refresh_device_log(conn)
 
     rows = get_devices_for_user(conn, vpn_name, limit=DEVICE_LIST_LIMIT)
     live = get_live_online_snapshot(force=False)
@@ -2785,9 +5343,8 @@ def show_admin_user_devices(conn: sqlite3.Connection, msg: dict, vpn_name: str):
         "",
     ]
     for i, r in enumerate(rows, start=1):
-        device_key, hwid, ua, ip, platform, os_name, os_version, device_model, app_version, lang, first_seen, last_seen, hits, pending = r
+        device_key, hwid, ua, ip, platform, os_name, os_version, device_model, app_version, lang, first_seen, last_seen, hits, pending, title = r
         ident = human_device_id(device_key, hwid)
-        title = human_device_title(platform, os_name, os_version, device_model, ua)
         lines.append(f"{i}) ID: {_safe_text(ident, 48)}")
         if title:
             lines.append(f"Устройство: {_safe_text(title, 120)}")
@@ -2817,9 +5374,14 @@ def start_select(conn: sqlite3.Connection, msg: dict, intent: str, query: str =
     elif intent == "trial_off":
         filter_mode = "only_trial"
     rows = build_user_rows(conn, query=query, filter_mode=filter_mode)
+    if offset < 0:
+        offset = 0
+    if offset >= len(rows):
+        offset = max(0, len(rows) - SELECT_PAGE_SIZE)
+    page = rows[offset: offset + SELECT_PAGE_SIZE]
     if intent == "devices":
-        counts = get_device_counts_map(conn)
-        for r in rows:
+        counts = get_device_counts_map(conn, [r.get("name", "") for r in page])
+        for r in page:
             n = r.get("name", "")
             active, pending = counts.get(n, (0, 0))
             r["devices_active"] = active
@@ -2828,11 +5390,6 @@ def start_select(conn: sqlite3.Connection, msg: dict, intent: str, query: str =
             if pending > 0:
                 suffix += f" (+{pending})"
             r["label"] = f"{r['display']} | устройств: {suffix}"
-    if offset < 0:
-        offset = 0
-    if offset >= len(rows):
-        offset = max(0, len(rows) - SELECT_PAGE_SIZE)
-    page = rows[offset: offset + SELECT_PAGE_SIZE]
 
     set_admin_state(conn, tg_id, STATE_SELECT_USER, {"intent": intent, "query": query, "offset": offset})
 
@@ -2908,7 +5465,7 @@ def handle_admin_text(conn: sqlite3.Connection, msg: dict, text: str, st: dict):
             send_message(chat_id, "Некорректное значение. Введи целое число дней > 0.", kb_admin_back())
             return True
         name = payload.get("name", "")
-        rc, out = run_cmd([ADD_USER_CMD, "--name", name, "--days", str(days)], timeout_sec=300)
+        rc, out = run_clients_cmd([ADD_USER_CMD, "--name", name, "--days", str(days)], timeout_sec=300)
         clear_admin_state(conn, tg_id)
         if rc == 0:
             print(f"[admin-add-ok] name={name} days={days}", file=sys.stderr, flush=True)
@@ -3004,7 +5561,7 @@ def handle_confirm_callback(conn: sqlite3.Connection, msg: dict, action: str, st
         return True
 
     if step == STATE_DEL_CONFIRM and action == CB_CONFIRM_DELETE:
-        rc, out = run_cmd([DEL_USER_CMD, "--name", name], timeout_sec=300)
+        rc, out = run_clients_cmd([DEL_USER_CMD, "--name", name], timeout_sec=300)
         clear_admin_state(conn, tg_id)
         if rc == 0:
             notify_user_change(
@@ -3247,20 +5804,14 @@ def dispatch_action(conn: sqlite3.Connection, msg: dict, action: str):
         if not is_admin_user(user):
             send_message(chat_id, "Эта команда только для администратора.", kb_main(is_admin=False))
             return
-        try:
-            ingest_device_log(conn)
-        except Exception as e:
-            print(f"[device-ingest-error] {e}", file=sys.stderr, flush=True)
+        refresh_device_log(conn)
         start_select(conn, msg, intent="devices", query="", offset=0)
     elif action == CB_ADMIN_DEVICES_REFRESH:
         if not is_admin_user(user):
             send_message(chat_id, "Эта команда только для администратора.", kb_main(is_admin=False))
             return
         clear_admin_state(conn, tg_id)
-        try:
-            ingest_device_log(conn)
-        except Exception as e:
-            print(f"[device-ingest-error] {e}", file=sys.stderr, flush=True)
+        refresh_device_log(conn)
         start_select(conn, msg, intent="devices", query="", offset=0)
     elif action == CB_ADMIN_ONLINE:
         if not is_admin_user(user):
@@ -3386,10 +5937,281 @@ def dispatch_action(conn: sqlite3.Connection, msg: dict, action: str):
         show_main(chat_id, user)
 
 
+def update_chat_key(upd: dict):
+    cq = upd.get("callback_query") or {}
+    msg = upd.get("message") or cq.get("message") or {}
+    chat_id = (msg.get("chat") or {}).get("id")
+    if chat_id is None:
+        actor = cq.get("from") or (upd.get("pre_checkout_query") or {}).get("from") or {}
+        chat_id = actor.get("id")
+    return int(chat_id or 0)
+
+
+# Updates are fanned out to UPDATE_WORKERS threads; updates of one chat stay strictly ordered.
+_dispatch_cond = threading.Condition()
+_dispatch_chats = {}
+_dispatch_ready = deque()
+_dispatch_stats = {"queued": 0, "max_queued": 0, "busy": 0, "done": 0, "errors": 0, "handler_ms_total": 0, "handler_ms_max": 0}
+
+
+def dispatch_stats():
+    with _dispatch_cond:
+        return dict(_dispatch_stats)
+
+
+def submit_update(upd: dict):
+    key = update_chat_key(upd)
+    with _dispatch_cond:
+        while _dispatch_stats["queued"] >= max(1, UPDATE_QUEUE_MAX):
+            _dispatch_cond.wait()
+        q = _dispatch_chats.get(key)
+        if q is None:
+            q = deque()
+            _dispatch_chats[key] = q
+            _dispatch_ready.append(key)
+        q.append(upd)
+        _dispatch_stats["queued"] += 1
+        _dispatch_stats["max_queued"] = max(_dispatch_stats["max_queued"], _dispatch_stats["queued"])
+        _dispatch_cond.notify_all()
+
+
+def process_update(conn: sqlite3.Connection, key: int, upd: dict):
+    started = time.monotonic()
+    failed = False
+    try:
+        with unit_of_work():
+            handle_update(conn, upd)
+    except Exception as e:
+        failed = True
+        print(f"[update-worker-error] chat={key} update={upd.get('update_id')} err={e}", file=sys.stderr, flush=True)
+        traceback.print_exc()
+    elapsed_ms = int((time.monotonic() - started) * 1000)
+    with _dispatch_cond:
+        _dispatch_stats["done"] += 1
+        if failed:
+            _dispatch_stats["errors"] += 1
+        _dispatch_stats["handler_ms_total"] += elapsed_ms
+        _dispatch_stats["handler_ms_max"] = max(_dispatch_stats["handler_ms_max"], elapsed_ms)
+
+
+def update_worker_loop():
+    conn = db_conn()
+    while True:
+        with _dispatch_cond:
+            while not _dispatch_ready:
+                _dispatch_cond.wait()
+            # A chat stays in _dispatch_chats while one of its updates runs, so it is never picked twice.
+            key = _dispatch_ready.popleft()
+            upd = _dispatch_chats[key].popleft()
+            _dispatch_stats["busy"] += 1
+        process_update(conn, key, upd)
+        with _dispatch_cond:
+            _dispatch_stats["queued"] -= 1
+            _dispatch_stats["busy"] -= 1
+            if _dispatch_chats.get(key):
+                _dispatch_ready.append(key)
+            else:
+                _dispatch_chats.pop(key, None)
+            _dispatch_cond.notify_all()
+
+
+def handle_update(conn: sqlite3.Connection, upd: dict):
+    pcq = upd.get("pre_checkout_query")
+    if pcq:
+        pcq_id = pcq.get("id")
+        if pcq_id:
+            answer_pre_checkout(pcq_id, True)
+        return
+
+    cq = upd.get("callback_query")
+    if cq:
+        msg = cq.get("message")
+        actor = cq.get("from")
+        if msg:
+            if actor:
+                msg["from"] = actor
+            data = (cq.get("data") or "").strip()
+            dispatch_action(conn, msg, data)
+        answer_callback(cq.get("id"))
+        return
+
+    msg = upd.get("message")
+    if not msg:
+        return
+
+    successful = msg.get("successful_payment")
+    if successful:
+        user = msg.get("from") or {}
+        tg_id = int(user.get("id") or 0)
+        row = get_user(conn, tg_id)
+        payload = (successful.get("invoice_payload") or "").strip().lower()
+        m = re.fullmatch(r"sub_(\d+)m", payload)
+        months = int(m.group(1)) if m else 0
+        plan = PAYMENT_PLANS.get(months)
+        if not row or not plan:
+            send_message(
+                int(msg["chat"]["id"]),
+                "✅ Оплата получена. Напиши в поддержку для ручной активации.\n\n" + SUPPORT_TEXT,
+                kb_main(is_admin=is_admin_user(user)),
+            )
+            send_admin_alert(
+                f"💳 Получена оплата Stars, но не удалось авто-продлить.\n"
+                f"tg_id={tg_id} payload={payload or '-'}"
+            )
+            return
+
+        vpn_name = row[2]
+        days = int(plan["days"])
+        ok, out = extend_user_expire_days(vpn_name, days)
+        if ok:
+            set_trial_flag(vpn_name, False)
+            info = find_subscription_info(vpn_name)
+            exp_txt = (info or {}).get("expire_text", "обновлено")
+            send_message(
+                int(msg["chat"]["id"]),
+                f"✅ Оплата получена. Подписка продлена на {months} мес.\nДействует до: {exp_txt}",
+                kb_main(is_admin=is_admin_user(user)),
+            )
+        else:
+            send_message(
+                int(msg["chat"]["id"]),
+                "✅ Оплата получена.\n❌ Не удалось авто-продлить срок, напиши в поддержку.\n\n" + SUPPORT_TEXT,
+                kb_main(is_admin=is_admin_user(user)),
+            )
+            send_admin_alert(
+                f"💳 Оплата получена, но продление не применилось.\n"
+                f"user={vpn_name} tg_id={tg_id} payload={payload or '-'}\n{out[:1200]}"
+            )
+        return
+
+    text = (msg.get("text") or "").strip()
+    if not text:
+        return
+
+    if text.startswith("/start"):
+        handle_start(conn, msg)
+        return
+
+    user = msg.get("from") or {}
+    tg_id = int(user.get("id") or 0)
+    st = get_admin_state(conn, tg_id)
+    if st and is_admin_user(user):
+        if handle_admin_text(conn, msg, text, st):
+            return
+
+    dispatch_action(conn, msg, text)
+
+
+_webhook_lock = threading.Lock()
+_webhook_rt = {"sink": None, "seen": deque(maxlen=2048), "seen_ids": set()}
+_webhook_stats = {"accepted": 0, "rejected": 0, "duplicates": 0}
+
+
+def webhook_stats():
+    with _webhook_lock:
+        return dict(_webhook_stats)
+
+
+def accept_webhook_update(upd: dict):
+    update_id = int(upd.get("update_id") or 0)
+    with _webhook_lock:
+        # Telegram redelivers an update if it did not see our 200 in time.
+        if update_id in _webhook_rt["seen_ids"]:
+            _webhook_stats["duplicates"] += 1
+            return False
+        seen = _webhook_rt["seen"]
+        if len(seen) == seen.maxlen:
+            _webhook_rt["seen_ids"].discard(seen[0])
+        seen.append(update_id)
+        _webhook_rt["seen_ids"].add(update_id)
+        _webhook_stats["accepted"] += 1
+    _webhook_rt["sink"](upd)
+    return True
+
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    def _reply(self, code: int):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        self.wfile.flush()
+
+    def _reject(self, code: int):
+        with _webhook_lock:
+            _webhook_stats["rejected"] += 1
+        self._reply(code)
+
+    def do_POST(self):
+        if self.path.split("?", 1)[0] != WEBHOOK_PATH:
+            self._reject(404)
+            return
+        secret = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret.encode("utf-8"), WEBHOOK_SECRET.encode("utf-8")):
+            self._reject(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = 0
+        if length <= 0 or length > 1024 * 1024:
+            self._reject(400)
+            return
+        try:
+            upd = json.loads(self.rfile.read(length).decode("utf-8", errors="ignore"))
+        except Exception:
+            upd = None
+        if not isinstance(upd, dict) or "update_id" not in upd:
+            self._reject(400)
+            return
+        self._reply(200)
+        try:
+            accept_webhook_update(upd)
+        except Exception as e:
+            print(f"[webhook-error] update={upd.get('update_id')} err={e}", file=sys.stderr, flush=True)
+            traceback.print_exc()
+
+    def do_GET(self):
+        self._reject(405)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_webhook_server(sink):
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        print("UPDATES_MODE=webhook requires WEBHOOK_URL and WEBHOOK_SECRET", file=sys.stderr)
+        sys.exit(1)
+    _webhook_rt["sink"] = sink
+    host, _sep, port = WEBHOOK_LISTEN.rpartition(":")
+    server = http.server.ThreadingHTTPServer((host or "127.0.0.1", int(port)), WebhookHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    api_call(
+        "setWebhook",
+        {
+            "url": WEBHOOK_URL,
+            "secret_token": WEBHOOK_SECRET,
+            "max_connections": max(1, WEBHOOK_MAX_CONNECTIONS),
+            "allowed_updates": ["message", "callback_query", "pre_checkout_query"],
+        },
+    )
+    print(f"[webhook] listening on {WEBHOOK_LISTEN}{WEBHOOK_PATH}", file=sys.stderr, flush=True)
+
+
+def drop_webhook():
+    # getUpdates is refused while a webhook is set, e.g. after switching back from webhook mode.
+    try:
+        api_call("deleteWebhook", {"drop_pending_updates": False})
+    except Exception as e:
+        print(f"[webhook] deleteWebhook failed: {e}", file=sys.stderr, flush=True)
+
+
 def main_loop():
-    conn = sqlite3.connect(DB_PATH)
-    init_db(conn)
+    conn = db_conn()
     ensure_bot_menu_commands()
+    clients_registry.flush()
+    start_outbox()
+    start_device_socket()
 
     worker = Thread(target=provision_worker_loop, daemon=True)
     worker.start()
@@ -3405,104 +6227,188 @@ def main_loop():
     trial_notifier.start()
     traffic_collector = Thread(target=traffic_collect_loop, daemon=True)
     traffic_collector.start()
-
+    device_ingester = Thread(target=device_ingest_loop, daemon=True)
+    device_ingester.start()
+    # Webhook requests are acknowledged before handling, so they always go through the worker pool.
+    workers = max(1 if UPDATES_MODE == "webhook" else 0, UPDATE_WORKERS)
+    for _ in range(workers):
+        Thread(target=update_worker_loop, daemon=True).start()
+    print(f"[updates] mode={UPDATES_MODE} workers={workers} queue_max={UPDATE_QUEUE_MAX}", file=sys.stderr, flush=True)
+
+    if UPDATES_MODE == "webhook":
+        start_webhook_server(submit_update)
+        while True:
+            time.sleep(3600)
+
+    drop_webhook()
     offset = 0
     while True:
         try:
             updates = api_call("getUpdates", {"timeout": 30, "offset": offset})
             for upd in updates:
                 offset = max(offset, int(upd["update_id"]) + 1)
+                if workers > 0:
+                    submit_update(upd)
+                else:
+                    with unit_of_work():
+                        handle_update(conn, upd)
 
-                pcq = upd.get("pre_checkout_query")
-                if pcq:
-                    pcq_id = pcq.get("id")
-                    if pcq_id:
-                        answer_pre_checkout(pcq_id, True)
-                    continue
-
-                cq = upd.get("callback_query")
-                if cq:
-                    msg = cq.get("message")
-                    actor = cq.get("from")
-                    if msg:
-                        if actor:
-                            msg["from"] = actor
-                        data = (cq.get("data") or "").strip()
-                        dispatch_action(conn, msg, data)
-                    answer_callback(cq.get("id"))
-                    continue
+        except Exception as e:
+            print(f"loop error: {e}", file=sys.stderr)
+            traceback.print_exc()
+            time.sleep(2)
 
-                msg = upd.get("message")
-                if not msg:
-                    continue
 
-                successful = msg.get("successful_payment")
-                if successful:
-                    user = msg.get("from") or {}
-                    tg_id = int(user.get("id") or 0)
-                    row = get_user(conn, tg_id)
-                    payload = (successful.get("invoice_payload") or "").strip().lower()
-                    m = re.fullmatch(r"sub_(\d+)m", payload)
-                    months = int(m.group(1)) if m else 0
-                    plan = PAYMENT_PLANS.get(months)
-                    if not row or not plan:
-                        send_message(
-                            int(msg["chat"]["id"]),
-                            "✅ Оплата получена. Напиши в поддержку для ручной активации.\n\n" + SUPPORT_TEXT,
-                            kb_main(is_admin=is_admin_user(user)),
-                        )
-                        send_admin_alert(
-                            f"💳 Получена оплата Stars, но не удалось авто-продлить.\n"
-                            f"tg_id={tg_id} payload={payload or '-'}"
-                        )
-                        continue
-
-                    vpn_name = row[2]
-                    days = int(plan["days"])
-                    ok, out = extend_user_expire_days(vpn_name, days)
-                    if ok:
-                        set_trial_flag(vpn_name, False)
-                        info = find_subscription_info(vpn_name)
-                        exp_txt = (info or {}).get("expire_text", "обновлено")
-                        send_message(
-                            int(msg["chat"]["id"]),
-                            f"✅ Оплата получена. Подписка продлена на {months} мес.\nДействует до: {exp_txt}",
-                            kb_main(is_admin=is_admin_user(user)),
-                        )
-                    else:
-                        send_message(
-                            int(msg["chat"]["id"]),
-                            "✅ Оплата получена.\n❌ Не удалось авто-продлить срок, напиши в поддержку.\n\n" + SUPPORT_TEXT,
-                            kb_main(is_admin=is_admin_user(user)),
-                        )
-                        send_admin_alert(
-                            f"💳 Оплата получена, но продление не применилось.\n"
-                            f"user={vpn_name} tg_id={tg_id} payload={payload or '-'}\n{out[:1200]}"
-                        )
-                    continue
+def background_jobs():
+    jobs = [
+        provision_worker_job(),
+        monitor_job(),
+        replica_monitor_job(),
+        traffic_report_job(),
+        traffic_anomaly_job(),
+        trial_notice_job(),
+        traffic_collect_job(),
+        device_ingest_job(),
+    ]
+    return [j for j in jobs if j is not None]
+
+
+async def run_scheduler_async(jobs: list[dict]):
+    loop = asyncio.get_running_loop()
+    # Ticks get their own threads (a job never overlaps itself, so one each is enough): a tick blocked in a
+    # bridged run_cmd for minutes must not take a thread from update handlers in the default executor.
+    job_executor = ThreadPoolExecutor(max_workers=max(1, len(jobs)), thread_name_prefix="bot-job")
+    heap = [(loop.time(), i, job) for i, job in enumerate(jobs)]
+    heapq.heapify(heap)
+    seq = len(heap)
+    wake = asyncio.Event()
+    running = set()
+
+    async def run(job: dict):
+        nonlocal seq
+        delay = await loop.run_in_executor(job_executor, run_job_once, job)
+        if job["wait_async"] is not None:
+            try:
+                delay = await job["wait_async"](job["state"], delay)
+            except Exception as e:
+                print(f"{job['error_prefix']} {e}", file=sys.stderr, flush=True)
+                delay = job["error_delay"]
+        seq += 1
+        heapq.heappush(heap, (loop.time() + max(0, delay), seq, job))
+        wake.set()
 
-                text = (msg.get("text") or "").strip()
-                if not text:
-                    continue
+    while True:
+        wake.clear()
+        if not heap:
+            await wake.wait()
+            continue
+        due = heap[0][0]
+        if due > loop.time():
+            try:
+                await asyncio.wait_for(wake.wait(), due - loop.time())
+            except asyncio.TimeoutError:
+                pass
+            continue
+        _due, _seq, job = heapq.heappop(heap)
+        task = loop.create_task(run(job))
+        running.add(task)
+        task.add_done_callback(running.discard)
 
-                if text.startswith("/start"):
-                    handle_start(conn, msg)
-                    continue
 
-                user = msg.get("from") or {}
-                tg_id = int(user.get("id") or 0)
-                st = get_admin_state(conn, tg_id)
-                if st and is_admin_user(user):
-                    if handle_admin_text(conn, msg, text, st):
-                        continue
+def _process_update_in_executor(key: int, upd: dict):
+    process_update(db_conn(), key, upd)
 
-                dispatch_action(conn, msg, text)
 
+async def _handle_update_async(key: int, upd: dict, prev: asyncio.Task | None, slots: asyncio.Semaphore):
+    busy = False
+    try:
+        if prev is not None:
+            await asyncio.wait({prev})
+        with _dispatch_cond:
+            _dispatch_stats["busy"] += 1
+        busy = True
+        await asyncio.get_running_loop().run_in_executor(None, _process_update_in_executor, key, upd)
+    finally:
+        with _dispatch_cond:
+            _dispatch_stats["queued"] -= 1
+            if busy:
+                _dispatch_stats["busy"] -= 1
+        slots.release()
+
+
+async def enqueue_update_async(upd: dict):
+    slots = _async_rt["update_slots"]
+    # Last scheduled task per chat: each new update of the chat waits for it, which keeps per-chat order.
+    chat_tails = _async_rt["chat_tails"]
+    await slots.acquire()
+    key = update_chat_key(upd)
+    with _dispatch_cond:
+        _dispatch_stats["queued"] += 1
+        _dispatch_stats["max_queued"] = max(_dispatch_stats["max_queued"], _dispatch_stats["queued"])
+    task = asyncio.get_running_loop().create_task(_handle_update_async(key, upd, chat_tails.get(key), slots))
+    chat_tails[key] = task
+    task.add_done_callback(lambda t, k=key: chat_tails.pop(k, None) if chat_tails.get(k) is t else None)
+
+
+async def poll_updates_async():
+    offset = 0
+    while True:
+        try:
+            updates = await api_call_async("getUpdates", {"timeout": 30, "offset": offset})
         except Exception as e:
             print(f"loop error: {e}", file=sys.stderr)
             traceback.print_exc()
-            time.sleep(2)
+            await asyncio.sleep(2)
+            continue
+        for upd in updates:
+            offset = max(offset, int(upd["update_id"]) + 1)
+            await enqueue_update_async(upd)
+
+
+async def main_async():
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=max(2, ASYNC_MAX_WORKERS), thread_name_prefix="bot-exec"))
+    _async_rt["tg_sem"] = asyncio.Semaphore(max(1, TG_ASYNC_MAX_CONNS))
+    _async_rt["update_slots"] = asyncio.Semaphore(max(1, UPDATE_QUEUE_MAX))
+    _async_rt["chat_tails"] = {}
+    _async_rt["thread_id"] = threading.get_ident()
+    _async_rt["loop"] = loop
+    await loop.run_in_executor(None, db_conn)
+    await loop.run_in_executor(None, ensure_bot_menu_commands)
+    await loop.run_in_executor(None, clients_registry.flush)
+    await loop.run_in_executor(None, start_outbox)
+    await loop.run_in_executor(None, start_device_socket)
+    jobs = await loop.run_in_executor(None, background_jobs)
+    print(
+        f"[runtime] asyncio jobs={len(jobs)} (own threads) executor={max(2, ASYNC_MAX_WORKERS)} tg_conns={TG_ASYNC_MAX_CONNS}",
+        file=sys.stderr,
+        flush=True,
+    )
+    if UPDATES_MODE == "webhook":
+        await loop.run_in_executor(
+            None, start_webhook_server, lambda upd: asyncio.run_coroutine_threadsafe(enqueue_update_async(upd), loop)
+        )
+        await run_scheduler_async(jobs)
+    else:
+        await loop.run_in_executor(None, drop_webhook)
+        await asyncio.gather(run_scheduler_async(jobs), poll_updates_async())
 
 
 if __name__ == "__main__":
-    main_loop()
+    if sys.argv[1:2] == ["bench-device-log"]:
+        bench_device_log(int(sys.argv[2]) if len(sys.argv) > 2 else 1000000)
+    elif sys.argv[1:2] == ["backfill-devices"]:
+        # bot.py backfill-devices [--workers N] [log ...]; default: DEVICE_LOG_PATH and its rotations
+        args = sys.argv[2:]
+        n_workers = 0
+        if args[:1] == ["--workers"] and len(args) > 1:
+            n_workers = int(args[1])
+            args = args[2:]
+        backfill_device_logs(args, n_workers)
+    elif sys.argv[1:2] == ["bench-traffic-rollup"]:
+        # bot.py bench-traffic-rollup [users] [days]
+        bench_traffic_rollup(*[int(a) for a in sys.argv[2:4]])
+    elif BOT_RUNTIME == "asyncio":
+        asyncio.run(main_async())
+    else:
+        main_loop()
@@ -0,0 +1,68 @@
+#!/usr/bin/env bash
+set -euo pipefail
+
+# POST a fake Telegram update to the bot webhook receiver (UPDATES_MODE=webhook).
+WEBHOOK_LOCAL_URL="${WEBHOOK_LOCAL_URL:-http://127.0.0.1:8081/tg-webhook}"
+WEBHOOK_SECRET="${WEBHOOK_SECRET:-}"
+CHAT_ID="${CHAT_ID:-227380225}"
+TEXT="${TEXT:-/start}"
+CALLBACK_DATA="${CALLBACK_DATA:-}"
+COUNT="${COUNT:-1}"
+
+usage() {
+  cat <<USAGE
+Usage:
+  WEBHOOK_SECRET=<secret> webhook_fake_update.sh [--text <text>] [--callback <data>] [--chat <id>] [--count <N>]
+
+Env:
+  WEBHOOK_LOCAL_URL (default: http://127.0.0.1:8081/tg-webhook)
+USAGE
+}
+
+while [[ $# -gt 0 ]]; do
+  case "$1" in
+    --text)
+      TEXT="${2:-}"; shift 2 ;;
+    --callback)
+      CALLBACK_DATA="${2:-}"; shift 2 ;;
+    --chat)
+      CHAT_ID="${2:-}"; shift 2 ;;
+    --count)
+      COUNT="${2:-}"; shift 2 ;;
+    -h|--help)
+      usage; exit 0 ;;
+    *)
+      echo "Unknown arg: $1" >&2
+      usage
+      exit 1 ;;
+  esac
+done
+
+if [[ -z "$WEBHOOK_SECRET" ]]; then
+  echo "WEBHOOK_SECRET is required" >&2
+  exit 1
+fi
+
+base_id="$(date +%s)"
+for ((i = 0; i < COUNT; i++)); do
+  payload="$(CHAT_ID="$CHAT_ID" TEXT="$TEXT" CALLBACK_DATA="$CALLBACK_DATA" UPDATE_ID="$((base_id * 1000 + i))" python3 - <<'PY'
+import json, os, time
+chat_id = int(os.environ["CHAT_ID"])
+user = {"id": chat_id, "is_bot": False, "first_name": "Fake", "username": "fake_user"}
+msg = {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "from": user}
+upd = {"update_id": int(os.environ["UPDATE_ID"])}
+if os.environ.get("CALLBACK_DATA"):
+    upd["callback_query"] = {"id": str(upd["update_id"]), "from": user, "message": msg, "data": os.environ["CALLBACK_DATA"]}
+else:
+    msg["text"] = os.environ["TEXT"]
+    upd["message"] = msg
+print(json.dumps(upd, ensure_ascii=False))
+PY
+)"
+  code="$(curl -sS -o /dev/null -w '%{http_code}' -X POST \
+    -H 'Content-Type: application/json' \
+    -H "X-Telegram-Bot-Api-Secret-Token: ${WEBHOOK_SECRET}" \
+    --data-binary "$payload" \
+    "$WEBHOOK_LOCAL_URL")"
+  echo "update $((base_id * 1000 + i)): HTTP ${code}"
+done